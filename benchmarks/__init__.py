@@ -0,0 +1,11 @@
+"""
+iMWLRDB: Internet Multi-line Width-Limited Record Database Format
+
+Benchmarks
+
+* python -m benchmarks: full suite on synthetic workloads, with
+  results saved as JSON
+
+* python -m benchmarks.wrap: line wrapping micro-benchmark
+
+"""
@@ -0,0 +1,247 @@
+"""
+iMWLRDB: Internet Multi-line Width-Limited Record Database Format
+
+Benchmark suite: times line wrapping, serialisation, streaming export
+and reading on synthetic workloads from benchmarks.workloads, and
+writes the results to a JSON file for comparison between revisions.
+
+Run with: python -m benchmarks [--sizes 64K,1M] [--out results.json]
+
+Compare with: python -m benchmarks --compare old.json new.json
+
+Sizes accept K, M and G suffixes. Workloads in the GB range are held
+in memory while serialising; measure those on a roomy machine.
+
+"""
+#
+# Copyright 2023 Moses Chong
+#
+# Licensed under the terms and conditions of the
+# Apache License Version 2.0.
+#
+from argparse import ArgumentParser
+from collections import deque
+from tempfile import TemporaryDirectory
+from time import perf_counter
+import json
+import os
+import platform
+import sys
+import tracemalloc
+from benchmarks.workloads import records, SEED
+from imwlrdb import (
+    bytes_with_breaks,
+    imlwldb_iter,
+    imwlrdb,
+    as_format,
+    mwlr_iter,
+    MWLRReader,
+    MWLRWriter,
+)
+
+KINDS = ('contacts', 'calendar', 'emails')
+SIZES_DEFAULT = '64K,1M'
+SUFFIXES = {'K': 1 << 10, 'M': 1 << 20, 'G': 1 << 30}
+REGRESSION_DEFAULT = 0.1
+
+def parse_size(s):
+    """Return number of bytes from a size like '64K' or '2G'"""
+    s = s.strip().upper()
+    if s[-1:] in SUFFIXES:
+        return int(float(s[:-1]) * SUFFIXES[s[-1]])
+    return int(s)
+
+def field_values(w):
+    """Return list of all field strings in a workload, in nested records too"""
+    out = []
+    stack = list(w['records'])
+    while stack:
+        d = stack.pop()
+        for k, v in d.items():
+            if isinstance(v, dict):
+                if '__type' in v: stack.append(v)
+                else: out.extend(str(x) for x in v.values())
+            else:
+                out.append(f'{k}:{v}')
+    return out
+
+def bench_wrap(w, fpath):
+    fmt = as_format(w['format'])
+    vals = field_values(w)
+    def run():
+        n = 0
+        for s in vals:
+            n += len(bytes_with_breaks(s, fmt.width, fmt.eol, fmt.sol))
+        return n
+    return run
+
+def bench_iter(w, fpath):
+    fmt = w['format']
+    def run():
+        n = 0
+        for d, uid in zip(w['records'], w['uids']):
+            for b in imlwldb_iter(d, uid, out_format=fmt): n += len(b)
+        return n
+    return run
+
+def bench_imwlrdb(w, fpath):
+    fmt = w['format']
+    def run():
+        return sum(
+            len(imwlrdb(d, uid, out_format=fmt))
+            for d, uid in zip(w['records'], w['uids'])
+        )
+    return run
+
+def bench_writer(w, fpath):
+    fmt = w['format']
+    def run():
+        with open(fpath, 'wb') as f, MWLRWriter(f, out_format=fmt) as wr:
+            for d, uid in zip(w['records'], w['uids']): wr.write(d, uid)
+        return os.path.getsize(fpath)
+    return run
+
+def bench_mwlr_iter(w, fpath):
+    fmt = w['format']
+    def run():
+        with open(fpath, 'rb') as f:
+            deque(mwlr_iter(f, in_format=fmt, **w['read_args']), maxlen=0)
+        return os.path.getsize(fpath)
+    return run
+
+def bench_reader(w, fpath):
+    fmt = w['format']
+    args = {k: v for k, v in w['read_args'].items() if k != 'depth'}
+    def run():
+        with MWLRReader(fpath, in_format=fmt, **args) as r:
+            for uid in r.uids: r.record(uid)
+        return os.path.getsize(fpath)
+    return run
+
+BENCHES = {
+    'bytes_with_breaks': bench_wrap,
+    'imlwldb_iter': bench_iter,
+    'imwlrdb': bench_imwlrdb,
+    'MWLRWriter': bench_writer,
+    'mwlr_iter': bench_mwlr_iter,
+    'MWLRReader': bench_reader,
+}
+WRITES_FILE = 'MWLRWriter'
+
+def measure(run, rounds):
+    """
+    Return (best time in seconds, bytes processed, peak memory in bytes)
+    of a benchmark; peak memory is taken from a separate, traced run,
+    so that tracing does not skew the timings.
+
+    """
+    best = None
+    for _ in range(rounds):
+        t = perf_counter()
+        nbytes = run()
+        t = perf_counter() - t
+        best = t if best is None else min(best, t)
+    tracemalloc.start()
+    try:
+        run()
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+    return best, nbytes, peak
+
+def bench(sizes, kinds=KINDS, names=tuple(BENCHES), rounds=3, seed=SEED):
+    """Return list of result dicts, one per workload, size and benchmark"""
+    out = []
+    with TemporaryDirectory() as tmp:
+        for kind in kinds:
+            for size in sizes:
+                w = records(kind, size, seed=seed)
+                fpath = os.path.join(tmp, f'{kind}-{size}.mwlr')
+                BENCHES[WRITES_FILE](w, fpath)()
+                for name in names:
+                    t, nbytes, peak = measure(BENCHES[name](w, fpath), rounds)
+                    out.append({
+                        'workload': kind,
+                        'size': size,
+                        'bench': name,
+                        'seconds': t,
+                        'bytes': nbytes,
+                        'records': w['count'],
+                        'mb_s': nbytes / t / 1e6,
+                        'records_s': w['count'] / t,
+                        'peak_bytes': peak,
+                    })
+    return out
+
+def meta(seed, rounds):
+    return {
+        'python': sys.version,
+        'implementation': platform.python_implementation(),
+        'platform': platform.platform(),
+        'machine': platform.machine(),
+        'cpus': os.cpu_count(),
+        'seed': seed,
+        'rounds': rounds,
+    }
+
+def compare(old, new, threshold=REGRESSION_DEFAULT):
+    """
+    Return list of (key, old MB/s, new MB/s, ratio, regressed) of
+    benchmarks found in both results; 'regressed' is True where the
+    new throughput is lower than the old by more than 'threshold'.
+
+    """
+    def keyed(res):
+        return {(r['workload'], r['size'], r['bench']): r for r in res}
+    a = keyed(old['results'])
+    b = keyed(new['results'])
+    out = []
+    for k in a:
+        if k not in b: continue
+        ratio = b[k]['mb_s'] / a[k]['mb_s']
+        out.append((k, a[k]['mb_s'], b[k]['mb_s'], ratio, ratio < 1-threshold))
+    return out
+
+def main(argv=None):
+    ap = ArgumentParser(prog='python -m benchmarks')
+    ap.add_argument('--sizes', default=SIZES_DEFAULT)
+    ap.add_argument('--workloads', default=','.join(KINDS))
+    ap.add_argument('--benches', default=','.join(BENCHES))
+    ap.add_argument('--rounds', type=int, default=3)
+    ap.add_argument('--seed', type=int, default=SEED)
+    ap.add_argument('--out', default='benchmark-results.json')
+    ap.add_argument('--compare', nargs=2, metavar=('OLD', 'NEW'))
+    ap.add_argument('--threshold', type=float, default=REGRESSION_DEFAULT)
+    args = ap.parse_args(argv)
+    if args.compare:
+        with open(args.compare[0]) as f: old = json.load(f)
+        with open(args.compare[1]) as f: new = json.load(f)
+        rows = compare(old, new, args.threshold)
+        for (kind, size, name), a, b, ratio, bad in rows:
+            flag = ' REGRESSION' if bad else ''
+            print(
+                f'{kind:<9}{size:>11} {name:<18}'
+                f'{a:9.2f}{b:9.2f} MB/s {ratio:6.2f}x{flag}'
+            )
+        return 1 if any(r[-1] for r in rows) else 0
+    sizes = [parse_size(s) for s in args.sizes.split(',')]
+    res = bench(
+        sizes,
+        kinds=args.workloads.split(','),
+        names=args.benches.split(','),
+        rounds=args.rounds,
+        seed=args.seed,
+    )
+    for r in res:
+        print(
+            f"{r['workload']:<9}{r['size']:>11} {r['bench']:<18}"
+            f"{r['mb_s']:9.2f} MB/s{r['records_s']:12.0f} rec/s"
+            f"{r['peak_bytes']/1e6:9.2f} MB peak"
+        )
+    with open(args.out, 'w') as f:
+        out = {'meta': meta(args.seed, args.rounds), 'results': res}
+        json.dump(out, f, indent=1)
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,128 @@
+"""
+iMWLRDB: Internet Multi-line Width-Limited Record Database Format
+
+Synthetic workloads for benchmarks, modelled on the sample databases
+in demo.py. Workloads are generated from a seed, so that every run
+works on exactly the same data.
+
+"""
+#
+# Copyright 2023 Moses Chong
+#
+# Licensed under the terms and conditions of the
+# Apache License Version 2.0.
+#
+from datetime import datetime, timedelta, timezone
+from random import Random
+from demo import date_styles, emails_format
+from imwlrdb import imwlrdb, FORMAT_DEFAULT
+
+SEED = 20261226
+WORDS = (
+    'fridge', 'turkey', 'cognac', 'christmas', 'cake', 'warranty', 'claim',
+    'refund', 'python', 'gutter', 'pipe', 'anniversary', 'mum', 'dad',
+    'bruh', 'consumer', 'law', 'escalating', 'sincerely', 'regards',
+    'Grüße', 'café', '🐍', '☀️',
+)
+EPOCH = datetime(2026, 1, 1, tzinfo=timezone(timedelta(hours=11)))
+
+def words(rnd, n):
+    """Return a string of 'n' random words"""
+    return ' '.join(rnd.choice(WORDS) for _ in range(n))
+
+def contact(rnd, i):
+    """Return a random vCard contact, like demo.contact"""
+    return {
+        '__type': 'VCARD',
+        'VERSION': '4.0',
+        'KIND': 'individual',
+        'N': f'{words(rnd, 1)};{words(rnd, 1)};;',
+        'NICKNAME': f'{words(rnd, 1)}{i}',
+        'BDAY': f'{rnd.randint(1950, 2010)}{rnd.randint(1, 12):02}01',
+        'CATEGORIES': words(rnd, rnd.randint(1, 3)),
+        'EMAIL': f'user{i}@example.com',
+        'LANG': 'en-AU',
+        'NOTE': words(rnd, rnd.randint(2, 40)),
+        'TZ': 'Australia/Melbourne',
+    }
+
+def event(rnd, i):
+    """Return a random iCalendar event, like those in demo.calendar"""
+    day = (EPOCH + timedelta(days=rnd.randint(0, 365))).strftime('%Y%m%d')
+    return {
+        '__type': 'VEVENT',
+        'DTSTAMP': f'{day}T000000Z',
+        'DTSTART': {'VALUE': f'DATE:{day}'},
+        'DTEND': {'VALUE': f'DATE:{day}'},
+        'SUMMARY': words(rnd, rnd.randint(1, 6)),
+        'SEQUENCE': i,
+        'DESCRIPTION': words(rnd, rnd.randint(0, 30)),
+    }
+
+def email(rnd, i):
+    """Return a random email, like those in demo.emails"""
+    dt = EPOCH + timedelta(seconds=rnd.randint(0, 31536000))
+    ds = date_styles(dt)
+    lines = (words(rnd, rnd.randint(1, 12)) for _ in range(rnd.randint(1, 30)))
+    return {
+        '__header': ds['daemon'],
+        'From': f'Sender {i} <sender{i}@example.com>',
+        'To': '<support@example.com>',
+        'Subject': words(rnd, rnd.randint(2, 10)),
+        'Date': ds['RFC2822-Date'],
+        'Message-Id': ds['Message-ID'].replace('@', f'.{i}@'),
+        '': '\r\n'.join(('',) + tuple(lines)),
+        '__footer': '\r\n',
+    }
+
+def records(kind, size, seed=SEED):
+    """
+    Return a dict of a workload of roughly 'size' bytes when
+    serialised, containing:
+
+    * records: list of dicts to serialise as top-level records
+
+    * uids: list of the UIDs of the records, in the same order
+
+    * count: number of records, counting sub-records
+
+    * format: output format
+
+    * read_args: arguments to readers, other than the format
+
+    Kinds are 'contacts', 'calendar' and 'emails'. A calendar
+    workload is a single calendar record without a UID, containing
+    all events under their UIDs; contacts and emails each have a
+    UID, so that readers can look them up.
+
+    """
+    rnd = Random(seed)
+    make, fmt, read_args = {
+        'contacts': (contact, FORMAT_DEFAULT, {}),
+        'calendar': (event, FORMAT_DEFAULT, {'depth': 2}),
+        'emails': (
+            email, emails_format, {'header': 'From ', 'footer': '\r\n'}
+        ),
+    }[kind]
+    out = []
+    total = 0
+    while total < size:
+        x = make(rnd, len(out))
+        total += len(imwlrdb(x, out_format=fmt)) + 2
+        out.append(x)
+    count = len(out)
+    uids = [f'{i:040x}' for i in range(count)]
+    if kind == 'calendar':
+        cal = {
+            '__type': 'VCALENDAR',
+            'CALSCALE': 'GREGORIAN',
+            'PRODID': '-//iMWLRDB Benchmark//v0.1//EN',
+            'VERSION': '2.0',
+        }
+        cal.update(zip(uids, out))
+        out = [cal,]
+        uids = [None,]
+    return {
+        'records': out, 'uids': uids, 'count': count, 'format': fmt,
+        'read_args': read_args
+    }
@@ -0,0 +1,76 @@
+"""
+iMWLRDB: Internet Multi-line Width-Limited Record Database Format
+
+Line wrapping benchmark: bytes_with_breaks() versus the original
+split, join and strip method, on ASCII and emoji-heavy strings.
+
+Run with: python -m benchmarks.wrap
+
+"""
+#
+# Copyright 2023 Moses Chong
+#
+# Licensed under the terms and conditions of the
+# Apache License Version 2.0.
+#
+from timeit import repeat
+from imwlrdb import bytes_with_breaks, split_by_max_length
+
+WIDTH = 80
+EOL = '\r\n'
+SOL = '\x20\x20'
+SAMPLES = {
+    'ascii_short': 'SUMMARY:10th Anniversary',
+    'ascii_long': 'The long, long Python slithers up the long gutter pipe ' * 40,
+    'emoji_long': '🐍🐍🐍🐍🐍🐍🐍🐍🐍🐍🐍🐍🐍Tour de Python☀️' * 40,
+}
+
+def bytes_with_breaks_iter(s, L, eol, sol, encoding):
+    """
+    The original bytes_with_breaks_iter(), formerly in imwlrdb:
+    iterator yielding, byte-by-byte, a string 's' where sequence
+    'eol' occurs at least once every 'L' bytes.
+
+    For each 'eol' inserted into the string, follow up with start
+    of line sequence 'sol' once immediately after.
+
+    The line byte count includes 'sol'.
+
+    """
+    byeol = bytes(eol, encoding=encoding)
+    bysol = bytes(sol, encoding=encoding)
+    #len_bysol = len(bysol)
+    bstrs = iter(bytes(s, encoding=encoding).split(byeol))
+    for bst in bstrs:
+        lenbst = len(bst)
+        if lenbst <= L-len(byeol):
+            if bst.endswith(byeol):
+                yield b''.join((bst,))
+                continue
+            else:
+                yield b''.join((bst, byeol))
+                continue
+        for x in split_by_max_length(bst, L-len(eol), len(bysol)):
+            # TODO: Yield, not return....
+            yield b''.join((x, byeol, bysol))
+
+def bytes_with_breaks_legacy(s, L, eol, sol, encoding='utf8'):
+    """The original bytes_with_breaks()"""
+    if len(s) <= 0: return b''
+    out = b''.join(bytes_with_breaks_iter(s, L, eol, sol, encoding=encoding))
+    return out.rstrip(bytes(sol, encoding=encoding))
+
+def bench(number=2000, rounds=5):
+    """Return dict of best time per call in microseconds, per sample"""
+    out = {}
+    for name, s in SAMPLES.items():
+        for fn in (bytes_with_breaks, bytes_with_breaks_legacy):
+            t = min(repeat(
+                lambda: fn(s, WIDTH, EOL, SOL), number=number, repeat=rounds
+            ))
+            out[(name, fn.__name__)] = t / number * 1e6
+    return out
+
+if __name__ == '__main__':
+    for (name, fn), us in bench().items():
+        print(f'{name:<12} {fn:<26} {us:10.2f} us')
@@ -8,19 +8,35 @@ from datetime import datetime
 from zoneinfo import ZoneInfo
 from os import path
 #
-from imwlrdb import imwlrdb, bytes_with_breaks, FORMAT_DEFAULT
+from imwlrdb import (
+    bytes_with_breaks, index_path, MWLRIndex, MWLRWriter, FORMAT_DEFAULT
+)
 
-def mwlr_file(d, fpath, out_format=FORMAT_DEFAULT):
-    """Convert dict, str list or tuple to MWLR database and write to file"""
-    with open(path.expanduser(fpath), mode='wb') as f:
-        if type(d) in (list, tuple):
-            for x in d:
-                if type(x) is dict:
-                    f.write(imwlrdb(x, out_format=out_format))
-        elif type(d) is dict: f.write(imwlrdb(d, out_format=out_format))
+def mwlr_file(
+        d, fpath, out_format=FORMAT_DEFAULT, index_fields=None, jobs=1
+    ):
+    """
+    Convert dict, str list or tuple to MWLR database and write to file
+
+    If index_fields is set, a sidecar index of records is also saved,
+    including the values of the fields named in index_fields.
+
+    Records in lists and tuples are serialised over 'jobs' processes.
+
+    """
+    fpath = path.expanduser(fpath)
+    index = None
+    if index_fields is not None: index = MWLRIndex(index_fields)
+    with open(fpath, mode='wb') as f:
+        if type(d) in (list, tuple, dict):
+            with MWLRWriter(f, out_format=out_format, index=index) as w:
+                if type(d) is dict: w.write(d)
+                else:
+                    w.write_all((x for x in d if type(x) is dict), jobs)
         elif type(d) is str:
             f.write(bytes_with_breaks(d, 40, '\r\n', '\x20\x20'))
         else: raise TypeError('sorry, object is of an unsupported type')
+    if index is not None: index.save(index_path(fpath), fpath)
 
 def date_styles(dt):
     """Return dict of a datetime in different formats"""
@@ -161,7 +177,41 @@ calendar = {
     } # may be different in your country
 }
 
-# TODO: Four-level database for a hypothetical app
+# Four-level database for a hypothetical note-taking app
+# Notebooks contain sections, which contain pages, which may have
+# attachments; each level is a sub-record of the one above
+#
+notebook = {
+    '__type': 'NOTEBOOK',
+    'TITLE': 'Household',
+    'OWNER': 'Coco Bunny',
+    '5b3f2c7e0a914d6e8f1b2c3d4e5f60718293a4b5': {
+        '__type': 'SECTION',
+        'TITLE': 'Appliances',
+        '9c1d2e3f40516273849a5b6c7d8e9f0a1b2c3d4e': {
+            '__type': 'PAGE',
+            'TITLE': 'Fridge',
+            'MODIFIED': '20261227T093000Z',
+            'TEXT': 'turkey goes on the bottom shelf\\ncognac goes in the door',
+            'a0b1c2d3e4f5061728394a5b6c7d8e9fa0b1c2d3': {
+                '__type': 'ATTACHMENT',
+                'FILENAME': 'warranty.pdf',
+                'MEDIA-TYPE': 'application/pdf',
+                'SIZE': 182044,
+            },
+        },
+        'e4d3c2b1a0f9e8d7c6b5a4938271605f4e3d2c1b': {
+            '__type': 'PAGE',
+            'TITLE': 'Oven',
+            'MODIFIED': '20261224T170000Z',
+            'TEXT': 'preheat to 180 degrees, not 180 kelvin',
+        },
+    },
+    '0f1e2d3c4b5a69788796a5b4c3d2e1f00f1e2d3c': {
+        '__type': 'SECTION',
+        'TITLE': 'Garden',
+    },
+}
 
 # Demonstration of octet-limited width, as opposed to char-limited width
 long_string_a = "The long, long Python slithers up the long, long gutter pipe"
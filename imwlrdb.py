@@ -6,9 +6,7 @@ after the data formats used by iCalendar, Email, vCard and Usenet.
 MWLR attempts to be a generalisation of these formats.
 
 This module contains several functions to map a Python dict to onto
-an MWLR database file. Currently, only data export functions are
-available; database readers to map, or at least deserialise these
-files back into dicts will be added at a later date...
+an MWLR database file, and to read such files back into dicts.
 
 For more information on the format specifications, please check
 https://github.com/mounaiban/iMWLRDB/SPECS.rst.
@@ -29,8 +27,36 @@ https://github.com/mounaiban/iMWLRDB/SPECS.rst.
 # See the License for the specific language governing permissions and
 # limitations under the License.
 #
+from argparse import ArgumentParser
+from array import array
+from bisect import bisect_left, bisect_right, insort
+from codecs import lookup
+from collections import OrderedDict, deque
+from collections.abc import Mapping
+from concurrent.futures import (
+    FIRST_COMPLETED, ProcessPoolExecutor, wait
+)
+from contextlib import ExitStack
+from io import BytesIO, DEFAULT_BUFFER_SIZE, TextIOWrapper
 from itertools import chain, count, islice, repeat, zip_longest
+from operator import contains, eq, ge, gt, le, lt
+from hashlib import blake2b
 from secrets import token_hex
+from time import perf_counter
+from weakref import WeakSet
+import asyncio
+import json
+import mmap
+import os
+import pickle
+import re
+import struct
+import sys
+import zlib
+try:
+    import lzma
+except ImportError:
+    lzma = None # Python built without LZMA support
 
 BEGIN_MARK = 'BEGIN'
 EOL_DEFAULT = '\r\n' # End of Line
@@ -40,10 +66,30 @@ FSEP_DEFAULT = ':' # Field Separator
 FMSEP_DEFAULT = ';' # Field Separator (multi-value fields)
 VSEP_DEFAULT = '=' # Field Separator (sub-fields in multi-value fields)
 SFSEP_DEFAULT = ';' # Sub-field Separator
+ESCAPE_DEFAULT = '\\' # Escape character (multi-value fields)
+NEST_OPEN = '{' # Start of nested dict (multi-value fields)
+NEST_CLOSE = '}' # End of nested dict (multi-value fields)
 CONFIG_KEY_PREFIX = '__'
 UID_KEY = 'UID'
+INDEX_ENCODING = 'utf8'
+INDEX_MAGIC = b'MWLRIDX\x01'
+INDEX_NONE_LEN = 0xFFFFFFFF # length of absent strings in index files
+INDEX_SAMPLE_BYTES = 65536 # bytes from each end of file to checksum
+INDEX_SUFFIX = '.idx'
+STATS_COUNTERS = ('records', 'fields', 'lines', 'bytes', 'wraps', 'seconds')
+EXPORT_CHUNK_RECORDS = 256
+PARSE_CHUNK_BYTES = 1048576 # bytes per chunk when parsing in parallel
+TEMPLATES_MAX_KEYS = 65536 # field names in templates cached per Format
+TEMPLATE_SUB = object() # stands in for sub-record names in templates
+STORE_COMPACT_RATIO = 0.25 # dead space to file size ratio for compaction
+SERIALISE_CACHE_BYTES = 16777216 # serialised bytes kept by SerialiseCache
+WRITER_BUFFER_BYTES = 65536
+BLOCK_BYTES = 262144 # uncompressed bytes per block in block containers
+BLOCK_CODECS = ('zlib', 'lzma') # by codec number in block containers
+BLOCK_MAGIC = b'MWLRBLK\x01'
 ###
 FORMAT_DEFAULT = {
+    'escape': ESCAPE_DEFAULT,
     'fsep': FSEP_DEFAULT,
     'fmsep': FMSEP_DEFAULT,
     'eol': EOL_DEFAULT,
@@ -53,28 +99,267 @@ FORMAT_DEFAULT = {
     'vsep': VSEP_DEFAULT,
     'width_bytes': 80,
 }
+DEAD_TYPE = ''.join((CONFIG_KEY_PREFIX, 'dead'))
 FOOTER_KEY = ''.join((CONFIG_KEY_PREFIX, 'footer'))
 HEADER_KEY = ''.join((CONFIG_KEY_PREFIX, 'header'))
+PAD_KEY = ''.join((CONFIG_KEY_PREFIX, 'pad'))
+PARENT_KEY = ''.join((CONFIG_KEY_PREFIX, 'parent'))
+REMOVED_TYPE = ''.join((CONFIG_KEY_PREFIX, 'removed'))
 TYPE_KEY = ''.join((CONFIG_KEY_PREFIX, 'type'))
+QUERY_OPS = {
+    '==': eq,
+    '<': lt,
+    '<=': le,
+    '>': gt,
+    '>=': ge,
+    'contains': contains,
+    'startswith': str.startswith,
+}
+MV_CODECS = {} # compiled by multi_val_codec()
 WORDS_RESERVED = (
-    '', BEGIN_MARK, END_MARK, FOOTER_KEY, HEADER_KEY, TYPE_KEY, UID_KEY
+    '', BEGIN_MARK, END_MARK, DEAD_TYPE, FOOTER_KEY, HEADER_KEY, PAD_KEY,
+    PARENT_KEY, REMOVED_TYPE, TYPE_KEY, UID_KEY
 )
 
+def is_utf8(encoding):
+    """Return True if 'encoding' is a name of UTF-8"""
+    return lookup(encoding).name == 'utf-8'
+
+class Format:
+    """
+    Format specification compiled for use with a given encoding.
+
+    Separators are kept both as strings and pre-encoded bytes, along
+    with the newline translation table and the width limit, so that
+    they are worked out once, instead of every time a line is written.
+
+    Format objects are accepted anywhere a format dict is. When a
+    Format is used, its own encoding takes precedence over any
+    encoding argument.
+
+    Formats also keep a cache of record templates, so that records
+    with the same fields share pre-encoded field name prefixes; see
+    template().
+
+    Arguments
+    ---------
+    * spec: dict containing format specification of the database
+       file; missing items are taken from FORMAT_DEFAULT
+
+    * encoding: encoding of the database file when read as text
+
+    """
+    __slots__ = (
+        'spec', 'encoding', 'eol', 'sol', 'fsep', 'fmsep', 'sfsep',
+        'vsep', 'escape', 'newline', 'width', 'tdict', 'byeol', 'bysol',
+        'byfsep', 'byfmsep', 'utf8', 'templates', 'template_keys',
+    )
+
+    def __init__(self, spec=FORMAT_DEFAULT, encoding=ENCODING_DEFAULT):
+        fmt = lambda k: spec.get(k, FORMAT_DEFAULT[k])
+        enc = lambda s: bytes(s, encoding=encoding)
+        self.spec = dict(spec)
+        self.encoding = encoding
+        self.eol = fmt('eol')
+        self.sol = fmt('sol')
+        self.fsep = fmt('fsep')
+        self.fmsep = fmt('fmsep')
+        self.sfsep = fmt('sfsep')
+        self.vsep = fmt('vsep')
+        self.escape = fmt('escape')
+        self.newline = spec.get('newline') # no translation if absent
+        self.width = fmt('width_bytes')
+        self.tdict = {}
+        if 'newline' in spec: self.tdict = str.maketrans({'\n': self.newline})
+        self.byeol = enc(self.eol)
+        self.bysol = enc(self.sol)
+        self.byfsep = enc(self.fsep)
+        self.byfmsep = enc(self.fmsep)
+        self.utf8 = is_utf8(encoding)
+        self.templates = {}
+        self.template_keys = 0 # field names in cached templates
+
+    def template(self, keys):
+        """
+        Return the template for records with field names 'keys', as a
+        tuple of (name, name and FSEP, name and FMSEP) for every name
+        written as a field, the last two in bytes. Reserved names and
+        names that are not strings are left out.
+
+        If 'keys' is a record, its sub-records are stood in for by
+        (None, position of the sub-record in the record, None), so
+        that the UIDs of sub-records, which seldom repeat, are not
+        part of the template.
+
+        Templates are cached by field names and their order, so that
+        records of the same schema are worked out only once. Passing
+        the names of a schema ahead of time has the same effect. The
+        cache is cleared when it would hold over TEMPLATES_MAX_KEYS
+        names in all.
+
+        """
+        if type(keys) is dict or isinstance(keys, Mapping):
+            keys = tuple([
+                TEMPLATE_SUB if type(v) is dict and TYPE_KEY in v else k
+                for k, v in keys.items()
+            ])
+        else:
+            keys = tuple(keys)
+        t = self.templates.get(keys)
+        if t is not None: return t
+        enc = lambda s: bytes(s, encoding=self.encoding)
+        t = tuple(
+            (None, i, None) if k is TEMPLATE_SUB
+            else (
+                k, enc(''.join((k, self.fsep))),
+                enc(''.join((k, self.fmsep)))
+            )
+            for i, k in enumerate(keys)
+            if k is TEMPLATE_SUB or (
+                (type(k) is str)
+                and k not in WORDS_RESERVED
+                and k.upper() not in WORDS_RESERVED
+            )
+        )
+        if len(keys) > TEMPLATES_MAX_KEYS: return t
+        if self.template_keys + len(keys) > TEMPLATES_MAX_KEYS:
+            self.templates.clear()
+            self.template_keys = 0
+        self.templates[keys] = t
+        self.template_keys += len(keys)
+        return t
+
+    def __repr__(self):
+        return f'Format({self.spec!r}, {self.encoding!r})'
+
+    def __getstate__(self):
+        return (self.spec, self.encoding)
+
+    def __setstate__(self, state):
+        self.__init__(*state)
+
+FORMAT_DEFAULT_COMPILED = Format()
+
+def as_format(fmt, encoding=ENCODING_DEFAULT):
+    """
+    Return format specification 'fmt' as a Format. Formats are
+    returned as-is, while dicts are compiled for 'encoding'.
+
+    """
+    if type(fmt) is Format: return fmt
+    if fmt is FORMAT_DEFAULT and encoding == ENCODING_DEFAULT:
+        return FORMAT_DEFAULT_COMPILED
+    return Format(fmt, encoding)
+
+def multi_val_codec(sep_f=VSEP_DEFAULT, sep_r=FMSEP_DEFAULT, escape=None):
+    """
+    Return compiled patterns for multi-value fields with separators
+    'sep_f' and 'sep_r' and escape character 'escape', as a tuple of
+    (specials, substitution for escaping specials, tokenizer).
+
+    The tokenizer matches escaped specials, field-value separators,
+    item separators, NEST_OPEN, NEST_CLOSE and runs of other text,
+    in groups one to six respectively. Patterns are compiled once
+    for every combination of arguments.
+
+    Arguments
+    ---------
+    * sep_f: field-value separator
+
+    * sep_r: dict item separator
+
+    * escape: escape character
+
+    """
+    key = (sep_f, sep_r, escape)
+    codec = MV_CODECS.get(key)
+    if codec is not None: return codec
+    specials = sorted(
+        {escape, sep_f, sep_r, NEST_OPEN, NEST_CLOSE}, key=len, reverse=True
+    )
+    alt = '|'.join(re.escape(x) for x in specials)
+    firsts = re.escape(''.join({x[0] for x in specials}))
+    codec = MV_CODECS[key] = (
+        re.compile(alt),
+        ''.join((escape.replace('\\', '\\\\'), r'\g<0>')),
+        re.compile(
+            f'({re.escape(escape)}(?:{alt}))|({re.escape(sep_f)})'
+            f'|({re.escape(sep_r)})|({re.escape(NEST_OPEN)})'
+            f'|({re.escape(NEST_CLOSE)})|([^{firsts}]+|.)',
+            re.DOTALL
+        ),
+    )
+    return codec
+
 def multi_val_str(
         d,
         sep_f=VSEP_DEFAULT,
         sep_r=FMSEP_DEFAULT,
-        encoding=ENCODING_DEFAULT
+        encoding=ENCODING_DEFAULT,
+        escape=ESCAPE_DEFAULT,
     ):
     """
     Return a string containing keys and values of a dict,
     in serialised form.
 
-    By default, the dict {'alfa': 1, 'bravo': 20} becomes
-    "alfa=1;bravo=20"
+    By default, the dict {'alfa': 1, 'bravo': {'charlie': 'x;y'}}
+    becomes "alfa=1;bravo={charlie=x\\;y}"
+
+    Separators, escape characters, NEST_OPEN and NEST_CLOSE in keys
+    and values are preceded by the escape character, and dict values
+    are nested between NEST_OPEN and NEST_CLOSE. Other keys and
+    values are written as strings.
+
+    Arguments
+    ---------
+    * sep_f: field-value separator
+
+    * sep_r: dict item separator
+
+    * escape: escape character; if empty or None, nothing is escaped
+       and dict values are written as strings, as they were in
+       earlier versions
+
+    """
+    if not escape:
+        return sep_r.join([f'{k}{sep_f}{v}' for k, v in d.items()])
+    specials, rep, _ = multi_val_codec(sep_f, sep_r, escape)
+    if specials.search(''.join([f'{k}{v}' for k, v in d.items()])) is None:
+        # nothing to escape or nest (dicts as strings contain NEST_OPEN)
+        return sep_r.join([f'{k}{sep_f}{v}' for k, v in d.items()])
+    sub = specials.sub
+    items = []
+    for k, v in d.items():
+        if type(v) is dict:
+            v = ''.join((
+                NEST_OPEN,
+                multi_val_str(v, sep_f, sep_r, encoding, escape),
+                NEST_CLOSE,
+            ))
+        else:
+            v = sub(rep, v if type(v) is str else str(v))
+        items.append(
+            ''.join((sub(rep, k if type(k) is str else str(k)), sep_f, v))
+        )
+    return sep_r.join(items)
+
+def multi_val_dict(
+        s, sep_f=VSEP_DEFAULT, sep_r=FMSEP_DEFAULT, escape=ESCAPE_DEFAULT
+    ):
+    """
+    Return a dict of the keys and values in a string 's' serialised
+    by multi_val_str(); all values are returned as strings, except
+    for nested dicts.
+
+    By default, the string "alfa=1;bravo={charlie=x\\;y}" becomes
+    {'alfa': '1', 'bravo': {'charlie': 'x;y'}}
 
-    Currently, only numeric and string keys and values are
-    properly supported; dicts work somewhat acceptably.
+    Escape characters not followed by a separator, escape character,
+    NEST_OPEN or NEST_CLOSE are kept as they are, and strings with
+    unbalanced nesting are split as if they had none. Values written
+    by versions before escaping and nesting were added, which contain
+    balanced braces or escaped specials, read back differently unless
+    'escape' is empty.
 
     Arguments
     ---------
@@ -82,12 +367,60 @@ def multi_val_str(
 
     * sep_r: dict item separator
 
+    * escape: escape character; if empty or None, separators are
+       never escaped and nested dicts are not recognised
+
     """
-    # TODO: Handle nested dicts
-    keys = d.keys()
-    vals = d.values()
-    pairs = zip((f'{k}{sep_f}' for k in keys), (f'{v}{sep_r}' for v in vals))
-    return ''.join(chain.from_iterable(pairs))[:-len(sep_r)]
+    if not escape or (escape not in s and NEST_OPEN not in s):
+        pairs = (x.partition(sep_f) for x in s.split(sep_r))
+        return {k: v for k, _, v in pairs}
+    tokens = multi_val_codec(sep_f, sep_r, escape)[2]
+    nesc = len(escape)
+    stack = []
+    d = {}
+    key = None # None while reading a key
+    buf = []
+    done = False # True after a nested dict, until the next item
+    for m in tokens.finditer(s):
+        i = m.lastindex
+        if i == 1:
+            buf.append(m.group(1)[nesc:])
+        elif i == 2:
+            if key is None and not done:
+                key = ''.join(buf)
+                buf = []
+            else:
+                buf.append(sep_f)
+        elif i == 3:
+            if not done:
+                if key is None: d[''.join(buf)] = ''
+                else: d[key] = ''.join(buf)
+            key = None
+            buf = []
+            done = False
+        elif i == 4 and key is not None and not buf and not done:
+            stack.append((d, key))
+            d = {}
+            key = None
+        elif i == 5 and stack:
+            if not done and (key is not None or buf):
+                if key is None: d[''.join(buf)] = ''
+                else: d[key] = ''.join(buf)
+            inner = d
+            d, key = stack.pop()
+            d[key] = inner
+            key = None
+            buf = []
+            done = True
+        else:
+            buf.append(m.group(i))
+    if stack:
+        # unbalanced nesting: not written by multi_val_str()
+        return multi_val_dict(s, sep_f, sep_r, None)
+    if not done:
+        if key is None: d[''.join(buf)] = ''
+        else: d[key] = ''.join(buf)
+    return d
 
 def split_by_max_length(s, L, Lsol=0):
     """
@@ -105,58 +438,228 @@ def split_by_max_length(s, L, Lsol=0):
     slices = zip_longest(starts, stops, fillvalue=lens)
     return (s[x:y] for x,y in slices)
 
-def bytes_with_breaks_iter(s, L, eol, sol, encoding):
+def bytes_with_breaks(s, L, eol, sol, encoding=ENCODING_DEFAULT):
     """
-    Iterator yielding, byte-by-byte, a string 's' where sequence
-    'eol' occurs at least once every 'L' bytes.
+    Return a bytes version of a string 's' as a bytearray with
+    line break 'eol' followed by a line start 'sol' every 'L' bytes
 
-    For each 'eol' inserted into the string, follow up with start
-    of line sequence 'sol' once immediately after.
+    The line byte count includes the line start sequence 'sol'.
+    In UTF-8, lines are only broken between characters.
 
-    The line byte count includes 'sol'.
+    """
+    return wrap_bytes(
+        bytes(s, encoding=encoding), L,
+        bytes(eol, encoding=encoding), bytes(sol, encoding=encoding),
+        utf8=is_utf8(encoding)
+    )
 
+def wrap_bytes(b, L, byeol, bysol, utf8=True):
     """
-    byeol = bytes(eol, encoding=encoding)
-    bysol = bytes(sol, encoding=encoding)
-    #len_bysol = len(bysol)
-    bstrs = iter(bytes(s, encoding=encoding).split(byeol))
-    for bst in bstrs:
-        lenbst = len(bst)
-        if lenbst <= L-len(byeol):
-            if bst.endswith(byeol):
-                yield b''.join((bst,))
-                continue
-            else:
-                yield b''.join((bst, byeol))
-                continue
-        for x in split_by_max_length(bst, L-len(eol), len(bysol)):
-            # TODO: Yield, not return....
-            yield b''.join((x, byeol, bysol))
+    Return bytes 'b' with line break 'byeol' followed by a line start
+    'bysol' every 'L' bytes; this is bytes_with_breaks() for strings
+    that have already been encoded.
+
+    Lines are worked out in a single pass, and joined in one go
+    at the end. If 'utf8' is True, lines are never broken in the
+    middle of a multi-byte character, and may come up short of 'L'
+    bytes as a result; a single character wider than a line is
+    kept whole.
+
+    Output is the same as from the original split, join and strip
+    method (see benchmarks/wrap.py), trailing spaces included, except
+    that lines after a 'byeol' already in 'b' no longer begin with
+    'bysol' when the line before them was broken up.
 
-def bytes_with_breaks(s, L, eol, sol, encoding=ENCODING_DEFAULT):
     """
-    Return a bytes version of a string 's' as a bytearray with
-    line break 'eol' followed by a line start 'sol' every 'L' bytes
+    lenb = len(b)
+    if not lenb: return b''
+    leneol = len(byeol)
+    first = L - leneol # room for content on the first line
+    if lenb <= first and byeol not in b: return b''.join((b, byeol))
+    rest = first - len(bysol) # room on continuing lines
+    out = []
+    push = out.append
+    i = 0
+    while True:
+        j = b.find(byeol, i)
+        if j < 0: j = lenb
+        room = first
+        while j - i > room:
+            if room < 1: raise ValueError(f'width {L} too small for lines')
+            c = i + room
+            if utf8:
+                # 0b10xxxxxx: UTF-8 continuation byte
+                while c > i and b[c] & 0xC0 == 0x80: c -= 1
+                if c == i:
+                    c = i + room
+                    while c < j and b[c] & 0xC0 == 0x80: c += 1
+            push(b[i:c])
+            push(byeol)
+            push(bysol)
+            i = c
+            room = rest
+        push(b[i:j])
+        push(byeol)
+        if j >= lenb: break
+        i = j + leneol
+    return b''.join(out)
 
-    The line byte count includes the line start sequence 'sol'.
+class SerialiseStats:
+    """
+    Counters of serialised records by record type, for finding out
+    where export time goes. Pass to imlwldb_iter(), imwlrdb() or
+    MWLRWriter as 'stats'; nothing is counted when it is not passed.
+
+    Counters are kept in 'types', a dict of dicts by record type
+    (None for untyped records), each with the following counts:
+
+    * records: number of records
+
+    * fields: number of fields, including multi-value fields
+
+    * lines: number of lines, including continuation lines
+
+    * bytes: number of bytes, including EOLs
+
+    * wraps: number of continuation lines from wrapping fields
+
+    * seconds: time spent serialising
+
+    Sub-records are counted under their own type, and are not counted
+    towards the records that contain them.
+
+    Arguments
+    ---------
+    * callback: function called after every record with the type and
+       a dict of counts for that record, for sending counts elsewhere
+
+    """
+    def __init__(self, callback=None):
+        self.callback = callback
+        self.types = {}
+
+    def add(self, rtype, counts):
+        """Add a dict of 'counts' to the counters for type 'rtype'"""
+        c = self.types.get(rtype)
+        if c is None:
+            c = self.types[rtype] = dict.fromkeys(STATS_COUNTERS, 0)
+        for k, v in counts.items(): c[k] += v
+        if self.callback: self.callback(rtype, counts)
+
+    def total(self):
+        """Return a dict of counts for all record types"""
+        out = dict.fromkeys(STATS_COUNTERS, 0)
+        for c in self.types.values():
+            for k, v in c.items(): out[k] += v
+        return out
+
+    def reset(self):
+        """Set all counters back to zero"""
+        self.types.clear()
+
+class SerialiseCache:
+    """
+    Cache of serialised sub-records, for exporting the same records
+    over and over again, such as when only a few sub-records change
+    between exports. Pass to imlwldb_iter(), imwlrdb() or MWLRWriter
+    as 'cache'.
+
+    Sub-records are looked up by a hash of the sub-record with its
+    sub-records, its UID, the format and the fields of the index it is
+    added to, so that a sub-record that has changed in any way is
+    serialised again. Hashes are taken of the pickled sub-record, so
+    sub-records that cannot be pickled are never cached.
+
+    The least recently used sub-records are dropped once more than
+    'max_bytes' of serialised bytes are cached.
+
+    Arguments
+    ---------
+    * max_bytes: number of serialised bytes to keep
 
     """
-    if len(s) <= 0: return b''
-    out = b''.join(bytes_with_breaks_iter(s, L, eol, sol, encoding=encoding))
-        # TODO: b''.join doesn't work here...
-    return out.rstrip(bytes(sol, encoding=encoding))
+    def __init__(self, max_bytes=SERIALISE_CACHE_BYTES):
+        self.max_bytes = max_bytes
+        self.size = 0 # serialised bytes cached
+        self.hits = 0
+        self.misses = 0
+        self._items = OrderedDict() # key: (bytes, index entries)
+
+    def __len__(self):
+        return len(self._items)
+
+    def key(self, d, uid, fmt, fields=None):
+        """
+        Return the key of sub-record 'd' with UID 'uid', serialised in
+        Format 'fmt' and indexed with 'fields', or None if it cannot be
+        pickled
+
+        """
+        try:
+            b = pickle.dumps(
+                (fmt.encoding, fmt.spec, fields, uid, d),
+                pickle.HIGHEST_PROTOCOL
+            )
+        except (pickle.PicklingError, TypeError, AttributeError):
+            return None
+        return blake2b(b, digest_size=16).digest()
+
+    def get(self, key):
+        """
+        Return the serialised bytes and index entries under 'key', or
+        None if they are not cached
+
+        """
+        x = self._items.get(key)
+        if x is None:
+            self.misses += 1
+            return None
+        self._items.move_to_end(key)
+        self.hits += 1
+        return x
+
+    def put(self, key, b, entries=()):
+        """
+        Cache serialised bytes 'b' and index entries 'entries' under
+        'key', dropping the least recently used items to make room
+
+        """
+        if len(b) > self.max_bytes: return
+        old = self._items.pop(key, None)
+        if old is not None: self.size -= len(old[0])
+        self._items[key] = (b, tuple(entries))
+        self.size += len(b)
+        while self.size > self.max_bytes:
+            _, (x, _) = self._items.popitem(last=False)
+            self.size -= len(x)
+
+    def clear(self):
+        """Drop all cached items"""
+        self._items.clear()
+        self.size = 0
 
 def imlwldb_iter(
         d,
         uid=None,
         encoding=ENCODING_DEFAULT,
         out_format=FORMAT_DEFAULT,
-        need_type=False
+        need_type=False,
+        index=None,
+        offset=0,
+        stats=None,
+        cache=None
     ):
     """
     Iterator yielding bytes of an MLWL database file representation of
     dict 'd'.
 
+    Sub-records are serialised from a stack of records being written
+    rather than by recursion, so that records may be nested to any
+    depth, and are all written in the same format.
+
+    Output is yielded in pieces, one for each sub-record, and one for
+    each run of lines between sub-records.
+
     Arguments
     ---------
     * d: dict
@@ -165,91 +668,266 @@ def imlwldb_iter(
 
     * encoding: encoding of the database file when read as text
 
-    * out_format: dict containing format specification of the
-       database file
+    * out_format: dict or Format containing format specification
+       of the database file
+
+    * need_type: determines if the __type field is mandatory, as it
+       is for sub-records
 
-    * need_type: determines if the __type field is mandatory;
-       intended for use only during recursion when serialising
-       nested dicts.
+    * index: MWLRIndex to add records to while they are written;
+       only records with a type, or a header and footer are added
+
+    * offset: position in the file where output begins, used to
+       work out offsets for 'index'
+
+    * stats: SerialiseStats to count records in
+
+    * cache: SerialiseCache of serialised sub-records, to look up
+       sub-records in before serialising them; not used when 'stats'
+       is set, so that only records actually serialised are counted
 
     """
     # TODO: Document specs for out_format
-    # TODO: Move function calls from iter inner loop to outer loop
-    eol = out_format.get('eol', FORMAT_DEFAULT['eol'])
-    sol = out_format.get('sol', FORMAT_DEFAULT['sol'])
-    fsep = out_format.get('fsep', FORMAT_DEFAULT['fsep'])
-    fmsep = out_format.get('fmsep', FORMAT_DEFAULT['fmsep'])
-    width = out_format.get('width_bytes', FORMAT_DEFAULT['width_bytes'])
-
-    def mktdict(fd):
-        if 'newline' in fd:
-            return str.maketrans({'\n': out_format['newline']})
-        else: return {}
-
-    tdict = mktdict(out_format)
-    keys = (
-        key for key in d.keys()
-        if (type(key) is str)
-        and key.upper() not in WORDS_RESERVED
-    )
-    footer = d.get(FOOTER_KEY)
-    header = d.get(HEADER_KEY) # TODO: test
-    if (footer and not header) or (not footer and header):
-        raise ValueError('both header and footer must be absent or present')
-    rtype = d.get(TYPE_KEY)
-    if need_type and not rtype:
-        raise ValueError('sub-records must have a type')
-    # Record start
-    if header:
-        yield bytes_with_breaks(header, width, eol, sol, encoding)
-    elif rtype and not (header or footer):
-        yield bytes_with_breaks(
-            ''.join((BEGIN_MARK, fsep, rtype,)),
-            width, eol, sol, encoding=encoding
-        )
-    if uid:
-        yield bytes_with_breaks(''.join((UID_KEY, fsep, uid)),
-        width, eol, sol, encoding=encoding
-    )
-    # Fields
-    for k in keys:
-        if k in WORDS_RESERVED: continue
-        obj = d.get(k)
-        if type(obj) is dict:
-            if '__type' in obj:
+    fmt = as_format(out_format, encoding)
+    encoding = fmt.encoding
+    width = fmt.width
+    byeol = fmt.byeol
+    bysol = fmt.bysol
+    fsep = fmt.fsep
+    vsep = fmt.vsep
+    sfsep = fmt.sfsep
+    escape = fmt.escape
+    newline = fmt.newline
+    utf8 = fmt.utf8
+    room = width - len(byeol) # room for content on a line of its own
+    bycont = byeol + bysol
+    # Lines are gathered in 'out', and yielded in one piece before each
+    # sub-record and at the end of each record. Lines that fit within
+    # the width are added as they are; only longer lines are wrapped.
+    out = []
+    push = out.append
+    pos = offset
+    stack = [] # frames of records being written, innermost last
+    # Running counts for 'stats'; the counts of a record are worked out
+    # from the difference between its start and end, less those of its
+    # sub-records. Time spent outside the iterator is not counted.
+    nf = nl = nw = 0 # fields, lines and wraps
+    t_busy = 0.0
+    t0 = perf_counter() if stats is not None else 0.0
+    # Output of sub-records missing from 'cache' is kept in 'captured'
+    # while any of them are being written, to be cached at their end
+    if stats is not None: cache = None
+    fields = None if index is None else index.fields
+    captured = []
+    ncap = 0 # sub-records being captured
+
+    def put(s, head=b''):
+        # Add a line of bytes 'head' followed by str 's', wrapping the
+        # line only if it is too long
+        nonlocal nl, nw
+        b = bytes(s, encoding)
+        if len(head) + len(b) <= room and byeol not in b:
+            if head: push(head)
+            push(b)
+            push(byeol)
+            nl += 1
+        else:
+            if head: b = b''.join((head, b))
+            x = wrap_bytes(b, width, byeol, bysol, utf8)
+            push(x)
+            nl += x.count(byeol)
+            if bysol: nw += x.count(bycont)
+
+    def counts():
+        return [pos, nf, nl, nw, t_busy + perf_counter() - t0]
+
+    def begin_cached(d, uid):
+        # Write sub-record 'd' from the cache, or begin it as usual,
+        # capturing its output if it is missing
+        nonlocal ncap
+        key = cache.key(d, uid, fmt, fields)
+        hit = None if key is None else cache.get(key)
+        if hit is None:
+            begin(d, uid, True)
+            if key is not None:
+                stack[-1]['cache'] = (key, len(captured), pos)
+                ncap += 1
+            return
+        b, entries = hit
+        push(b)
+        for uid, rtype, a, z, vals in entries:
+            index.add(uid, rtype, pos + a, pos + z, dict(zip(fields, vals)))
+
+    def begin(d, uid, need_type):
+        # Write the start of record 'd', and add its frame to the stack
+        footer = d.get(FOOTER_KEY)
+        header = d.get(HEADER_KEY) # TODO: test
+        if (footer and not header) or (not footer and header):
+            raise ValueError(
+                'both header and footer must be absent or present'
+            )
+        rtype = d.get(TYPE_KEY)
+        if need_type and not rtype:
+            raise ValueError('sub-records must have a type')
+        if rtype == DEAD_TYPE:
+            raise ValueError(f'{DEAD_TYPE} is a reserved record type')
+        parent = None if stack else d.get(PARENT_KEY)
+        fr = {
+            'rec': d,
+            'type': rtype,
+            'header': header,
+            'footer': footer,
+            'keys': iter(fmt.template(d)),
+            'names': None, # field names by position, for sub-records
+            'index': None,
+        }
+        if index is not None and (header or rtype):
+            vals = {
+                k: str(d[k]) for k in index.fields
+                if k in d and type(d[k]) is not dict
+            }
+            rt = None if header else rtype
+            fr['index'] = index.add(uid, rt, pos, values=vals)
+        if stats is not None:
+            fr['start'] = counts()
+            fr['sub'] = [0] * len(fr['start'])
+        stack.append(fr)
+        # Record start
+        if header:
+            put(header)
+        elif rtype:
+            put(''.join((BEGIN_MARK, fsep, rtype,)))
+        if uid:
+            put(''.join((UID_KEY, fsep, uid)))
+        if parent is not None:
+            # only top-level records, as in deltas, have a parent field
+            put(''.join((PARENT_KEY, fsep, str(parent))))
+
+    def end(fr):
+        # Finish the record of frame 'fr' after its output is yielded
+        nonlocal ncap
+        stack.pop()
+        i = fr['index']
+        if i is not None: index.set_end(i, pos - len(byeol))
+        if 'cache' in fr:
+            key, j, start = fr['cache']
+            entries = []
+            if i is not None:
+                for k in range(i, len(index.records)):
+                    uid, rtype, a, z = index.records[k]
+                    entries.append((
+                        uid, rtype, a - start, z - start,
+                        index.record_values[k]
+                    ))
+            cache.put(key, b''.join(captured[j:]), entries)
+            ncap -= 1
+            if not ncap: captured.clear()
+        if stats is None: return
+        incl = [b - a for a, b in zip(fr['start'], counts())]
+        if stack:
+            sub = stack[-1]['sub']
+            for j, x in enumerate(incl): sub[j] += x
+        own = [a - b for a, b in zip(incl, fr['sub'])]
+        stats.add(fr['type'], {
+            'records': 1,
+            'fields': own[1],
+            'lines': own[2],
+            'bytes': own[0],
+            'wraps': own[3],
+            'seconds': own[4],
+        })
+
+    begin(d, uid, need_type)
+    while stack:
+        fr = stack[-1]
+        d = fr['rec']
+        sub = None
+        # Fields
+        for k, byk, bykm in fr['keys']:
+            if k is None:
                 # sub record with BEGIN, END and discrete fields
-                for x in imlwldb_iter(d[k], uid=k, need_type=True): yield x
-            else:
+                if fr['names'] is None: fr['names'] = list(d)
+                sub = fr['names'][byk]
+                break
+            obj = d[k]
+            if type(obj) is dict:
                 # multi-part record:
                 # just multiple values crammed into a single field
-                mval = multi_val_str(obj)
-                yield bytes_with_breaks(
-                    ''.join((k, fmsep, mval)),
-                    width, eol, sol, encoding=encoding
-                )
+                put(multi_val_str(obj, vsep, sfsep, escape=escape), bykm)
+            else:
+                # normal values
+                v = obj if type(obj) is str else str(obj)
+                if newline is not None and '\n' in v:
+                    v = v.replace('\n', newline)
+                put(v, byk)
+            nf += 1
         else:
-            # normal values
-            lin: str
-            if not k: lin = str(obj).translate(tdict)
-            else: lin = ''.join((k, fsep, str(obj).translate(tdict)))
-            yield bytes_with_breaks(lin, width, eol, sol, encoding=encoding)
-
-    # Freeform body area
-    if '' in d:
-        yield bytes_with_breaks(
-            str(d.get('')), width, eol, '', encoding=encoding
-        )
+            # Freeform body area
+            if '' in d:
+                x = wrap_bytes(
+                    bytes(str(d['']), encoding=encoding), width, byeol, b'',
+                    utf8
+                )
+                push(x)
+                nl += x.count(byeol)
+            # Record end
+            if fr['footer']:
+                put(fr['footer'])
+            elif fr['type']:
+                put(''.join((END_MARK, fsep, fr['type'])))
+        if out:
+            x = b''.join(out)
+            out.clear()
+            pos += len(x)
+            if ncap: captured.append(x)
+            if stats is None:
+                yield x
+            else:
+                t_busy += perf_counter() - t0
+                yield x
+                t0 = perf_counter()
+        if sub is None: end(fr)
+        elif cache is not None: begin_cached(d[sub], sub)
+        else: begin(d[sub], sub, True)
 
-    # Record end
-    if footer:
-        yield bytes_with_breaks(footer, width, eol, sol, encoding)
-    elif rtype and not (header or footer):
-        yield bytes_with_breaks(
-            ''.join((END_MARK, fsep, rtype)),
-            width, eol, sol, encoding=encoding
-        )
+async def imlwldb_aiter(
+        d,
+        uid=None,
+        encoding=ENCODING_DEFAULT,
+        out_format=FORMAT_DEFAULT,
+        index=None,
+        offset=0,
+        stats=None,
+        cache=None
+    ):
+    """
+    Asynchronous iterator yielding bytes of an MLWL database file
+    representation of dict 'd', the same as imlwldb_iter().
+
+    Control is yielded to the event loop after each piece of output,
+    that is, after each sub-record, and each run of fields between
+    sub-records. Each piece is still serialised synchronously by
+    imlwldb_iter(); only the steps between pieces are asynchronous.
+
+    """
+    fmt = as_format(out_format, encoding)
+    for x in imlwldb_iter(
+        d, uid, fmt.encoding, fmt, index=index, offset=offset, stats=stats,
+        cache=cache
+    ):
+        yield x
+        await asyncio.sleep(0)
 
-def imwlrdb(d, uid=None, encoding=ENCODING_DEFAULT, out_format=FORMAT_DEFAULT):
+def imwlrdb(
+        d,
+        uid=None,
+        encoding=ENCODING_DEFAULT,
+        out_format=FORMAT_DEFAULT,
+        index=None,
+        offset=0,
+        stats=None,
+        cache=None
+    ):
     """
     Convert a dict 'd' to a MLWL database file. Returns a byte string.
 
@@ -261,9 +939,2907 @@ def imwlrdb(d, uid=None, encoding=ENCODING_DEFAULT, out_format=FORMAT_DEFAULT):
 
     * encoding: encoding of the database file when read as text
 
-    * out_format: dict containing format specification of the
-       database file
+    * out_format: dict or Format containing format specification
+       of the database file
+
+    * index: MWLRIndex to add records to; see imlwldb_iter()
+
+    * offset: position in the file where output begins
+
+    * stats: SerialiseStats to count records in
+
+    * cache: SerialiseCache of serialised sub-records; see
+       imlwldb_iter()
+
+    """
+    out_format = as_format(out_format, encoding)
+    out = list(imlwldb_iter(
+        d, uid, encoding, out_format, index=index, offset=offset,
+        stats=stats, cache=cache
+    ))
+    if out: out[-1] = out[-1][:-len(out_format.byeol)] # no EOL at the end
+    return b''.join(out)
+
+def record_tree_iter(d, uid=None):
+    """
+    Iterator yielding (uid, parent uid, record) of dict 'd' with UID
+    'uid' and all of its sub-records, each record before its
+    sub-records. The parent UID of 'd' is None.
+
+    """
+    stack = [(uid, None, d)]
+    while stack:
+        uid, parent, rec = stack.pop()
+        yield uid, parent, rec
+        stack.extend(reversed([
+            (k, uid, v) for k, v in rec.items()
+            if type(v) is dict and TYPE_KEY in v
+        ]))
+
+def own_fields(d):
+    """Return a dict of the items of record 'd' without sub-records"""
+    return {
+        k: v for k, v in d.items()
+        if not (type(v) is dict and TYPE_KEY in v)
+    }
+
+def record_hashes(d, uid=None):
+    """
+    Return a dict of (parent uid, hash) of dict 'd' with UID 'uid' and
+    all of its sub-records by UID, for finding out which records have
+    changed with record_diff().
+
+    Hashes are of the fields of a record as they are serialised,
+    without its sub-records, so that a record is only changed when
+    its own fields are. The order of fields counts, as it does in the
+    output, but not the order of sub-records.
+
+    As records are told apart by UID alone, ValueError is raised if
+    any UID is used more than once in the tree, as it may be by
+    sub-records of different parents.
+
+    """
+    out = {}
+    for k, parent, rec in record_tree_iter(d, uid):
+        if k in out: raise ValueError(f'UID {k} is used more than once')
+        own = [
+            (x, multi_val_str(v) if type(v) is dict else str(v))
+            for x, v in own_fields(rec).items()
+        ]
+        b = bytes(repr(own), encoding='utf8', errors='surrogatepass')
+        out[k] = (parent, blake2b(b, digest_size=16).digest())
+    return out
+
+def record_diff(old, new):
+    """
+    Return lists of the UIDs of records added, changed and removed
+    between two versions of a record tree, from their hashes from
+    record_hashes(). Records moved to another parent count as
+    changed. Records added or removed along with their parent are
+    left out, as they go with their parent.
+
+    """
+    added = []
+    changed = []
+    for k, (parent, h) in new.items():
+        x = old.get(k)
+        if x is None:
+            if parent is None or parent in old: added.append(k)
+        elif x != (parent, h):
+            changed.append(k)
+    removed = [
+        k for k, (parent, _) in old.items()
+        if k not in new and (parent is None or parent in new)
+    ]
+    return added, changed, removed
+
+def delta_records(old, new, uid=None):
+    """
+    Iterator yielding (uid, record) of the records of a delta between
+    two versions of a record tree, for sending only what has changed.
+
+    Added records are yielded with their sub-records, and changed
+    records with only their own fields, both with the UID of their
+    parent under PARENT_KEY, except for 'new' itself. Removed records
+    are yielded as empty records of type REMOVED_TYPE.
+
+    Arguments
+    ---------
+    * old: dict of hashes of the old version from record_hashes(),
+       which may be kept instead of the old version itself
+
+    * new: dict of the new version
+
+    * uid: UID of 'new'
+
+    """
+    added, changed, removed = record_diff(old, record_hashes(new, uid))
+    added = set(added)
+    changed = set(changed)
+    for k, parent, rec in record_tree_iter(new, uid):
+        if k not in added and k not in changed: continue
+        out = {} if parent is None else {PARENT_KEY: parent}
+        out.update(rec if k in added else own_fields(rec))
+        yield k, out
+    for k in removed: yield k, {TYPE_KEY: REMOVED_TYPE}
+
+def imwlrdb_delta(
+        old,
+        new,
+        uid=None,
+        encoding=ENCODING_DEFAULT,
+        out_format=FORMAT_DEFAULT
+    ):
+    """
+    Return the bytes of an MWLR database of the records added, changed
+    and removed between two versions of a record tree. Records are as
+    from delta_records(), each written at the top level with its UID.
+
+    Arguments
+    ---------
+    * old: dict of hashes of the old version from record_hashes()
+
+    * new: dict of the new version
+
+    * uid: UID of 'new'
+
+    * encoding: encoding of the database file when read as text
+
+    * out_format: dict or Format containing format specification
+       of the database file
+
+    """
+    f = BytesIO()
+    with MWLRWriter(f, encoding, out_format) as w:
+        for k, d in delta_records(old, new, uid): w.write(d, k)
+    return f.getvalue()
+
+def serialise_records(
+        records,
+        out_format=FORMAT_DEFAULT,
+        fields=None,
+        stats=None,
+        uid_key=None
+    ):
+    """
+    Return the serialised bytes of a list of dicts 'records', each
+    record ending with an EOL, for MWLRWriter.write_all().
+
+    If 'fields' are specified, also return a list of index entries for
+    the records, as (uid, type, start, end, values) tuples, offsets
+    being from the start of the bytes; otherwise None is returned in
+    place of the list. The UID of the first record, or None if it has
+    none, is returned last.
+
+    Records are counted in SerialiseStats 'stats', if specified. If
+    'uid_key' is specified, the value under it in each record, if
+    any, is written as the UID of the record.
+
+    """
+    fmt = as_format(out_format)
+    index = None if fields is None else MWLRIndex(fields)
+    pos = 0
+    out = []
+    first = None
+    for d in records:
+        uid = None
+        if uid_key is not None and d.get(uid_key) is not None:
+            uid = str(d[uid_key])
+        if not out: first = uid
+        for x in imlwldb_iter(
+            d,
+            uid,
+            encoding=fmt.encoding,
+            out_format=fmt,
+            index=index,
+            offset=pos,
+            stats=stats
+        ):
+            out.append(x)
+            pos += len(x)
+    entries = None
+    if index is not None:
+        entries = [
+            (uid, rtype, start, end, dict(zip(index.fields, vals)))
+            for (uid, rtype, start, end), vals
+            in zip(index.records, index.record_values)
+        ]
+    return b''.join(out), entries, first
+
+def serialise_records_counted(
+        records, out_format=FORMAT_DEFAULT, fields=None, uid_key=None
+    ):
+    """
+    Return the same as serialise_records(), with a list of
+    (type, counts) of every record counted by SerialiseStats
+    appended, for counting records serialised in another process.
+
+    """
+    log = []
+    stats = SerialiseStats(callback=lambda *x: log.append(x))
+    return serialise_records(
+        records, out_format, fields, stats, uid_key
+    ) + (log,)
+
+class MWLRWriter:
+    """
+    Writer for MWLR database files, writing records to a binary file
+    object as they are serialised, instead of building the entire file
+    in memory.
+
+    Records are separated by an EOL, and the file does not end with
+    an EOL, so that a file with a single record is exactly the same as
+    the output of imwlrdb().
+
+    Output is buffered up to 'buffer_bytes' before it is written to the
+    file; writers must be closed (or used in a with statement) to write
+    out the last of the output. The file itself is not closed.
+
+    Arguments
+    ---------
+    * f: binary file object
+
+    * encoding: encoding of the database file when read as text
+
+    * out_format: dict or Format containing format specification
+       of the database file
+
+    * buffer_bytes: number of bytes to buffer before writing
+
+    * index: MWLRIndex to add records to as they are written
+
+    * stats: SerialiseStats to count records in
+
+    * cache: SerialiseCache of serialised sub-records; see
+       imlwldb_iter(). Records written over several processes by
+       write_all() do not use the cache.
 
     """
-    leneol = len((bytes(out_format.get('eol', EOL_DEFAULT), encoding=encoding)))
-    return b''.join(imlwldb_iter(d, uid, encoding, out_format))[:-leneol]
+    def __init__(
+            self,
+            f,
+            encoding=ENCODING_DEFAULT,
+            out_format=FORMAT_DEFAULT,
+            buffer_bytes=WRITER_BUFFER_BYTES,
+            index=None,
+            stats=None,
+            cache=None
+        ):
+        self.f = f
+        self.out_format = as_format(out_format, encoding)
+        self.buffer_bytes = buffer_bytes
+        self.index = index
+        self.stats = stats
+        self.cache = cache
+        self.pos = 0 # bytes written so far, including the buffer
+        self._buf = []
+        self._buf_len = 0
+        self._eol_due = False # EOL held back from the last record
+        self._held = None # last piece of the record being written
+        self._tail = None # END line of the outer record when appending
+
+    @classmethod
+    def append(
+            cls,
+            f,
+            encoding=ENCODING_DEFAULT,
+            out_format=FORMAT_DEFAULT,
+            buffer_bytes=WRITER_BUFFER_BYTES,
+            index=None,
+            stats=None,
+            outer=None,
+            cache=None
+        ):
+        """
+        Return a writer adding records to an existing database in
+        binary file 'f', which must be open for reading and writing.
+        The file ends up the same as if all of its records had been
+        written by a single writer.
+
+        If the file already ends with an EOL after the END line of a
+        record, records are written after it without adding another.
+
+        Arguments
+        ---------
+        * outer: type of a record at the end of the file to add records
+           to as sub-records; records are written before its END line,
+           which is written again when the writer is closed
+
+        * index: MWLRIndex of the file as it is, to add the new records
+           to; the end of the 'outer' record is also updated
+
+        The remaining arguments are the same as those of MWLRWriter.
+
+        """
+        w = cls(f, encoding, out_format, buffer_bytes, index, stats, cache)
+        fmt = w.out_format
+        byeol = fmt.byeol
+        size = f.seek(0, os.SEEK_END)
+        # Read back from the end until the whole last line is in 'tail'
+        n = 0
+        while True:
+            n = min(size, max(n * 2, DEFAULT_BUFFER_SIZE))
+            f.seek(size - n)
+            tail = f.read(n)
+            body = tail[:-len(byeol)] if tail.endswith(byeol) else tail
+            i = body.rfind(byeol)
+            if i >= 0 or n >= size: break
+        i = i + len(byeol) if i >= 0 else 0
+        last = body[i:] # last line, not counting a trailing EOL
+        trail = tail[len(body):] # trailing EOL, if any
+        byend = bytes(''.join((END_MARK, fmt.fsep)), encoding=fmt.encoding)
+        if outer is None:
+            w.pos = size
+            w._eol_due = size > 0 and not (trail and last.startswith(byend))
+            f.seek(size)
+            return w
+        if last != b''.join((byend, bytes(outer, encoding=fmt.encoding))):
+            raise ValueError(f'file does not end with a {outer} record')
+        w.pos = size - n + i
+        j = None
+        if index is not None:
+            end = w.pos + len(last)
+            for j in range(len(index.records) - 1, -1, -1):
+                if index.records[j][1:4:2] == (outer, end): break
+            else:
+                raise ValueError(f'record {outer} is not in the index')
+        w._tail = (last, trail, j)
+        f.seek(w.pos)
+        return w
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def _put(self, x):
+        self._buf.append(x)
+        self._buf_len += len(x)
+        self.pos += len(x)
+        if self._buf_len >= self.buffer_bytes: self.flush()
+
+    def close(self):
+        """Write out buffered output, without the EOL of the last record"""
+        if self._tail is not None:
+            # Put back the END line of the outer record when appending
+            last, trail, i = self._tail
+            self._tail = None
+            if self._eol_due: self._put(self.out_format.byeol)
+            self._put(last)
+            if i is not None: self.index.set_end(i, self.pos)
+            self._put(trail)
+            self._eol_due = not trail
+            self.flush()
+            self.f.truncate()
+            return
+        self.flush()
+
+    def flush(self):
+        """Write out buffered output to the file"""
+        self.f.writelines(self._buf)
+        self._buf.clear()
+        self._buf_len = 0
+
+    def write_all(
+            self,
+            records,
+            jobs=None,
+            chunk_size=EXPORT_CHUNK_RECORDS,
+            uid_key=None
+        ):
+        """
+        Serialise and write dicts from iterable 'records', in chunks of
+        'chunk_size' records over 'jobs' worker processes. The output
+        is the same as that of calling write() on every record in turn.
+
+        Only a few chunks per worker are in flight at a time, so that
+        'records' may be a generator of any length. If 'jobs' is None,
+        one worker is used per CPU; if 'jobs' is 1, records are written
+        in this process.
+
+        If 'uid_key' is specified, the value under it in each record,
+        if any, is written as the UID of the record, as records read
+        by mwlr_iter() have theirs under UID_KEY.
+
+        """
+        if jobs is None: jobs = os.cpu_count() or 1
+        if jobs <= 1:
+            for d in records:
+                uid = None
+                if uid_key is not None and d.get(uid_key) is not None:
+                    uid = str(d[uid_key])
+                self.write(d, uid)
+            return
+        fields = None if self.index is None else self.index.fields
+        serialise = serialise_records
+        if self.stats is not None: serialise = serialise_records_counted
+        records = iter(records)
+        chunks = iter(lambda: list(islice(records, chunk_size)), [])
+        pending = deque()
+        with ProcessPoolExecutor(jobs) as ex:
+            for chunk in chain(chunks, repeat(None, jobs * 2)):
+                if chunk is not None:
+                    pending.append(ex.submit(
+                        serialise, chunk, self.out_format, fields,
+                        uid_key=uid_key
+                    ))
+                if len(pending) >= jobs * 2 or (chunk is None and pending):
+                    b, entries, uid, *log = pending.popleft().result()
+                    self._write_serialised(b, entries, uid)
+                    for x in chain.from_iterable(log): self.stats.add(*x)
+
+    def _write_serialised(self, b, entries, uid=None):
+        # Write bytes 'b' of whole records with their EOLs from
+        # serialise_records(), the first with UID 'uid', and add
+        # 'entries' to the index
+        if not b: return
+        byeol = self.out_format.byeol
+        if self._eol_due: self._put(byeol)
+        for uid, rtype, start, end, vals in entries or ():
+            self.index.add(uid, rtype, start + self.pos, end + self.pos, vals)
+        self._put(b[:-len(byeol)])
+        self._eol_due = True
+
+    def _begin(self):
+        # Start a record, returning the offset where it will begin
+        self._held = None
+        return self.pos + (len(self.out_format.byeol) if self._eol_due else 0)
+
+    def _feed(self, x):
+        # Write a piece of the current record, holding back the last one
+        if self._held is not None: self._put(self._held)
+        elif self._eol_due: self._put(self.out_format.byeol)
+        self._held = x
+
+    def _end(self):
+        # Finish the current record, leaving out its EOL
+        if self._held is not None:
+            self._put(self._held[:-len(self.out_format.byeol)])
+            self._eol_due = True
+        self._held = None
+
+    def write(self, d, uid=None):
+        """Serialise dict 'd' and write it as a record with UID 'uid'"""
+        fmt = self.out_format
+        offset = self._begin()
+        for x in imlwldb_iter(
+            d,
+            uid,
+            fmt.encoding,
+            fmt,
+            index=self.index,
+            offset=offset,
+            stats=self.stats,
+            cache=self.cache
+        ):
+            self._feed(x)
+        self._end()
+
+class AsyncMWLRWriter(MWLRWriter):
+    """
+    Writer for MWLR database files, like MWLRWriter, but for writing
+    to asyncio.StreamWriter-like sinks from coroutines.
+
+    Control is yielded to the event loop between records, and the
+    sink is drained every time the buffer is written to it, so that
+    large exports do not stall other tasks, nor outrun the client.
+
+    Arguments
+    ---------
+    * sink: object with write(), writelines() and drain() methods,
+       the last being a coroutine, such as an asyncio.StreamWriter
+
+    The remaining arguments are the same as those of MWLRWriter.
+
+    """
+    def __init__(
+            self,
+            sink,
+            encoding=ENCODING_DEFAULT,
+            out_format=FORMAT_DEFAULT,
+            buffer_bytes=WRITER_BUFFER_BYTES,
+            index=None,
+            stats=None,
+            cache=None
+        ):
+        super().__init__(
+            sink, encoding, out_format, buffer_bytes, index, stats, cache
+        )
+        self._drain_due = False
+
+    @classmethod
+    def append(cls, *args, **kwargs):
+        raise ValueError('streams cannot be appended to')
+
+    def __enter__(self):
+        raise TypeError('use "async with" with AsyncMWLRWriter')
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *args):
+        await self.close()
+
+    async def close(self):
+        """Write out buffered output and wait for the sink to drain"""
+        self.flush()
+        await self.drain()
+
+    async def drain(self):
+        """Wait for the sink to drain, if anything has been written"""
+        if self._drain_due:
+            self._drain_due = False
+            await self.f.drain()
+
+    def flush(self):
+        if self._buf: self._drain_due = True
+        super().flush()
+
+    async def write(self, d, uid=None):
+        """Serialise dict 'd' and write it as a record with UID 'uid'"""
+        fmt = self.out_format
+        offset = self._begin()
+        async for x in imlwldb_aiter(
+            d,
+            uid,
+            fmt.encoding,
+            fmt,
+            index=self.index,
+            offset=offset,
+            stats=self.stats,
+            cache=self.cache
+        ):
+            self._feed(x)
+            await self.drain()
+        self._end()
+        await self.drain()
+        await asyncio.sleep(0)
+
+    async def write_all(self, records):
+        """
+        Write dicts from 'records', which may be an iterable or an
+        asynchronous iterable.
+
+        """
+        if hasattr(records, '__aiter__'):
+            async for d in records: await self.write(d)
+        else:
+            for d in records: await self.write(d)
+
+def append_records(
+        fpath,
+        records,
+        encoding=ENCODING_DEFAULT,
+        out_format=FORMAT_DEFAULT,
+        outer=None,
+        jobs=1
+    ):
+    """
+    Add records to the end of the database file at 'fpath', without
+    rewriting the records already in it. If the file has an up-to-date
+    sidecar index, the index is updated as well; stale sidecars are
+    left for MWLRReader to rebuild.
+
+    Arguments
+    ---------
+    * fpath: path to the database file
+
+    * records: iterable of dicts, or a dict of dicts by UID, as
+       sub-records are kept in their parents
+
+    * encoding: encoding of the database file when read as text
+
+    * out_format: dict or Format containing format specification
+       of the database file
+
+    * outer: type of a record at the end of the file to add records
+       to as sub-records; see MWLRWriter.append()
+
+    * jobs: number of processes to serialise records over, for
+       records that are not in a dict; see MWLRWriter.write_all()
+
+    """
+    ipath = index_path(fpath)
+    index = MWLRIndex.load(ipath, fpath) # must be loaded before changes
+    with open(fpath, mode='r+b') as f:
+        with MWLRWriter.append(
+            f, encoding, out_format, index=index, outer=outer
+        ) as w:
+            if type(records) is dict:
+                for uid, d in records.items(): w.write(d, uid)
+            else:
+                w.write_all(records, jobs)
+    if index is not None: index.save(ipath, fpath)
+
+def block_compressor(codec, level=None):
+    """
+    Return a compressor object of codec 'codec' (a name in
+    BLOCK_CODECS) at compression level 'level', or the codec's
+    default level if None.
+
+    """
+    if codec == 'zlib':
+        return zlib.compressobj(-1 if level is None else level)
+    if codec == 'lzma' and lzma is not None:
+        return lzma.LZMACompressor(preset=level)
+    raise ValueError(f'codec {codec} is not available')
+
+def block_decompress(codec, b):
+    """Return bytes 'b' decompressed with codec 'codec'"""
+    if codec == 'zlib': return zlib.decompress(b)
+    if codec == 'lzma' and lzma is not None: return lzma.decompress(b)
+    raise ValueError(f'codec {codec} is not available')
+
+class MWLRBlockWriter(MWLRWriter):
+    """
+    Writer for MWLR block containers, which hold a database in blocks
+    compressed independently of each other, so that any part of the
+    database may be read by decompressing only the blocks it is in.
+
+    The uncompressed blocks joined together are exactly the database
+    file that MWLRWriter would have written. Blocks begin at the start
+    of a top-level record, and a new block is begun at the next record
+    once a block holds 'block_bytes', so records never span blocks.
+    Records from write_all() over several processes are kept together
+    in chunks, which may take blocks past 'block_bytes'.
+
+    Containers begin with BLOCK_MAGIC and the codec number, followed
+    by the blocks, a table of blocks, and a trailer of the offset of
+    the table, the number of blocks and BLOCK_MAGIC. Each entry in the
+    table has the uncompressed offset and size, and the compressed
+    offset and size of a block, and the UID of its first record. The
+    table is only written when the writer is closed.
+
+    Offsets in 'index' are those of the uncompressed database, for
+    use with MWLRBlockReader.
+
+    Arguments
+    ---------
+    * codec: name of the compression codec in BLOCK_CODECS
+
+    * level: compression level, or None for the codec's default
+
+    * block_bytes: number of uncompressed bytes per block
+
+    The remaining arguments are the same as those of MWLRWriter.
+
+    """
+    def __init__(
+            self,
+            f,
+            encoding=ENCODING_DEFAULT,
+            out_format=FORMAT_DEFAULT,
+            buffer_bytes=WRITER_BUFFER_BYTES,
+            index=None,
+            stats=None,
+            codec='zlib',
+            level=None,
+            block_bytes=BLOCK_BYTES,
+            cache=None
+        ):
+        if codec not in BLOCK_CODECS:
+            raise ValueError(f'unknown codec {codec}')
+        block_compressor(codec, level) # fail early if unavailable
+        super().__init__(
+            f, encoding, out_format, buffer_bytes, index, stats, cache
+        )
+        self.codec = codec
+        self.level = level
+        self.block_bytes = block_bytes
+        self.blocks = [] # (uid, offset, size, compressed offset, size)
+        self._block = None # (uid, offset, compressed offset) of open block
+        self._comp = None
+        self._cpos = 0 # compressed bytes written
+        self._closed = False
+        self._write_raw(
+            b''.join((BLOCK_MAGIC, bytes((BLOCK_CODECS.index(codec),))))
+        )
+
+    @classmethod
+    def append(cls, *args, **kwargs):
+        raise ValueError('block containers cannot be appended to')
+
+    def _write_raw(self, b):
+        if not b: return
+        self.f.write(b)
+        self._cpos += len(b)
+
+    def _begin_block(self, uid):
+        # Begin a new block at the next record if the open block is full
+        block = self._block
+        if block is not None and self.pos - block[1] < self.block_bytes:
+            return
+        if block is not None: self._end_block()
+        self._block = (uid, self.pos, self._cpos)
+        self._comp = block_compressor(self.codec, self.level)
+
+    def _end_block(self, last=False):
+        # Close the open block, with the EOL of its last record unless
+        # it is the last block
+        if self._eol_due and not last:
+            self._put(self.out_format.byeol)
+            self._eol_due = False
+        self.flush()
+        self._write_raw(self._comp.flush())
+        uid, start, cstart = self._block
+        self.blocks.append(
+            (uid, start, self.pos - start, cstart, self._cpos - cstart)
+        )
+        self._block = None
+        self._comp = None
+
+    def close(self):
+        """
+        Write out buffered output and the table of blocks. The file
+        itself is not closed.
+
+        """
+        if self._closed: return
+        self._closed = True
+        if self._block is not None: self._end_block(last=True)
+        table = self._cpos
+        out = []
+        for uid, start, size, cstart, csize in self.blocks:
+            out.append(struct.pack('<QQQQ', start, size, cstart, csize))
+            out.append(index_str_bytes(uid))
+        out.append(struct.pack('<QQ', table, len(self.blocks)))
+        out.append(BLOCK_MAGIC)
+        self._write_raw(b''.join(out))
+
+    def flush(self):
+        """Compress buffered output and write it to the file"""
+        if self._buf:
+            self._write_raw(self._comp.compress(b''.join(self._buf)))
+        self._buf.clear()
+        self._buf_len = 0
+
+    def _write_serialised(self, b, entries, uid=None):
+        if b: self._begin_block(uid)
+        super()._write_serialised(b, entries, uid)
+
+    def write(self, d, uid=None):
+        """Serialise dict 'd' and write it as a record with UID 'uid'"""
+        if d: self._begin_block(uid)
+        super().write(d, uid)
+
+def lines_iter(
+        f,
+        eol=EOL_DEFAULT,
+        encoding=ENCODING_DEFAULT,
+        size=DEFAULT_BUFFER_SIZE
+    ):
+    """
+    Iterator yielding lines from a binary file object 'f' as bytes,
+    without the end-of-line sequence 'eol'.
+
+    The file is read 'size' bytes at a time, so memory use depends
+    on the length of the longest line, rather than that of the file.
+
+    """
+    byeol = bytes(eol, encoding=encoding)
+    keep = len(byeol) - 1 # most bytes of an EOL at the end of a block
+    pieces = [] # pieces of the line being read, joined once it ends
+    tail = b'' # last 'keep' bytes of the pieces
+    started = False
+    for block in iter(lambda: f.read(size), b''):
+        started = True
+        if tail:
+            # Only the start of the block is searched for an EOL split
+            # across blocks, as the rest of the line was already
+            j = b''.join((tail, block[:keep])).find(byeol)
+            if 0 <= j < len(tail):
+                ln = b''.join(pieces)
+                yield ln[:len(ln)-len(tail)+j]
+                block = block[j+len(byeol)-len(tail):]
+                pieces = []
+                tail = b''
+        lines = block.split(byeol)
+        if len(lines) > 1:
+            pieces.append(lines[0])
+            yield b''.join(pieces)
+            yield from lines[1:-1]
+            pieces = [lines[-1]]
+            tail = b''
+        else:
+            pieces.append(block)
+        if keep: tail = b''.join((tail, pieces[-1]))[-keep:]
+    if started: yield b''.join(pieces)
+
+class _Lines:
+    # Lines from a binary file object like lines_iter(), that can also
+    # skip ahead to the next line matching a pattern, without splitting
+    # the lines in between
+    def __init__(self, f, byeol, size):
+        self.f = f
+        self.byeol = byeol
+        self.size = size
+        self.buf = b''
+        self.i = 0 # start of the next line in buf
+        self.started = False
+        self.done = False
+
+    def __iter__(self):
+        return self
+
+    def _more(self):
+        # Read another block, keeping the EOL before the next line
+        block = self.f.read(self.size)
+        if not block: return False
+        self.started = True
+        k = max(0, self.i - len(self.byeol))
+        self.buf = b''.join((self.buf[k:], block))
+        self.i -= k
+        return True
+
+    def __next__(self):
+        while True:
+            j = self.buf.find(self.byeol, self.i)
+            if j >= 0:
+                ln = self.buf[self.i:j]
+                self.i = j + len(self.byeol)
+                return ln
+            if not self._more():
+                if self.done or not self.started: raise StopIteration
+                self.done = True
+                ln = self.buf[self.i:]
+                self.i = len(self.buf)
+                return ln
+
+    def skip_to(self, seek, keep):
+        # Skip lines up to the next line that begins a match of 'seek',
+        # a compiled pattern starting with the EOL; return the last
+        # 'keep' lines skipped. Must not be used before the first line.
+        byeol = self.byeol
+        neol = len(byeol)
+        while True:
+            m = seek.search(self.buf, self.i - neol)
+            if m is not None or not self._more_trimmed(keep): break
+        end = len(self.buf) if m is None else m.start()
+        skipped = self.buf[self.i:end] if end >= self.i else None
+        if m is None:
+            self.i = len(self.buf)
+            self.done = True
+        else:
+            self.i = m.start() + neol
+        if skipped is None or not keep: return []
+        return skipped.rsplit(byeol, keep)[-keep:]
+
+    def _more_trimmed(self, keep):
+        # Read another block, dropping all but the last 'keep' lines
+        # and any partial line before it
+        buf = self.buf
+        p = len(buf)
+        for _ in range(keep + 1):
+            q = buf.rfind(self.byeol, self.i, p)
+            if q < 0: break
+            p = q
+        else:
+            self.i = p + len(self.byeol)
+        return self._more()
+
+def mwlr_iter(
+        f,
+        encoding=ENCODING_DEFAULT,
+        in_format=FORMAT_DEFAULT,
+        header=None,
+        footer=None,
+        depth=1,
+        size=DEFAULT_BUFFER_SIZE,
+        only=None
+    ):
+    """
+    Iterator yielding records from a binary file object 'f' of an
+    MWLR database, as dicts. This is the reverse of imlwldb_iter().
+
+    Only the record being read is held in memory. Records nested
+    deeper than 'depth' are returned as part of their parent record.
+
+    Arguments
+    ---------
+    * f: binary file object
+
+    * encoding: encoding of the database file when read as text
+
+    * in_format: dict or Format containing format specification
+       of the database file; accepts the same as out_format in
+       imwlrdb()
+
+    * header: regular expression (str, bytes or compiled bytes
+       pattern) matching the first line of records with a custom
+       header (i.e. __header); custom headers are not detected
+       if omitted
+
+    * footer: the custom footer (i.e. __footer) of records with
+       custom headers; if omitted, such records end where the next
+       one begins
+
+    * depth: nesting level of the records to yield. The file-level
+       context is level 0, records in the file are level 1, their
+       sub-records level 2, and so on. Records at a lower level are
+       yielded after their sub-records, without the sub-records.
+
+    * size: number of bytes to read from 'f' at a time
+
+    * only: names of the fields to read; other fields are skipped
+       without being unfolded or decoded, as is the freeform body
+       area unless '' is included. Types, UIDs, custom headers and
+       footers, and sub-records are still read, the sub-records
+       with the same fields skipped. All fields are read if omitted.
+
+    Records yielded on their own have their UID, if any, under the
+    UID key. Sub-records without a UID are filed under a random
+    160-bit UID. The file-level context is only yielded if it has
+    any fields, or if depth is zero. The 'newline' sequence in field
+    values is translated back into line feeds.
+
+    Dead records (of type DEAD_TYPE), which take up the space of
+    deleted records, are skipped along with their contents. Records
+    of type REMOVED_TYPE, which stand for removed records in deltas
+    from imwlrdb_delta(), are yielded like any other record.
+
+    Lines in freeform body areas that resemble field continuations,
+    END markers or custom headers cannot be told apart from them,
+    and freeform body lines broken up to fit the width limit are
+    returned with the line breaks.
+
+    """
+    fmt = as_format(in_format, encoding)
+    encoding = fmt.encoding
+    enc = lambda s: bytes(s, encoding=encoding)
+    byeol = fmt.byeol
+    sol = fmt.bysol
+    fsep = fmt.byfsep
+    fmsep = fmt.byfmsep
+    newline = fmt.newline
+    bybegin = b''.join((enc(BEGIN_MARK), fsep))
+    byend = b''.join((enc(END_MARK), fsep))
+    bydead = enc(DEAD_TYPE)
+    if type(header) is str: header = re.compile(enc(header))
+    elif type(header) is bytes: header = re.compile(header)
+    footer_lines = None
+    if footer is not None:
+        footer_lines = [enc(x) for x in footer.split(fmt.eol)]
+    keep_body = only is None or '' in only
+    nfoot = len(footer_lines) if footer_lines else 0
+    wanted = None
+    if only is not None:
+        wanted = {enc(x) for x in only if x}
+        wanted.update((enc(BEGIN_MARK), enc(END_MARK)))
+        seek_end = re.compile(re.escape(byeol) + re.escape(byend))
+        if header:
+            seek_header = re.compile(
+                b''.join((re.escape(byeol), b'(?:', header.pattern, b')'))
+            )
+    byuid = enc(UID_KEY)
+
+    def frame(rec, rtype=None, is_header=False):
+        return {
+            'rec': rec, 'uid': None, 'type': rtype,
+            'header': is_header, 'body': None,
+        }
+
+    stack = [frame({}),]
+
+    def has_footer(fr):
+        if footer_lines is None: return True
+        body = fr['body']
+        return body is not None and body[-len(footer_lines):] == footer_lines
+
+    def field(fr, ln):
+        # Return False if 'ln' is not a field
+        seps = [x for x in (ln.find(fsep), ln.find(fmsep)) if x >= 0]
+        if not seps or min(seps) == 0: return False
+        i = min(seps)
+        name = str(ln[:i], encoding=encoding)
+        if ln.startswith(fsep, i):
+            val = str(ln[i+len(fsep):], encoding=encoding)
+            if newline: val = val.replace(newline, '\n')
+            if name.upper() == UID_KEY: fr['uid'] = val
+            else: fr['rec'][name] = val
+        else:
+            fr['rec'][name] = multi_val_dict(
+                str(ln[i+len(fmsep):], encoding=encoding),
+                fmt.vsep,
+                fmt.sfsep,
+                fmt.escape,
+            )
+        return True
+
+    def done(fr, level):
+        if fr['type'] == bydead: return
+        rec = fr['rec']
+        body = fr['body']
+        if fr['header'] and footer_lines is not None:
+            if has_footer(fr): del body[-len(footer_lines):]
+        if body and keep_body:
+            text = str(byeol.join(body), encoding=encoding)
+            if text: rec[''] = text
+        if fr['header'] and footer is not None: rec[FOOTER_KEY] = footer
+        uid = fr['uid']
+        if level > depth:
+            if uid is None: uid = token_hex(20)
+            stack[-1]['rec'][uid] = rec
+        elif level > 0 or depth == 0 or rec or uid is not None:
+            if uid is not None: rec[UID_KEY] = uid
+            yield rec
+
+    def add_body(fr, ln):
+        # Add 'ln' to the body, keeping only what is needed to find
+        # footers if the body is not wanted
+        body = fr['body']
+        body.append(ln)
+        if not keep_body and len(body) > nfoot: del body[0]
+
+    def wanted_line(ln):
+        # Return False if 'ln' starts a field that is not in 'only'
+        if header and stack[-1]['type'] is None and header.match(ln):
+            return True
+        seps = [x for x in (ln.find(fsep), ln.find(fmsep)) if x >= 0]
+        if not seps: return True
+        name = ln[:min(seps)]
+        return not name or name in wanted or name.upper() == byuid
+
+    def feed(ln):
+        top = stack[-1]
+        if header and top['type'] is None and header.match(ln):
+            if not top['header']:
+                stack.append(frame({HEADER_KEY: str(ln, encoding)}, None, True))
+                return
+            if has_footer(top):
+                stack.pop()
+                yield from done(top, 1)
+                stack.append(frame({HEADER_KEY: str(ln, encoding)}, None, True))
+                return
+        if top['type'] is not None and ln.startswith(byend) \
+                and ln[len(byend):] == top['type']:
+            level = len(stack) - 1
+            stack.pop()
+            yield from done(top, level)
+        elif top['body'] is not None and len(stack) > 1:
+            add_body(top, ln)
+        elif ln.startswith(bybegin):
+            rtype = ln[len(bybegin):]
+            stack.append(frame({TYPE_KEY: str(rtype, encoding)}, rtype))
+        elif top['body'] is not None:
+            add_body(top, ln)
+        elif ln.startswith(byend):
+            raise ValueError(f'unexpected record end: {str(ln, encoding)}')
+        elif not field(top, ln):
+            top['body'] = []
+            add_body(top, ln)
+
+    # Unfold lines continued with SOL before feeding them, except
+    # in freeform body areas, which are written without SOLs. Fields
+    # not in 'only' are dropped along with their continuation lines.
+    # Lines in the bodies of records are also dropped if the body is
+    # not wanted, unless they could end the record.
+    parts = None
+    foldable = False
+    if wanted is None: lines = lines_iter(f, fmt.eol, encoding, size)
+    else: lines = _Lines(f, byeol, size)
+    for ln in lines:
+        if foldable and sol and ln.startswith(sol):
+            if parts is not None: parts.append(ln[len(sol):])
+            continue
+        if parts is not None: yield from feed(b''.join(parts))
+        top = stack[-1]
+        foldable = top['body'] is None
+        parts = [ln,]
+        if wanted is None: continue
+        if foldable:
+            if not wanted_line(ln): parts = None
+        elif not (
+            keep_body
+            or len(stack) == 1
+            or ln.startswith(byend)
+            or (header and top['type'] is None and header.match(ln))
+        ):
+            add_body(top, ln)
+            parts = None
+            seek = seek_end if top['type'] is not None else seek_header
+            for x in lines.skip_to(seek, nfoot): add_body(top, x)
+    if parts is not None: yield from feed(b''.join(parts))
+    while len(stack) > 1:
+        top = stack.pop()
+        if not top['header']:
+            raise ValueError(f"record {top['rec'][TYPE_KEY]} has no end")
+        yield from done(top, 1)
+    yield from done(stack[0], 0)
+
+class _MapRange:
+    # Binary file-like object reading a range of a memory map
+    def __init__(self, mm, start, end):
+        self.mm = mm
+        self.i = start
+        self.end = end
+
+    def read(self, size=-1):
+        n = self.end - self.i
+        if 0 <= size < n: n = size
+        b = self.mm[self.i:self.i+n]
+        self.i += n
+        return b
+
+def chunk_ranges(
+        mm,
+        encoding=ENCODING_DEFAULT,
+        in_format=FORMAT_DEFAULT,
+        header=None,
+        footer=None,
+        chunk_bytes=PARSE_CHUNK_BYTES
+    ):
+    """
+    Iterator yielding (start, end) byte ranges splitting the MWLR
+    database in bytes-like object 'mm' into chunks of at least
+    'chunk_bytes' (except the last), so that each chunk holds only
+    whole top-level records. Ranges do not include the EOL between
+    chunks.
+
+    Chunks begin at BEGIN markers outside of any record, or if
+    'header' is set, only at custom headers, after a footer if
+    'footer' is set. Records are found in the same way as in
+    MWLRReader, from the markers alone; the markers of records
+    still have to be scanned in order to tell if they are nested.
+
+    Chunks never begin after the empty line that ends a freeform
+    area in SPECS.rst, as mwlr_iter() does not end records there
+    either; records with freeform areas always end at their END
+    marker or footer.
+
+    Arguments
+    ---------
+    * mm: bytes-like object, such as an mmap.mmap of the file
+
+    * encoding, in_format, header, footer: see mwlr_iter()
+
+    * chunk_bytes: number of bytes per chunk
+
+    """
+    fmt = as_format(in_format, encoding)
+    enc = lambda s: bytes(s, encoding=fmt.encoding)
+    byeol = fmt.byeol
+    start = 0
+    target = chunk_bytes
+    if header is not None:
+        # The compiled pattern is used as it is, keeping its flags, and
+        # matches not at the start of a line are skipped
+        if type(header) is str: header = enc(header)
+        if type(header) is bytes: header = re.compile(header)
+        neol = len(byeol)
+        tail = None
+        if footer is not None:
+            tail = b''.join((byeol, enc(footer), byeol))
+        while target < len(mm):
+            m = header.search(mm, target)
+            if m is None: break
+            i = m.start()
+            if i < neol or mm[i-neol:i] != byeol or (
+                tail and mm[max(0, i-len(tail)):i] != tail
+            ):
+                target = i + 1
+                continue
+            yield start, i - neol
+            start = i
+            target = i + chunk_bytes
+    else:
+        bybegin = enc(BEGIN_MARK)
+        marks = re.compile(b''.join((
+            b'(?:\\A|', re.escape(byeol), b')(',
+            re.escape(bybegin), b'|', re.escape(enc(END_MARK)), b')',
+            re.escape(fmt.byfsep), b'(.*?)(?=', re.escape(byeol), b'|\\Z)'
+        )), re.DOTALL)
+        stack = []
+        for m in marks.finditer(mm):
+            mark, rtype = m.group(1, 2)
+            if mark == bybegin:
+                i = m.start(1)
+                if not stack and i >= target:
+                    yield start, i - len(byeol)
+                    start = i
+                    target = i + chunk_bytes
+                stack.append(rtype)
+            elif stack and stack[-1] == rtype:
+                stack.pop()
+    if start < len(mm): yield start, len(mm)
+
+def parse_range(
+        fpath,
+        start,
+        end,
+        encoding=ENCODING_DEFAULT,
+        in_format=FORMAT_DEFAULT,
+        header=None,
+        footer=None,
+        depth=1,
+        only=None
+    ):
+    """
+    Return a list of records from bytes 'start' to 'end' of the MWLR
+    database file at 'fpath', as dicts, with the file-level context
+    in the range, or None, for mwlr_parallel_iter().
+
+    The file is memory-mapped, so that processes reading different
+    ranges of the same file share its pages. The remaining arguments
+    are the same as those of mwlr_iter().
+
+    """
+    with open(fpath, mode='rb') as f:
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            out = list(mwlr_iter(
+                _MapRange(mm, start, end), encoding, in_format, header,
+                footer, depth, only=only
+            ))
+    context = None
+    if out and TYPE_KEY not in out[-1] and HEADER_KEY not in out[-1]:
+        context = out.pop()
+    return out, context
+
+def mwlr_parallel_iter(
+        fpath,
+        encoding=ENCODING_DEFAULT,
+        in_format=FORMAT_DEFAULT,
+        header=None,
+        footer=None,
+        depth=1,
+        only=None,
+        jobs=None,
+        ordered=True,
+        chunk_bytes=PARSE_CHUNK_BYTES
+    ):
+    """
+    Iterator yielding records from the MWLR database file at 'fpath'
+    as dicts, like mwlr_iter(), parsing chunks of the file over 'jobs'
+    worker processes. Chunks are split with chunk_ranges(), and only
+    a few chunks per worker are in flight at a time.
+
+    If 'ordered' is False, records are yielded a chunk at a time as
+    soon as each chunk is parsed, instead of in the order in the file.
+    The file-level context, made up of the file-level fields of all
+    chunks, is always yielded last.
+
+    If 'jobs' is None, one worker is used per CPU; if 'jobs' is 1 or
+    'depth' is 0, the file is parsed in this process.
+
+    The remaining arguments are the same as those of mwlr_iter().
+
+    """
+    if jobs is None: jobs = os.cpu_count() or 1
+    if jobs <= 1 or depth == 0:
+        with open(fpath, mode='rb') as f:
+            yield from mwlr_iter(
+                f, encoding, in_format, header, footer, depth, only=only
+            )
+        return
+    fmt = as_format(in_format, encoding)
+    context = {}
+    with open(fpath, mode='rb') as f:
+        try:
+            mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:
+            return # empty files cannot be mapped
+        with mm, ProcessPoolExecutor(jobs) as ex:
+            pending = deque() if ordered else set()
+            ranges = chunk_ranges(
+                mm, fmt.encoding, fmt, header, footer, chunk_bytes
+            )
+            for r in chain(ranges, repeat(None, jobs * 2)):
+                if r is not None:
+                    fu = ex.submit(
+                        parse_range, fpath, *r, fmt.encoding, fmt, header,
+                        footer, depth, only
+                    )
+                    if ordered: pending.append(fu)
+                    else: pending.add(fu)
+                if len(pending) < jobs * 2 and (r is not None or not pending):
+                    continue
+                if ordered:
+                    done = (pending.popleft(),)
+                else:
+                    done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for fu in done:
+                    recs, x = fu.result()
+                    yield from recs
+                    if not x: continue
+                    if '' in x and '' in context:
+                        x[''] = fmt.eol.join((context[''], x['']))
+                    context.update(x)
+    if context: yield context
+
+class Column:
+    """
+    Values of one field over the rows of a ColumnTable, laid out as
+    in Apache Arrow string arrays: values encoded in UTF-8 end to end
+    in 'data', the offsets of the start of every row's value and the
+    end of the last in 'offsets', and a bitmap 'present' of the rows
+    with the field, bit (i % 8) of byte (i // 8) being for row i.
+    Rows without the field have empty values.
+
+    Arguments
+    ---------
+    * name: name of the field
+
+    """
+    __slots__ = ('name', 'data', 'offsets', 'present')
+
+    def __init__(self, name):
+        self.name = name
+        self.data = bytearray()
+        self.offsets = array('Q', (0,))
+        self.present = bytearray()
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, i):
+        """Return the value of row 'i', or None if it is missing"""
+        n = len(self)
+        if i < 0: i += n
+        if not 0 <= i < n: raise IndexError('row out of range')
+        if not self.present[i >> 3] & (1 << (i & 7)): return None
+        return str(
+            self.data[self.offsets[i]:self.offsets[i+1]], encoding='utf8'
+        )
+
+    def __iter__(self):
+        for i in range(len(self)): yield self[i]
+
+    def append(self, value, row=None):
+        """
+        Add str 'value' as the value of row 'row', adding missing rows
+        before it, or the next row if None. Values of None are missing.
+
+        """
+        n = len(self)
+        if row is None: row = n
+        if row < n: raise ValueError(f'row {row} is already in the column')
+        if row > n: self.offsets.extend(repeat(len(self.data), row - n))
+        present = self.present
+        if len(present) < (row >> 3) + 1:
+            present.extend(bytes((row >> 3) + 1 - len(present)))
+        if value is not None:
+            self.data.extend(bytes(value, encoding='utf8'))
+            present[row >> 3] |= 1 << (row & 7)
+        self.offsets.append(len(self.data))
+
+    def numbers(self, typecode='d', missing=float('nan')):
+        """
+        Return the values as an array of type 'typecode' (see the
+        array module), with 'missing' for missing values. Values are
+        converted with float() or int() to suit the type.
+
+        """
+        conv = float if typecode in 'fd' else int
+        return array(typecode, (
+            missing if x is None else conv(x) for x in self
+        ))
+
+    def numpy(self):
+        """
+        Return NumPy arrays of the column as a tuple of (data, offsets,
+        present), being views of the data and offsets as uint8 and
+        uint64, and a bool array of the rows with the field.
+
+        """
+        try:
+            import numpy # not imported with the module, to start faster
+        except ImportError:
+            raise ValueError('NumPy is not installed') from None
+        present = numpy.unpackbits(
+            numpy.frombuffer(self.present, numpy.uint8), bitorder='little'
+        )
+        return (
+            numpy.frombuffer(self.data, numpy.uint8),
+            numpy.frombuffer(self.offsets, numpy.uint64),
+            present[:len(self)].astype(bool),
+        )
+
+class ColumnTable:
+    """
+    Table of records in columns, a Column for every field found in
+    any record, including the type, UID, custom header and footer
+    and freeform body, by their keys in records from mwlr_iter().
+    All columns have a row for every record.
+
+    Arguments
+    ---------
+    * in_format: dict or Format containing format specification
+       of the database file the records are from, used to serialise
+       multi-value fields as they were in the file
+
+    * encoding: encoding of the database file when read as text
+
+    """
+    __slots__ = ('columns', 'rows', 'in_format')
+
+    def __init__(self, in_format=FORMAT_DEFAULT, encoding=ENCODING_DEFAULT):
+        self.columns = {} # field name: Column
+        self.rows = 0
+        self.in_format = as_format(in_format, encoding)
+
+    def __len__(self):
+        return self.rows
+
+    def __getitem__(self, name):
+        return self.columns[name]
+
+    def add(self, d):
+        """
+        Add a record from dict 'd' as a row. Multi-value fields are
+        added in serialised form (see multi_val_str()), in the format
+        of 'in_format', while sub-records are left out.
+
+        """
+        fmt = self.in_format
+        row = self.rows
+        for k, v in d.items():
+            if type(v) is dict:
+                if TYPE_KEY in v or HEADER_KEY in v: continue # sub-record
+                v = multi_val_str(v, fmt.vsep, fmt.sfsep, escape=fmt.escape)
+            col = self.columns.get(k)
+            if col is None: col = self.columns[k] = Column(k)
+            col.append(str(v), row)
+        self.rows += 1
+
+    def finish(self):
+        """Add missing rows to the end of columns that are short"""
+        for col in self.columns.values():
+            if len(col) < self.rows: col.append(None, self.rows - 1)
+
+    def row(self, i):
+        """Return row 'i' as a dict, without missing fields"""
+        out = {}
+        for k, col in self.columns.items():
+            v = col[i]
+            if v is not None: out[k] = v
+        return out
+
+def mwlr_columns(
+        f,
+        encoding=ENCODING_DEFAULT,
+        in_format=FORMAT_DEFAULT,
+        header=None,
+        footer=None,
+        depth=1,
+        size=DEFAULT_BUFFER_SIZE,
+        only=None
+    ):
+    """
+    Return a ColumnTable of the records from a binary file object 'f'
+    of an MWLR database, read in a single pass. Records are added as
+    they are read, without a list of the records being kept.
+
+    The arguments are the same as those of mwlr_iter(); with 'only',
+    only the named fields (and the type and UID) are read and
+    have columns.
+
+    """
+    table = ColumnTable(in_format, encoding)
+    for d in mwlr_iter(
+            f, encoding, in_format, header, footer, depth, size, only
+        ):
+        table.add(d)
+    table.finish()
+    return table
+
+def index_path(fpath):
+    """Return the path to the sidecar index file of a database file"""
+    return ''.join((fpath, INDEX_SUFFIX))
+
+def file_checksum(fpath, size=INDEX_SAMPLE_BYTES):
+    """
+    Return a CRC-32 checksum of the first and last 'size' bytes of
+    the file at 'fpath', for telling if the file has changed.
+
+    """
+    with open(fpath, mode='rb') as f:
+        crc = zlib.crc32(f.read(size))
+        f.seek(0, os.SEEK_END)
+        f.seek(max(size, f.tell() - size))
+        return zlib.crc32(f.read(size), crc)
+
+class MWLRIndex:
+    """
+    Table of records in an MWLR database file, with the UID, type and
+    byte offsets of each record, and the values of selected fields.
+
+    Offsets are for the start of the first line and the end of the
+    last line of a record, without its EOL. Records with custom headers
+    have no type.
+
+    Indexes may be saved to a binary sidecar file, which records the
+    size, modification time and checksum of the database file, so that
+    stale indexes are detected when loaded.
+
+    Arguments
+    ---------
+    * fields: names of fields to index the values of
+
+    """
+    def __init__(self, fields=()):
+        self.fields = tuple(fields)
+        self.records = [] # (uid, type, start offset, end offset)
+        self.record_values = [] # field values, in order of fields
+        self.uids = {} # uid: position in records
+        self.values = {} # (field name, value): positions in records
+
+    def __len__(self):
+        return len(self.records)
+
+    def add(self, uid, rtype, start, end=None, values=None):
+        """
+        Add a record to the index, returning its position. Values
+        of indexed fields are taken from dict 'values'.
+
+        """
+        i = len(self.records)
+        vals = tuple((values or {}).get(k) for k in self.fields)
+        self.records.append((uid, rtype, start, end))
+        self.record_values.append(vals)
+        if uid is not None: self.uids[uid] = i
+        for k, v in zip(self.fields, vals):
+            if v is not None: self.values.setdefault((k, v), []).append(i)
+        return i
+
+    def set_end(self, i, end):
+        """Set the end offset of the record at position 'i'"""
+        self.records[i] = self.records[i][:3] + (end,)
+
+    def splice(self, i, j, records, values=None):
+        """
+        Replace the records at positions 'i' up to 'j' with 'records',
+        a list of (uid, type, start offset, end offset). Values of
+        indexed fields are taken from a list of dicts 'values', one
+        for each record. Only the entries of the records replaced are
+        changed, and the positions of records after them shifted.
+
+        """
+        if values is None: values = [None] * len(records)
+        vals = [tuple((v or {}).get(k) for k in self.fields) for v in values]
+        old = self.records[i:j]
+        old_vals = self.record_values[i:j]
+        self.records[i:j] = records
+        self.record_values[i:j] = vals
+        shift = len(records) - (j - i)
+        uids = self.uids
+        for x in old:
+            if x[0] is not None and i <= uids.get(x[0], -1) < j:
+                del uids[x[0]]
+        if shift:
+            for k, n in uids.items():
+                if n >= j: uids[k] = n + shift
+        for n, x in enumerate(records, i):
+            if x[0] is not None: uids[x[0]] = n
+        if not self.fields: return
+        # Positions of each value are kept in order, so that those of
+        # the old records can be found, and those after them shifted,
+        # by bisection
+        index = self.values
+        for n, x in enumerate(old_vals, i):
+            for key in zip(self.fields, x):
+                if key[1] is None: continue
+                found = index[key]
+                del found[bisect_left(found, n)]
+                if not found: del index[key]
+        if shift:
+            for found in index.values():
+                for a in range(bisect_left(found, j), len(found)):
+                    found[a] += shift
+        for n, x in enumerate(vals, i):
+            for key in zip(self.fields, x):
+                if key[1] is not None: insort(index.setdefault(key, []), n)
+
+    def find(self, field, value):
+        """Return positions of records where 'field' equals 'value'"""
+        return self.values.get((field, value), [])
+
+    def save(self, fpath, src_fpath):
+        """
+        Write the index to a sidecar file at 'fpath', for the database
+        file at 'src_fpath'.
+
+        """
+        st = os.stat(src_fpath)
+        out = [
+            INDEX_MAGIC,
+            struct.pack(
+                '<QqIHQ', st.st_size, st.st_mtime_ns,
+                file_checksum(src_fpath), len(self.fields),
+                len(self.records)
+            ),
+        ]
+        out.extend(map(index_str_bytes, self.fields))
+        for rec, vals in zip(self.records, self.record_values):
+            out.append(struct.pack('<QQ', rec[2], rec[3]))
+            out.append(index_str_bytes(rec[0]))
+            out.append(index_str_bytes(rec[1]))
+            out.extend(map(index_str_bytes, vals))
+        with open(fpath, mode='wb') as f: f.write(b''.join(out))
+
+    @classmethod
+    def load(cls, fpath, src_fpath, fields=None):
+        """
+        Return an index loaded from a sidecar file at 'fpath' for the
+        database file at 'src_fpath'. Returns None if there is no
+        sidecar file, or if it is stale or damaged, or if 'fields' are
+        specified and differ from those in the sidecar.
+
+        """
+        try:
+            with open(fpath, mode='rb') as f: b = f.read()
+            st = os.stat(src_fpath)
+        except OSError:
+            return None
+        if not b.startswith(INDEX_MAGIC): return None
+        try:
+            size, mtime, crc, nfields, nrecs = struct.unpack_from(
+                '<QqIHQ', b, len(INDEX_MAGIC)
+            )
+            if (size, mtime) != (st.st_size, st.st_mtime_ns): return None
+            if crc != file_checksum(src_fpath): return None
+            i = len(INDEX_MAGIC) + struct.calcsize('<QqIHQ')
+            names = []
+            for _ in range(nfields):
+                x, i = index_str_from(b, i)
+                names.append(x)
+            if fields is not None and tuple(fields) != tuple(names):
+                return None
+            out = cls(names)
+            for _ in range(nrecs):
+                start, end = struct.unpack_from('<QQ', b, i)
+                uid, i = index_str_from(b, i + 16)
+                rtype, i = index_str_from(b, i)
+                vals = []
+                for _ in range(nfields):
+                    x, i = index_str_from(b, i)
+                    vals.append(x)
+                out.add(uid, rtype, start, end, dict(zip(names, vals)))
+        except (struct.error, UnicodeDecodeError):
+            return None
+        return out
+
+def index_str_bytes(s):
+    """Return str or None 's' in sidecar index file form"""
+    if s is None: return struct.pack('<I', INDEX_NONE_LEN)
+    b = bytes(s, encoding=INDEX_ENCODING)
+    return b''.join((struct.pack('<I', len(b)), b))
+
+def index_str_from(b, i):
+    """
+    Return a str or None in sidecar index file form from bytes 'b'
+    at offset 'i', and the offset of the next item.
+
+    """
+    n = struct.unpack_from('<I', b, i)[0]
+    i += 4
+    if n == INDEX_NONE_LEN: return None, i
+    if i + n > len(b): raise struct.error('string beyond end of index')
+    return str(b[i:i+n], encoding=INDEX_ENCODING), i + n
+
+class LazyRecord(Mapping):
+    """
+    Read-only record of an MWLR database that keeps a memoryview of the
+    record's bytes instead of decoded values, for keeping large numbers
+    of records in memory for lookup.
+
+    The record is scanned once when created, and only the kind and
+    offsets of each field, sub-record and freeform body are kept, in
+    an array. Values are decoded, unfolded and have newlines
+    translated back every time they are read, and sub-records are
+    returned as LazyRecords. to_dict() returns the same dict as
+    mwlr_iter() would for the record on its own, and LazyRecords
+    compare equal to such dicts.
+
+    Sub-records without a UID are under a key made from their offset
+    in the record, which stays the same for every lookup, in place of
+    the random UID given to them every time a file is read.
+
+    Records must be smaller than 4 GiB. A memory-mapped file stays
+    mapped while LazyRecords of it remain; see
+    MWLRReader.pending_maps.
+
+    Arguments
+    ---------
+    * buf: bytes-like object containing the record, from its BEGIN
+       line or custom header to its END line or the end of its footer,
+       without an EOL after it
+
+    * encoding: encoding of the database file when read as text
+
+    * in_format: dict or Format containing format specification
+       of the database file; see mwlr_iter()
+
+    * footer: the custom footer of records with custom headers; see
+       mwlr_iter()
+
+    """
+    __slots__ = ('_mv', '_fields', '_fmt', '_footer')
+    # Kinds of entries in _fields, each of which is (kind, start of
+    # line, separator or end of first line, end of last line); the
+    # entries of sub-records have the separator of their UID line,
+    # or zero, instead of a separator
+    _TYPE, _HEADER, _VALUE, _MULTI, _UID, _RECORD, _BODY = range(7)
+
+    def __init__(
+            self,
+            buf,
+            encoding=ENCODING_DEFAULT,
+            in_format=FORMAT_DEFAULT,
+            footer=None
+        ):
+        mv = memoryview(buf)
+        self._mv = mv if mv.format == 'B' else mv.cast('B')
+        self._fmt = as_format(in_format, encoding)
+        self._footer = footer
+        self._fields = array('H' if len(mv) < 0x10000 else 'I')
+        self._scan()
+
+    def _scan(self):
+        mv = self._mv
+        fmt = self._fmt
+        enc = lambda s: bytes(s, encoding=fmt.encoding)
+        byeol = fmt.byeol
+        sol = fmt.bysol
+        eolsol = b''.join((byeol, sol))
+        fsep = fmt.byfsep
+        fmsep = fmt.byfmsep
+        bybegin = b''.join((enc(BEGIN_MARK), fsep))
+        byend = b''.join((enc(END_MARK), fsep))
+        byuid = enc(UID_KEY)
+        bydead = enc(DEAD_TYPE)
+        lines = []
+        i = 0
+        for m in re.finditer(re.escape(byeol), mv):
+            lines.append((i, m.start()))
+            i = m.end()
+        lines.append((i, len(mv)))
+        n = len(lines)
+        fields = self._fields
+
+        def logical(i, foldable):
+            # Return the position of the last line of the logical line
+            # at i, and the line unfolded
+            j = i
+            if foldable and sol:
+                while j + 1 < n and mv[lines[j+1][0]:][:len(sol)] == sol:
+                    j += 1
+            ln = bytes(mv[lines[i][0]:lines[j][1]])
+            if j > i: ln = ln.replace(eolsol, b'')
+            return j, ln
+
+        def walk(i, rtype, out):
+            # Walk the lines of the record of type 'rtype' (None for
+            # custom headers) after its first line at i, returning the
+            # position of its last line and the separator of its UID
+            # line; entries of its fields are added to 'out' if it is
+            # not None
+            body = None
+            last = n - 1
+            uid = 0
+            i += 1
+            while i < n:
+                j, ln = logical(i, body is None)
+                if rtype is not None and ln.startswith(byend) \
+                        and ln[len(byend):] == rtype:
+                    last = j
+                    break
+                if body is not None:
+                    i = j + 1
+                    continue
+                start = lines[i][0]
+                if ln.startswith(bybegin):
+                    sub = ln[len(bybegin):]
+                    k, sub_uid = walk(j, sub, None)
+                    if out is not None and sub != bydead:
+                        out.extend(
+                            (self._RECORD, start, sub_uid, lines[k][1])
+                        )
+                    i = k + 1
+                    continue
+                if ln.startswith(byend):
+                    raise ValueError(
+                        f'unexpected record end: {str(ln, fmt.encoding)}'
+                    )
+                seps = [
+                    x for x in (ln.find(fsep), ln.find(fmsep)) if x >= 0
+                ]
+                end = lines[j][1]
+                if not seps or min(seps) == 0:
+                    body = len(out) if out is not None else 0
+                    if out is not None:
+                        out.extend((self._BODY, start, end, end))
+                else:
+                    k = min(seps)
+                    kind = self._MULTI
+                    if ln.startswith(fsep, k):
+                        kind = self._VALUE
+                        if ln[:k].upper() == byuid:
+                            kind = self._UID
+                            uid = start + k
+                    if out is not None:
+                        out.extend((kind, start, start + k, end))
+                i = j + 1
+            else:
+                if rtype is not None:
+                    raise ValueError(
+                        f'record {str(rtype, fmt.encoding)} has no end'
+                    )
+            if body is not None and out is not None:
+                out[body+3] = lines[i-1][1]
+            return last, uid
+
+        j, ln = logical(0, True)
+        if ln.startswith(bybegin):
+            fields.extend((self._TYPE, len(bybegin), 0, lines[j][1]))
+            walk(j, ln[len(bybegin):], fields)
+        else:
+            fields.extend((self._HEADER, 0, 0, lines[j][1]))
+            walk(j, None, fields)
+        walk = None # free the lines now, not on garbage collection
+
+    def _bytes(self, start, end):
+        # Return the bytes from start to end, unfolded
+        fmt = self._fmt
+        b = bytes(self._mv[start:end])
+        if fmt.bysol: b = b.replace(b''.join((fmt.byeol, fmt.bysol)), b'')
+        return b
+
+    def _str(self, start, end):
+        return str(self._bytes(start, end), encoding=self._fmt.encoding)
+
+    def _entries(self, *kinds):
+        f = self._fields
+        for i in range(0, len(f), 4):
+            if f[i] in kinds: yield f[i:i+4]
+
+    def _value(self, kind, start, sep, end):
+        fmt = self._fmt
+        if kind == self._MULTI:
+            return multi_val_dict(
+                self._str(sep + len(fmt.byfmsep), end),
+                fmt.vsep,
+                fmt.sfsep,
+                fmt.escape,
+            )
+        val = self._str(sep + len(fmt.byfsep), end)
+        if fmt.newline: val = val.replace(fmt.newline, '\n')
+        return val
+
+    def _name(self, start, sep):
+        return str(self._mv[start:sep], encoding=self._fmt.encoding)
+
+    def _sub(self, start, end):
+        return LazyRecord(self._mv[start:end], in_format=self._fmt)
+
+    def _sub_uid(self, start, sep):
+        # Return the UID of the sub-record at offset 'start' from the
+        # separator of its UID line, or a key made from the offset, in
+        # the form of a random UID, if it has none
+        if not sep: return f'{start:040x}'
+        mv = self._mv
+        fmt = self._fmt
+        eol = re.compile(re.escape(fmt.byeol))
+        sol = fmt.bysol
+        end = sep
+        while True:
+            m = eol.search(mv, end)
+            if m is None:
+                end = len(mv)
+                break
+            end = m.start()
+            if not sol or mv[m.end():m.end()+len(sol)] != sol: break
+            end = m.end()
+        return self._value(self._UID, 0, sep, end)
+
+    def _body(self):
+        # Return the freeform body text, or None if there is none
+        fmt = self._fmt
+        byeol = fmt.byeol
+        for _, start, first, end in self._entries(self._BODY):
+            body = [self._bytes(start, first)]
+            if end > first:
+                rest = bytes(self._mv[first+len(byeol):end])
+                body.extend(rest.split(byeol))
+            if self.type is None and self._footer is not None:
+                footer = [
+                    bytes(x, encoding=fmt.encoding)
+                    for x in self._footer.split(fmt.eol)
+                ]
+                if body[-len(footer):] == footer: del body[-len(footer):]
+            text = str(byeol.join(body), encoding=fmt.encoding)
+            return text or None
+        return None
+
+    @property
+    def type(self):
+        """Type of the record, or None if it has a custom header"""
+        for kind, start, _, end in self._entries(self._TYPE):
+            return self._str(start, end)
+        return None
+
+    @property
+    def uid(self):
+        """UID of the record, or None"""
+        uid = None
+        for x in self._entries(self._UID): uid = self._value(*x)
+        return uid
+
+    def _subs(self):
+        # Iterator yielding (uid, start, end) of sub-records
+        for _, start, sep, end in self._entries(self._RECORD):
+            yield self._sub_uid(start, sep), start, end
+
+    def __getitem__(self, key):
+        if key == TYPE_KEY or key == HEADER_KEY:
+            kind = self._TYPE if key == TYPE_KEY else self._HEADER
+            for _, start, _, end in self._entries(kind):
+                return self._str(start, end)
+        elif key == UID_KEY:
+            uid = self.uid
+            if uid is not None: return uid
+        elif key == '':
+            body = self._body()
+            if body is not None: return body
+        elif key == FOOTER_KEY:
+            if self.type is None and self._footer is not None:
+                return self._footer
+        elif isinstance(key, str):
+            mv = self._mv
+            try:
+                bykey = bytes(key, encoding=self._fmt.encoding)
+            except UnicodeEncodeError:
+                raise KeyError(key) from None
+            found = None
+            for x in self._entries(self._VALUE, self._MULTI):
+                if mv[x[1]:x[2]] == bykey: found = x
+            if found is not None: return self._value(*found)
+            for uid, start, end in self._subs():
+                if uid == key: return self._sub(start, end)
+        raise KeyError(key)
+
+    def __iter__(self):
+        seen = set()
+        for kind, start, sep, end in self._entries(
+                self._TYPE, self._HEADER, self._VALUE, self._MULTI,
+                self._RECORD
+            ):
+            if kind == self._TYPE: key = TYPE_KEY
+            elif kind == self._HEADER: key = HEADER_KEY
+            elif kind == self._RECORD: key = self._sub_uid(start, sep)
+            else: key = self._name(start, sep)
+            if key not in seen: yield key
+            seen.add(key)
+        if self._body() is not None: yield ''
+        if self.type is None and self._footer is not None: yield FOOTER_KEY
+        if self.uid is not None: yield UID_KEY
+
+    def __len__(self):
+        return sum(1 for _ in self)
+
+    def __eq__(self, other):
+        if isinstance(other, LazyRecord): other = other.to_dict()
+        if not isinstance(other, Mapping): return NotImplemented
+        return self.to_dict() == dict(other)
+
+    def to_dict(self):
+        """Return the record as a dict, with sub-records as dicts"""
+        out = {}
+        for kind, start, sep, end in self._entries(
+                self._TYPE, self._HEADER, self._VALUE, self._MULTI,
+                self._RECORD
+            ):
+            if kind == self._TYPE: out[TYPE_KEY] = self._str(start, end)
+            elif kind == self._HEADER:
+                out[HEADER_KEY] = self._str(start, end)
+            elif kind == self._RECORD:
+                d = self._sub(start, end).to_dict()
+                d.pop(UID_KEY, None)
+                out[self._sub_uid(start, sep)] = d
+            else:
+                out[self._name(start, sep)] = self._value(
+                    kind, start, sep, end
+                )
+        body = self._body()
+        if body is not None: out[''] = body
+        if self.type is None and self._footer is not None:
+            out[FOOTER_KEY] = self._footer
+        uid = self.uid
+        if uid is not None: out[UID_KEY] = uid
+        return out
+
+class MWLRReader:
+    """
+    Random-access reader for MWLR database files.
+
+    The file is memory-mapped, and a table of records is built in a
+    single pass when the reader is created. Records are only decoded
+    when they are requested.
+
+    Records with BEGIN and END markers are indexed, including
+    sub-records, as are records with custom headers if 'header' is
+    set. Records are looked up by UID, or by the values of fields
+    in 'fields'; records without a UID remain in the table, but can
+    only be reached by position. Dead records are left out of the
+    table, and their offsets are kept in 'dead' instead. Records of
+    type REMOVED_TYPE in deltas are kept in the table like any other
+    record, as mwlr_iter() yields them.
+
+    Arguments
+    ---------
+    * fpath: path to the database file
+
+    * encoding: encoding of the database file when read as text
+
+    * in_format: dict or Format containing format specification
+       of the database file; see mwlr_iter()
+
+    * header, footer: custom header pattern and footer of records;
+       see mwlr_iter()
+
+    * fields: names of fields to index the values of; building an
+       index of field values requires all records to be decoded
+
+    * sidecar: if True, load the index from a sidecar file, building
+       and saving the index if the sidecar is missing or stale
+
+    """
+    def __init__(
+            self,
+            fpath,
+            encoding=ENCODING_DEFAULT,
+            in_format=FORMAT_DEFAULT,
+            header=None,
+            footer=None,
+            fields=(),
+            sidecar=False
+        ):
+        self.in_format = as_format(in_format, encoding)
+        self.encoding = self.in_format.encoding
+        self.header = header
+        self.footer = footer
+        self._file = open(fpath, mode='rb')
+        try:
+            self._mm = mmap.mmap(
+                self._file.fileno(), 0, access=mmap.ACCESS_READ
+            )
+        except ValueError:
+            self._mm = b'' # empty files cannot be mapped
+        self.index = None
+        self.dead = [] # (start offset, end offset) of dead records
+        if sidecar:
+            self.index = MWLRIndex.load(index_path(fpath), fpath, fields)
+        if self.index is None:
+            self.index = MWLRIndex(fields)
+            self._index()
+            if sidecar: self.index.save(index_path(fpath), fpath)
+        self.records = self.index.records
+        self.uids = self.index.uids
+        self._parents = None # innermost enclosing record of each record
+        self._pending = WeakSet() # maps kept open by LazyRecords
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def __len__(self):
+        return len(self.records)
+
+    def _index(self):
+        enc = lambda s: bytes(s, encoding=self.encoding)
+        byeol = self.in_format.byeol
+        bysol = self.in_format.bysol
+        fsep = self.in_format.byfsep
+        byuid = b''.join((enc(UID_KEY), fsep))
+        marks = b''.join((
+            b'(', re.escape(enc(BEGIN_MARK)),
+            b'|', re.escape(enc(END_MARK)), b')',
+            re.escape(fsep), b'(.*?)(?=', re.escape(byeol), br'|\Z)'
+        ))
+        mm = self._mm
+        ms = chain(
+            (m for m in (re.match(marks, mm, re.DOTALL),) if m),
+            re.finditer(b''.join((re.escape(byeol), marks)), mm, re.DOTALL)
+        )
+        stack = []
+        found = []
+
+        def uid_at(i):
+            if mm[i:i+len(byuid)] != byuid: return None
+            return self._unfold(i + len(byuid), byeol, bysol)
+
+        for m in ms:
+            mark, rtype = m.group(1, 2)
+            if mark == enc(BEGIN_MARK):
+                uid = uid_at(m.end() + len(byeol))
+                stack.append((uid, rtype, m.start(1), len(found)))
+                found.append(None)
+            elif stack and stack[-1][1] == rtype:
+                uid, rtype, start, i = stack.pop()
+                rtype = str(rtype, encoding=self.encoding)
+                found[i] = (uid, rtype, start, m.end(2))
+        if stack:
+            rtype = str(stack[-1][1], encoding=self.encoding)
+            raise ValueError(f'record {rtype} has no end')
+        if self.header is not None:
+            # Custom headers only count as record starts after a footer
+            hpat = self.header
+            if type(hpat) is str: hpat = enc(hpat)
+            elif type(hpat) is not bytes: hpat = hpat.pattern
+            hpat = b''.join((
+                b'(?:\\A|(?<=', re.escape(byeol), b'))(?:', hpat, b')'
+            ))
+            tail = None
+            if self.footer is not None:
+                tail = b''.join((byeol, enc(self.footer), byeol))
+            starts = []
+            for m in re.finditer(hpat, mm):
+                i = m.start()
+                if starts and tail and mm[max(0, i-len(tail)):i] != tail:
+                    continue
+                starts.append(i)
+            ends = [x - len(byeol) for x in starts[1:]]
+            ends.append(len(mm))
+            for start, end in zip(starts, ends):
+                i = mm.find(byeol, start)
+                uid = uid_at(i + len(byeol)) if i >= 0 else None
+                found.append((uid, None, start, end))
+        found.sort(key=lambda x: x[2])
+        for uid, rtype, start, end in found:
+            if rtype == DEAD_TYPE:
+                self.dead.append((start, end))
+                continue
+            vals = None
+            if self.index.fields:
+                vals = self._parse(start, end, rtype)
+            self.index.add(uid, rtype, start, end, vals)
+
+    def _unfold(self, i, byeol, bysol):
+        # Return the decoded line starting from offset i, joining
+        # any continuation lines
+        mm = self._mm
+        parts = []
+        while True:
+            j = mm.find(byeol, i)
+            if j < 0: j = len(mm)
+            parts.append(mm[i:j])
+            i = j + len(byeol)
+            if not bysol or mm[i:i+len(bysol)] != bysol: break
+            i += len(bysol)
+        return str(b''.join(parts), encoding=self.encoding)
+
+    def _parse(self, start, end, rtype, only=None):
+        f = BytesIO(self._mm[start:end])
+        if rtype is not None:
+            return next(mwlr_iter(
+                f, self.encoding, self.in_format, only=only
+            ))
+        return next(mwlr_iter(
+            f, self.encoding, self.in_format, self.header, self.footer,
+            only=only
+        ))
+
+    def close(self):
+        self._close_map(self._mm)
+        self._mm = None
+        self._file.close()
+
+    def _close_map(self, mm):
+        # Close memory map 'mm', or if LazyRecords still have views of
+        # it, keep it as pending; it is unmapped when the last of them
+        # is deleted
+        if type(mm) is not mmap.mmap: return
+        try:
+            mm.close()
+        except BufferError:
+            self._pending.add(mm)
+
+    @property
+    def pending_maps(self):
+        """
+        Number of memory maps of the file left open after the reader
+        was closed, or the file was mapped again, as LazyRecords from
+        them remain; each is unmapped once its LazyRecords are deleted.
+
+        """
+        return len(self._pending)
+
+    def _record_at(self, i):
+        # Return the position of the innermost record containing the
+        # byte at offset i, or None
+        recs = self.records
+        if self._parents is None:
+            self._starts = [x[2] for x in recs]
+            self._parents = []
+            stack = []
+            for j, (_, _, _, end) in enumerate(recs):
+                while stack and recs[stack[-1]][3] < end: stack.pop()
+                self._parents.append(stack[-1] if stack else -1)
+                stack.append(j)
+        j = bisect_right(self._starts, i) - 1
+        while j >= 0 and recs[j][3] <= i: j = self._parents[j]
+        return j if j >= 0 else None
+
+    def _candidates(self, field, op, value):
+        # Return the set of positions of records that may meet a query
+        # condition, from a search of the raw bytes, or None if all
+        # records may. Field values split over continuation lines are
+        # not missed, as records with the field's first line broken
+        # are included. Types are found on BEGIN lines, while other
+        # reserved names, and UIDs, which need not be on lines of
+        # their own, are not searched for.
+        if field in (HEADER_KEY, FOOTER_KEY) or field.upper() == UID_KEY:
+            return None
+        if not field: return None
+        fmt = self.in_format
+        enc = lambda s: bytes(s, encoding=self.encoding)
+        byeol = re.escape(fmt.byeol)
+        line = b''.join((b'(?:\\A|', byeol, b')'))
+        name = enc(field)
+        if field == TYPE_KEY:
+            if op not in ('==', 'startswith') or type(value) is not str:
+                return None
+            if not value: return None # records without a BEGIN line
+            name = enc(BEGIN_MARK)
+        prefix = b''.join((name, fmt.byfsep))
+        pats = []
+        if op in ('==', 'startswith', 'contains') and type(value) is str:
+            if fmt.newline is not None:
+                value = value.replace('\n', fmt.newline)
+            v = enc(value)
+            room = fmt.width - len(fmt.byeol) - len(prefix)
+            lead = None # start of the value where it may be broken up
+            if op == 'contains':
+                pats.append(re.escape(v))
+                lead = b''
+            else:
+                pats.append(b''.join((line, re.escape(prefix + v))))
+                if op == '==':
+                    pats[-1] = b''.join((pats[-1], b'(?=', byeol, b'|\\Z)'))
+                k = max(0, room - 3) # bytes always on the first line
+                if len(v) > k: lead = v[:k]
+            if fmt.bysol and room > 0 and lead is not None:
+                # field lines broken up to fit the width
+                n = room - len(lead)
+                pats.append(b''.join((
+                    line, re.escape(prefix + lead),
+                    b'.{%d,%d}' % (max(0, n - 3), n),
+                    byeol, re.escape(fmt.bysol)
+                )))
+        else:
+            pats.append(b''.join((
+                line, re.escape(name),
+                b'(?:', re.escape(fmt.byfsep), b'|', re.escape(fmt.byfmsep),
+                b')'
+            )))
+        out = set()
+        for m in re.finditer(b'|'.join(pats), self._mm, re.DOTALL):
+            i = self._record_at(m.end() - 1)
+            if i is not None: out.add(i)
+        return out
+
+    def query(self, where, only=None, offsets=False):
+        """
+        Iterator yielding records that meet all conditions in 'where',
+        in the order they appear in the file.
+
+        Candidate records are first found by searching the file for
+        the encoded field names and values, and only the candidates
+        are decoded to check the conditions. A condition is met by
+        the innermost record that contains the field, so sub-records
+        are yielded on their own when conditions are on their fields.
+
+        Arguments
+        ---------
+        * where: list of (field, op, value) conditions, where 'op' is
+           one of the names in QUERY_OPS, to compare a field's value
+           with 'value' (e.g. ('Subject', 'contains', 'refund')), or
+           a function of the field's value and 'value' returning True
+           if the condition is met. Records without the field never
+           meet the condition, nor do multi-value fields unless 'op'
+           is a function.
+
+        * only: names of the fields to read; see mwlr_iter(). The
+           fields in 'where' are also read.
+
+        * offsets: if True, yield the (uid, type, start, end) entries
+           of records from the index instead of records
+
+        """
+        tests = []
+        for field, op, value in where:
+            fn = op if callable(op) else QUERY_OPS.get(op)
+            if fn is None: raise ValueError(f'unknown query operator {op}')
+            tests.append((field, fn, callable(op), value))
+        found = None
+        for field, op, value in where:
+            x = self._candidates(field, op, value)
+            if x is None: continue
+            found = x if found is None else found & x
+        if found is None: found = range(len(self.records))
+        # Candidates are checked with only the fields in conditions read
+        names = {x[0] for x in where}
+        for i in sorted(found):
+            _, rtype, start, end = self.records[i]
+            rec = self._parse(start, end, rtype, names)
+            for field, fn, any_type, value in tests:
+                v = rec.get(field)
+                if v is None or not (any_type or type(v) is str): break
+                if not fn(v, value): break
+            else:
+                if offsets:
+                    yield self.records[i]
+                elif only is None or not names.issuperset(only):
+                    yield self._parse(start, end, rtype, only)
+                else:
+                    yield rec
+
+    def find(self, field, value, only=None):
+        """
+        Return a list of records where field 'field' equals 'value',
+        as dicts; 'field' must be in the indexed fields. If 'only' is
+        set, only the fields named in it are read; see mwlr_iter().
+
+        """
+        if field not in self.index.fields:
+            raise KeyError(f'field {field} is not indexed')
+        return [
+            self._parse(*self.records[i][2:], self.records[i][1], only)
+            for i in self.index.find(field, value)
+        ]
+
+    def record_bytes(self, uid):
+        """
+        Return the bytes of the record with UID 'uid', from the start
+        of its first line to the end of its last line.
+
+        """
+        _, _, start, end = self.records[self.uids[uid]]
+        return self._mm[start:end]
+
+    def record(self, uid, only=None):
+        """
+        Return the record with UID 'uid' as a dict, including any
+        sub-records. The UID is under the UID key. If 'only' is set,
+        only the fields named in it are read; see mwlr_iter().
+
+        """
+        _, rtype, start, end = self.records[self.uids[uid]]
+        return self._parse(start, end, rtype, only)
+
+    def lazy(self, uid):
+        """
+        Return the record with UID 'uid' as a LazyRecord, backed by the
+        memory-mapped file. The file remains mapped after the reader is
+        closed, until the last LazyRecord from it is deleted; see
+        'pending_maps'. Records from an MWLRStore are not valid after
+        it is changed.
+
+        """
+        _, _, start, end = self.records[self.uids[uid]]
+        return LazyRecord(
+            memoryview(self._mm)[start:end], in_format=self.in_format,
+            footer=self.footer
+        )
+
+def dead_record(size, out_format=FORMAT_DEFAULT):
+    """
+    Return the bytes of a dead record of exactly 'size' bytes without
+    a trailing EOL, for taking up the space of a deleted record, or
+    None if no dead record can be made that size. Dead records are
+    skipped by readers.
+
+    """
+    fmt = as_format(out_format)
+    enc = lambda s: bytes(s, encoding=fmt.encoding)
+    byeol = fmt.byeol
+    begin = enc(''.join((BEGIN_MARK, fmt.fsep, DEAD_TYPE)))
+    end = enc(''.join((END_MARK, fmt.fsep, DEAD_TYPE)))
+    pad = enc(''.join((PAD_KEY, fmt.fsep)))
+    room = size - len(begin) - len(byeol) - len(end)
+    line_min = len(pad) + len(byeol)
+    out = [begin, byeol]
+    while room:
+        n = min(room, fmt.width)
+        if 0 < room - n < line_min: n = room - line_min
+        if n < line_min: return None # also if room is negative
+        out.extend((pad, b'-' * (n - line_min), byeol))
+        room -= n
+    out.append(end)
+    return b''.join(out)
+
+class MWLRStore(MWLRReader):
+    """
+    MWLR database file with records that may be updated or deleted
+    without rewriting the rest of the file.
+
+    An updated record is rewritten in place if it fits in the space of
+    the old one, with a dead record taking up any space left over.
+    Otherwise, the new record is appended to the end of the file, or
+    inside its parent record if the parent is the last record in the
+    file, and the old record is turned into a dead record; failing
+    that, the file is compacted with the new record in place of the
+    old one. Deleted records are turned into dead records.
+
+    Dead records are skipped by readers. The file is compacted once
+    'dead_bytes' reaches 'compact_ratio' of the file size, removing
+    dead records and their EOLs.
+
+    Only records with BEGIN and END markers and a UID may be changed.
+    The index and the table of dead records are patched after every
+    change for the records changed only, while compaction rebuilds
+    them from a scan of the file, without decoding any records.
+
+    Arguments
+    ---------
+    * fpath: path to the database file
+
+    * encoding: encoding of the database file when read as text
+
+    * in_format: dict or Format containing format specification of
+       the database file, also used for writing records
+
+    * compact_ratio: ratio of dead space to file size at which the
+       file is compacted after a change; if None, the file is only
+       compacted when compact() is called
+
+    """
+    def __init__(
+            self,
+            fpath,
+            encoding=ENCODING_DEFAULT,
+            in_format=FORMAT_DEFAULT,
+            compact_ratio=STORE_COMPACT_RATIO
+        ):
+        self.fpath = fpath
+        self.compact_ratio = compact_ratio
+        super().__init__(fpath, encoding, in_format)
+        self.dead_bytes = self._dead_size(self.dead)
+
+    def _dead_size(self, dead):
+        # Return the number of bytes taken up by dead records 'dead'
+        # and their EOLs
+        neol = len(self.in_format.byeol)
+        return sum(end - start + neol for start, end in dead)
+
+    def _remap(self):
+        # Map the file again after it has grown
+        mm = self._mm
+        self._mm = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        self._close_map(mm)
+
+    def _patch(self, i, start, end, records=(), dead=()):
+        # Replace the record at position 'i', which takes up offsets
+        # 'start' to 'end', and its sub-records in the index with
+        # 'records', and dead records in its space with 'dead', then
+        # compact the file if there is enough dead space
+        recs = self.records
+        j = i + 1
+        while j < len(recs) and recs[j][2] < end: j += 1
+        self.index.splice(i, j, list(records))
+        a = bisect_left(self.dead, (start,))
+        z = bisect_left(self.dead, (end,))
+        self.dead_bytes += self._dead_size(dead) - self._dead_size(
+            self.dead[a:z]
+        )
+        self.dead[a:z] = dead
+        self._parents = None
+        ratio = self.compact_ratio
+        if ratio is not None and self.dead_bytes > ratio * len(self._mm):
+            self.compact()
+
+    def _write_at(self, i, b):
+        with open(self.fpath, mode='r+b') as f:
+            f.seek(i)
+            f.write(b)
+
+    def _span(self, uid):
+        # Return the position, type and offsets of the record with
+        # UID 'uid'
+        i = self.uids[uid]
+        _, rtype, start, end = self.records[i]
+        if rtype is None:
+            raise ValueError('records with custom headers cannot be changed')
+        return i, rtype, start, end
+
+    def compact(self, replace=None):
+        """
+        Rewrite the file without dead records. Records may also be
+        replaced by passing a dict of bytes by (start, end) offsets
+        as 'replace'; records replaced by empty bytes are removed.
+
+        """
+        byeol = self.in_format.byeol
+        neol = len(byeol)
+        mm = self._mm
+        replace = replace or {}
+        cuts = [(start, end, v) for (start, end), v in replace.items()]
+        cuts.extend(
+            (start, end, b'') for start, end in self.dead
+            if not any(a <= start and end <= b for a, b in replace)
+        )
+        cuts.sort()
+        tmp = ''.join((self.fpath, '.tmp'))
+        with open(tmp, mode='wb') as f:
+            i = 0
+            for start, end, b in cuts:
+                if not b:
+                    # remove the EOL before the record, or the one after
+                    # the record if it is at the start of the file
+                    if start >= neol: start -= neol
+                    elif mm[end:end+neol] == byeol: end += neol
+                f.write(mm[i:start])
+                f.write(b)
+                i = end
+            f.write(mm[i:])
+        self.close()
+        os.replace(tmp, self.fpath)
+        pending = self._pending
+        super().__init__(self.fpath, self.encoding, self.in_format)
+        self._pending.update(pending)
+        self.dead_bytes = self._dead_size(self.dead)
+
+    def delete(self, uid):
+        """Delete the record with UID 'uid', and its sub-records"""
+        i, _, start, end = self._span(uid)
+        b = dead_record(end - start, self.in_format)
+        if b is None:
+            self.compact({(start, end): b''})
+            return
+        self._write_at(start, b)
+        self._patch(i, start, end, dead=[(start, end)])
+
+    def update(self, uid, d):
+        """
+        Replace the record with UID 'uid' with dict 'd', which must
+        have a type.
+
+        """
+        fmt = self.in_format
+        byeol = fmt.byeol
+        i, _, start, end = self._span(uid)
+        if not d.get(TYPE_KEY):
+            raise ValueError('records in a store must have a type')
+        index = MWLRIndex()
+        b = imwlrdb(d, uid, out_format=fmt, index=index, offset=start)
+        pad = None
+        if len(b) == end - start:
+            pad = b''
+        elif len(b) < end - start:
+            pad = dead_record(end - start - len(b) - len(byeol), fmt)
+            if pad is not None: pad = b''.join((byeol, pad))
+        if pad is not None:
+            self._write_at(start, b''.join((b, pad)))
+            dead = [(start + len(b) + len(byeol), end)] if pad else []
+            self._patch(i, start, end, index.records, dead)
+            return
+        # Find the parent record, that with the latest start of all
+        # those that enclose the record
+        parent = None
+        for _, rtype, p_start, p_end in self.records:
+            if p_start >= start: break
+            if p_end >= end: parent = (rtype, p_start, p_end)
+        size = len(self._mm)
+        tail = size - (len(byeol) if self._mm[-len(byeol):] == byeol else 0)
+        outer = None
+        if parent is not None:
+            outer, p_start, p_end = parent
+            top = all(
+                not (x[2] < p_start and x[3] >= p_end) for x in self.records
+            )
+            if not (top and p_end == tail):
+                self.compact({(start, end): b})
+                return
+        dead = dead_record(end - start, fmt)
+        if dead is None:
+            self.compact({(start, end): b})
+            return
+        with open(self.fpath, mode='r+b') as f:
+            with MWLRWriter.append(
+                f, out_format=fmt, index=self.index, outer=outer
+            ) as w:
+                w.write(d, uid)
+        self._write_at(start, dead)
+        self._remap()
+        self._patch(i, start, end, dead=[(start, end)])
+
+class MWLRBlockReader:
+    """
+    Random-access reader for MWLR block containers written by
+    MWLRBlockWriter, decompressing only the blocks that are read.
+    The last block read is kept decompressed.
+
+    Top-level records may be looked up by UID if they begin a block.
+    Other records may be looked up by UID with a sidecar index, which
+    must be saved from the writer's index with index.save() to
+    index_path() of the container.
+
+    Arguments
+    ---------
+    * fpath: path to the container file
+
+    * encoding: encoding of the database when read as text
+
+    * in_format: dict or Format containing format specification
+       of the database; see mwlr_iter()
+
+    * header, footer: custom header pattern and footer of records;
+       see mwlr_iter()
+
+    * sidecar: if True, load the index from a sidecar file, if there
+       is one that is up to date
+
+    """
+    def __init__(
+            self,
+            fpath,
+            encoding=ENCODING_DEFAULT,
+            in_format=FORMAT_DEFAULT,
+            header=None,
+            footer=None,
+            sidecar=False
+        ):
+        self.in_format = as_format(in_format, encoding)
+        self.encoding = self.in_format.encoding
+        self.header = header
+        self.footer = footer
+        self._file = open(fpath, mode='rb')
+        try:
+            self._load_table()
+        except (struct.error, UnicodeDecodeError, ValueError):
+            self._file.close()
+            raise ValueError(f'{fpath} is not a block container')
+        self.index = None
+        if sidecar: self.index = MWLRIndex.load(index_path(fpath), fpath)
+        self._starts = [x[1] for x in self.blocks]
+        self._cached = (None, None) # position, bytes of last block read
+
+    def _load_table(self):
+        f = self._file
+        nmagic = len(BLOCK_MAGIC)
+        head = f.read(nmagic + 1)
+        if head[:nmagic] != BLOCK_MAGIC: raise ValueError
+        self.codec = BLOCK_CODECS[head[nmagic]]
+        ntrail = struct.calcsize('<QQ') + nmagic
+        size = f.seek(0, os.SEEK_END)
+        f.seek(size - ntrail)
+        trail = f.read(ntrail)
+        if trail[-nmagic:] != BLOCK_MAGIC: raise ValueError
+        table, nblocks = struct.unpack_from('<QQ', trail)
+        f.seek(table)
+        b = f.read(size - ntrail - table)
+        self.blocks = [] # (uid, offset, size, compressed offset, size)
+        self.uids = {} # uid of first record: position in blocks
+        i = 0
+        for n in range(nblocks):
+            start, bsize, cstart, csize = struct.unpack_from('<QQQQ', b, i)
+            uid, i = index_str_from(b, i + 32)
+            self.blocks.append((uid, start, bsize, cstart, csize))
+            if uid is not None: self.uids[uid] = n
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def __len__(self):
+        """Size of the uncompressed database"""
+        if not self.blocks: return 0
+        return self.blocks[-1][1] + self.blocks[-1][2]
+
+    def __iter__(self):
+        """Iterator yielding all records of the database as dicts"""
+        for i in range(len(self.blocks)): yield from self._records(i)
+
+    def _records(self, i, only=None):
+        # Iterator yielding the records of the block at position 'i'.
+        # Blocks other than the last end with the EOL before the next
+        # block, which is left out, lest it be read as part of a footer
+        b = self.block(i)
+        byeol = self.in_format.byeol
+        if i < len(self.blocks) - 1 and b.endswith(byeol):
+            b = b[:-len(byeol)]
+        return mwlr_iter(
+            BytesIO(b), self.encoding, self.in_format, self.header,
+            self.footer, only=only
+        )
+
+    def block(self, i):
+        """Return the uncompressed bytes of the block at position 'i'"""
+        if self._cached[0] == i: return self._cached[1]
+        _, _, size, cstart, csize = self.blocks[i]
+        self._file.seek(cstart)
+        b = block_decompress(self.codec, self._file.read(csize))
+        if len(b) != size: raise ValueError(f'block {i} is damaged')
+        self._cached = (i, b)
+        return b
+
+    def block_at(self, offset):
+        """Return the position of the block containing offset 'offset'"""
+        if not 0 <= offset < len(self):
+            raise IndexError(f'offset {offset} is out of range')
+        return bisect_right(self._starts, offset) - 1
+
+    def read(self, start=0, end=None):
+        """
+        Return bytes 'start' to 'end' of the uncompressed database,
+        or to the end if 'end' is None
+
+        """
+        if end is None: end = len(self)
+        end = min(end, len(self))
+        if start >= end: return b''
+        out = []
+        i = self.block_at(start)
+        while i < len(self.blocks) and self.blocks[i][1] < end:
+            b_start = self.blocks[i][1]
+            out.append(self.block(i)[start-b_start:end-b_start])
+            start = b_start + self.blocks[i][2]
+            i += 1
+        return b''.join(out)
+
+    def record(self, uid, only=None):
+        """
+        Return the record with UID 'uid' as a dict. If 'only' is set,
+        only the fields named in it are read; see mwlr_iter().
+
+        """
+        if self.index is not None and uid in self.index.uids:
+            _, _, start, end = self.index.records[self.index.uids[uid]]
+            return next(mwlr_iter(
+                BytesIO(self.read(start, end)), self.encoding,
+                self.in_format, self.header, self.footer, only=only
+            ))
+        if uid not in self.uids: raise KeyError(f'record {uid} not found')
+        return next(self._records(self.uids[uid], only))
+
+    def close(self):
+        self._file.close()
+
+def jsonl_records(f):
+    """
+    Iterator yielding dicts from JSON Lines text file object 'f', one
+    record for every line; blank lines are skipped.
+
+    """
+    for n, ln in enumerate(f, 1):
+        if not ln.strip(): continue
+        try:
+            d = json.loads(ln)
+        except ValueError as e:
+            raise ValueError(f'line {n}: {e}') from None
+        if type(d) is not dict:
+            raise ValueError(f'line {n}: not a JSON object')
+        yield d
+
+def main(argv=None):
+    """
+    Convert JSON Lines to MWLR, or MWLR to JSON Lines, as run by
+    "python -m imwlrdb"; see "python -m imwlrdb --help" for usage.
+    Return the exit status.
+
+    Records are converted as they are read, so that files of any size
+    may be converted in constant memory, and the standard input and
+    output may be used in pipelines. Records on each JSON line are
+    written with the UID under UID_KEY, if any.
+
+    Arguments
+    ---------
+    * argv: command line arguments, not including the program name;
+       sys.argv is used if omitted
+
+    """
+    p = ArgumentParser(
+        prog='python -m imwlrdb',
+        description='Convert JSON Lines to MWLR and back.',
+    )
+    p.add_argument(
+        'to', choices=('mwlr', 'jsonl'), help='format to convert to'
+    )
+    p.add_argument(
+        'input', nargs='?', default='-',
+        help='input file; the standard input if omitted or -'
+    )
+    p.add_argument(
+        '-o', '--output', default='-',
+        help='output file; the standard output if omitted or -'
+    )
+    p.add_argument(
+        '-j', '--jobs', type=int, default=1,
+        help='worker processes (0 for one per CPU); reading MWLR in '
+            'parallel needs an input file'
+    )
+    p.add_argument(
+        '--encoding', default=ENCODING_DEFAULT,
+        help=f'encoding of MWLR files; default: {ENCODING_DEFAULT}'
+    )
+    p.add_argument(
+        '--depth', type=int, default=1,
+        help='nesting level of MWLR records to read; see mwlr_iter()'
+    )
+    p.add_argument('--header', help='custom header pattern of records')
+    p.add_argument(
+        '--footer', help='custom footer of records; backslash escapes '
+            'allowed'
+    )
+    unescape = lambda x: bytes(x, 'utf8').decode('unicode_escape')
+    for k, v in FORMAT_DEFAULT.items():
+        opt = ''.join(('--', k.replace('_', '-')))
+        if type(v) is int:
+            p.add_argument(opt, type=int, help=f'default: {v}')
+        elif k in ('eol', 'sol'):
+            # line breaks and spaces are hard to pass on a command line
+            p.add_argument(
+                opt, type=unescape,
+                help=f'backslash escapes allowed; default: {v!r}'
+            )
+        else:
+            p.add_argument(opt, help=f'default: {v}')
+    args = p.parse_intermixed_args(argv)
+    spec = dict(FORMAT_DEFAULT)
+    spec.update(
+        (k, getattr(args, k)) for k in FORMAT_DEFAULT
+        if getattr(args, k) is not None
+    )
+    fmt = Format(spec, args.encoding)
+    footer = args.footer
+    if footer is not None: footer = unescape(footer)
+    jobs = args.jobs or None
+    stdin = args.input == '-'
+    stdout = args.output == '-'
+    def std_text(buffer):
+        # Read or write JSON Lines on a standard stream as UTF-8, like
+        # files, whatever the locale; the stream is detached and not
+        # closed once done
+        f = TextIOWrapper(buffer, encoding='utf8')
+        files.callback(f.detach)
+        return f
+
+    try:
+        with ExitStack() as files:
+            if args.to == 'mwlr':
+                if stdin:
+                    fin = std_text(sys.stdin.buffer)
+                else:
+                    fin = files.enter_context(
+                        open(args.input, encoding='utf8')
+                    )
+                fout = sys.stdout.buffer
+                if not stdout:
+                    fout = files.enter_context(open(args.output, 'wb'))
+                with MWLRWriter(fout, out_format=fmt) as w:
+                    w.write_all(jsonl_records(fin), jobs, uid_key=UID_KEY)
+            else:
+                if stdin:
+                    records = mwlr_iter(
+                        sys.stdin.buffer, fmt.encoding, fmt, args.header,
+                        footer, args.depth
+                    )
+                else:
+                    records = mwlr_parallel_iter(
+                        args.input, fmt.encoding, fmt, args.header, footer,
+                        args.depth, jobs=jobs
+                    )
+                if stdout:
+                    fout = std_text(sys.stdout.buffer)
+                else:
+                    fout = files.enter_context(
+                        open(args.output, 'w', encoding='utf8')
+                    )
+                for d in records:
+                    fout.write(json.dumps(d, ensure_ascii=False))
+                    fout.write('\n')
+            fout.flush()
+    except (OSError, ValueError) as e:
+        if isinstance(e, BrokenPipeError):
+            # output closed early, as by head(1); not an error
+            devnull = os.open(os.devnull, os.O_WRONLY)
+            os.dup2(devnull, sys.stdout.fileno())
+            return 0
+        p.exit(1, f'{p.prog}: error: {e}\n')
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
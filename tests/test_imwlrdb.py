@@ -10,14 +10,56 @@ Main module unit tests
 # Licensed under the terms and conditions of the
 # Apache License Version 2.0.
 #
-from unittest import TestCase
-from imwlrdb import imwlrdb, bytes_with_breaks, EOL_DEFAULT
+from asyncio import run
+from importlib.util import find_spec
+from io import BytesIO, TextIOWrapper
+from json import dumps, loads
+from os import path
+from sys import getrecursionlimit
+from tempfile import TemporaryDirectory
+from math import isnan
+from unittest import TestCase, skipIf
+import re
+import sys
+from imwlrdb import (
+    imwlrdb, imlwldb_aiter, imlwldb_iter, bytes_with_breaks, index_path,
+    lines_iter, mwlr_columns, mwlr_iter, mwlr_parallel_iter, append_records,
+    chunk_ranges, dead_record, imwlrdb_delta, multi_val_dict, multi_val_str,
+    record_diff, record_hashes,
+    lzma, main,
+    AsyncMWLRWriter, Format, MWLRIndex, MWLRReader, MWLRWriter,
+    LazyRecord, MWLRBlockReader, MWLRBlockWriter, MWLRStore,
+    SerialiseCache, SerialiseStats, EOL_DEFAULT, TEMPLATES_MAX_KEYS
+)
 
 # NOTE: Long reference strings are split into multiple strings to
 # avoid excess whitespace in the strings
 
 EOL = bytes(EOL_DEFAULT, encoding='utf8')
 
+
+class TempFileTestCase(TestCase):
+    """Base for tests which work on files in a temporary directory"""
+
+    fname = 'test.mwlr'
+
+    def setUp(self):
+        self.tempdir = TemporaryDirectory()
+        self.fpath = self.path(self.fname)
+
+    def tearDown(self):
+        self.tempdir.cleanup()
+
+    def path(self, name):
+        return path.join(self.tempdir.name, name)
+
+    def write(self, b):
+        with open(self.fpath, mode='wb') as f: f.write(b)
+
+    def read(self, name=None, mode='rb'):
+        fpath = self.fpath if name is None else self.path(name)
+        with open(fpath, mode=mode) as f: return f.read()
+
 class bytesWithBreaksTests(TestCase):
     # NOTE: these functions return line-terminating characters.
     # Line-terminating chars output by bytes_with_breaks() will be
@@ -129,6 +171,54 @@ class bytesWithBreaksTests(TestCase):
         ref = b'abcdefgh\r\n123456\r\n'
         self.assertEqual(bytes_with_breaks(**args), ref)
 
+    def test_longer_than_break_length_multibyte(self):
+        """Lines must not be broken in the middle of a character"""
+        args = {
+            's': 'abcdefgh12345\U0001f40d\U0001f40d\U0001f40d\U0001f40d',
+            'L': 16,
+            'eol': '\r\n',
+            'sol': '\x20\x20'
+        }
+        ref = b''.join((
+            b'abcdefgh12345\r\n',
+            b'\x20\x20', b'\xf0\x9f\x90\x8d' * 3, b'\r\n',
+            b'\x20\x20\xf0\x9f\x90\x8d\r\n'
+        ))
+        self.assertEqual(bytes_with_breaks(**args), ref)
+
+    def test_longer_than_break_length_trailing_spaces(self):
+        """Trailing spaces are kept, and no SOL follows the last line"""
+        for s, ref in (
+            ('abcdefgh123456\x20\x20', (
+                b'abcdefgh123456\r\n',
+                b'\x20\x20\x20\x20\r\n'
+            )),
+            ('abcdefgh12345678\x20\x20', (
+                b'abcdefgh123456\r\n',
+                b'\x20\x2078\x20\x20\r\n'
+            )),
+        ):
+            with self.subTest(s=s):
+                self.assertEqual(
+                    bytes_with_breaks(s, 16, '\r\n', '\x20\x20'),
+                    b''.join(ref)
+                )
+
+    def test_longer_than_break_length_with_br(self):
+        """Only lines continuing a broken line begin with SOL"""
+        args = {
+            's': 'abcdefgh12345678A\r\nBCD',
+            'L': 16,
+            'eol': '\r\n',
+            'sol': '\x20\x20'
+        }
+        ref = b''.join((
+            b'abcdefgh123456\r\n',
+            b'\x20\x2078A\r\n',
+            b'BCD\r\n'
+        ))
+        self.assertEqual(bytes_with_breaks(**args), ref)
+
 class imwlrdbTests(TestCase):
 
     def test_empty(self):
@@ -237,6 +327,22 @@ class imwlrdbTests(TestCase):
         ))
         self.assertEqual(imwlrdb(d), ref)
 
+    def test_one_level_pieces(self):
+        """Lines between sub-records are output in one piece"""
+        d = {
+            '__type': 'RECORD',
+            'ALFA': 0,
+            'BRAVO': 'excel ' * 20,
+            'deadbeefcafe0000f000': {'__type': 'SUB_RECORD', 'CHARLIE': 1},
+            'DELTA': 'a\nb',
+        }
+        out = list(imlwldb_iter(d))
+        self.assertEqual(len(out), 3)
+        self.assertEqual(out[0].count(EOL + b'  '), 1)
+        self.assertEqual(out[2], b''.join((
+            b'DELTA:a\\nb', EOL, b'END:RECORD', EOL
+        )))
+
     def test_one_level_with_freeform_body(self):
         d1 = {
             'ALFA': 0,
@@ -327,6 +433,36 @@ class imwlrdbTests(TestCase):
         ))
         self.assertEqual(imwlrdb(d), ref)
 
+    def test_two_level_format(self):
+        """Sub-records are written in the same format as their parent"""
+        d = {
+            '__type': 'RECORD',
+            'ALFA': 0,
+            'deadbeefcafe0000f000': {'__type': 'SUB_RECORD', 'CHARLIE': -1},
+        }
+        ref = b''.join((
+            b'BEGIN= RECORD\n',
+            b'ALFA= 0\n',
+            b'BEGIN= SUB_RECORD\n',
+            b'UID= deadbeefcafe0000f000\n',
+            b'CHARLIE= -1\n',
+            b'END= SUB_RECORD\n',
+            b'END= RECORD'
+        ))
+        fmt = {'fsep': '= ', 'eol': '\n'}
+        self.assertEqual(imwlrdb(d, out_format=fmt), ref)
+
+    def test_deep(self):
+        """Nesting is not limited by the recursion limit"""
+        levels = getrecursionlimit() + 100
+        d = {'__type': 'R0'}
+        x = d
+        for i in range(1, levels):
+            x[f'{i:020x}'] = x = {'__type': f'R{i}'}
+        b = imwlrdb(d)
+        self.assertEqual(b.count(b'BEGIN:'), levels)
+        self.assertTrue(b.endswith(b'END:R1' + EOL + b'END:R0'))
+
     def test_two_level_uid_priority(self):
         """Ignore the UID property for sub-records, regardless of case"""
 
@@ -399,3 +535,1264 @@ class imwlrdbTests(TestCase):
             b'END:RECORD'
         ))
         self.assertEqual(imwlrdb(d), ref)
+
+class mwlrIterTests(TestCase):
+    # NOTE: all values are strings when read back
+
+    def test_empty(self):
+        self.assertEqual(list(mwlr_iter(BytesIO(b''))), [])
+
+    def test_lines_iter(self):
+        """Lines are split the same when EOLs are split across blocks"""
+        b = b'a\r\n\r\r\nbb\rb\r\n' + b'c' * 50 + b'\r\n\r'
+        for eol in ('\r\n', '\r', '\r\n\r'):
+            ref = b.split(bytes(eol, encoding='utf8'))
+            for size in range(1, 9):
+                with self.subTest(eol=eol, size=size):
+                    out = list(lines_iter(BytesIO(b), eol, size=size))
+                    self.assertEqual(out, ref)
+        self.assertEqual(list(lines_iter(BytesIO(b''))), [])
+
+    def test_one_level(self):
+        d = {
+            '__type': 'RECORD',
+            'ALFA': '0',
+            'BRAVO': 'excel\nmore excel',
+            '': 'Nobody here'
+        }
+        f = BytesIO(imwlrdb(d))
+        self.assertEqual(list(mwlr_iter(f)), [d,])
+
+    def test_one_level_no_type(self):
+        d = {'ALFA': '0', 'BRAVO': 'excel'}
+        f = BytesIO(imwlrdb(d))
+        self.assertEqual(list(mwlr_iter(f)), [d,])
+
+    def test_long_lines(self):
+        """Lines broken up mid-character must read back intact"""
+        d = {
+            '__type': 'RECORD',
+            'ALFA': ''.join(('x' * 101, '\U0001f40d' * 50)),
+        }
+        f = BytesIO(imwlrdb(d))
+        self.assertEqual(list(mwlr_iter(f, size=16)), [d,])
+
+    def test_two_level(self):
+        d = {
+            '__type': 'RECORD',
+            'ALFA': '0',
+            'deadbeefcafe0000f000': {
+                '__type': 'SUB_RECORD',
+                'CHARLIE': '-1',
+                'DELTA': {'ECHO': 'hi', 'FOXTROT': 'there'},
+            },
+            'BRAVO': 'excel',
+        }
+        f = BytesIO(imwlrdb(d))
+        self.assertEqual(list(mwlr_iter(f)), [d,])
+
+    def test_two_level_depth(self):
+        """Yield sub-records on their own, then the remaining record"""
+        d = {
+            '__type': 'RECORD',
+            'ALFA': '0',
+            'deadbeefcafe0000f000': {
+                '__type': 'SUB_RECORD',
+                'CHARLIE': '-1',
+            },
+        }
+        f = BytesIO(imwlrdb(d))
+        ref = [
+            {'__type': 'SUB_RECORD', 'CHARLIE': '-1',
+                'UID': 'deadbeefcafe0000f000'},
+            {'__type': 'RECORD', 'ALFA': '0'},
+        ]
+        self.assertEqual(list(mwlr_iter(f, depth=2)), ref)
+
+    def test_header_footer(self):
+        fmt = {'eol': '\r\n', 'newline': '', 'sol': ''}
+        recs = [
+            {
+                '__header': f'From MAILER DAEMON {i}',
+                'From': 'amor@example.com',
+                'Subject': 'Re: ' * i,
+                '': '\r\nHello,\r\n\r\nregards',
+                '__footer': '\r\n',
+            } for i in range(3)
+        ]
+        f = BytesIO(EOL.join(imwlrdb(x, out_format=fmt) for x in recs))
+        args = {'in_format': fmt, 'header': 'From ', 'footer': '\r\n'}
+        self.assertEqual(list(mwlr_iter(f, **args)), recs)
+        keys = ('__header', 'From', '__footer')
+        ref = [{k: x[k] for k in keys} for x in recs]
+        for size in (3, 4096):
+            f.seek(0)
+            x = mwlr_iter(f, only=('From',), size=size, **args)
+            self.assertEqual(list(x), ref)
+
+    def test_only(self):
+        """Fields not asked for are skipped, with their continuations"""
+        d = {
+            '__type': 'RECORD',
+            'ALFA': 'x' * 200,
+            'BRAVO': 'excel',
+            'deadbeefcafe0000f000': {
+                '__type': 'SUB_RECORD', 'ALFA': 'y' * 200, 'BRAVO': 'more'
+            },
+            '': 'Nobody here\r\nbut us',
+        }
+        f = BytesIO(imwlrdb(d))
+        ref = {
+            '__type': 'RECORD',
+            'BRAVO': 'excel',
+            'deadbeefcafe0000f000': {'__type': 'SUB_RECORD', 'BRAVO': 'more'},
+        }
+        self.assertEqual(list(mwlr_iter(f, only={'BRAVO'})), [ref,])
+        f.seek(0)
+        ref = {'__type': 'RECORD', '': d['']}
+        ref['deadbeefcafe0000f000'] = {'__type': 'SUB_RECORD'}
+        self.assertEqual(list(mwlr_iter(f, only={''}, depth=1)), [ref,])
+
+    def test_unterminated(self):
+        f = BytesIO(b''.join((b'BEGIN:RECORD', EOL, b'ALFA:0')))
+        with self.assertRaises(ValueError):
+            list(mwlr_iter(f))
+
+class multiValueTests(TestCase):
+
+    d = {
+        'TYPE': 'work;home',
+        'ALFA': {'BRAVO': 'a=b', 'CHARLIE': {'DELTA': '{x}'}},
+        'PATH': 'C:\\dir',
+        'EMPTY': {},
+    }
+
+    def test_str(self):
+        self.assertEqual(
+            multi_val_str(self.d),
+            'TYPE=work\\;home;ALFA={BRAVO=a\\=b;CHARLIE={DELTA=\\{x\\}}}'
+            ';PATH=C:\\\\dir;EMPTY={}'
+        )
+        self.assertEqual(multi_val_str({'VALUE': 'DATE'}), 'VALUE=DATE')
+
+    def test_round_trip(self):
+        self.assertEqual(multi_val_dict(multi_val_str(self.d)), self.d)
+        s = multi_val_str(self.d, sep_f=':=', sep_r=',', escape='%')
+        self.assertEqual(multi_val_dict(s, ':=', ',', '%'), self.d)
+
+    def test_legacy(self):
+        """Unescaped and unbalanced strings split as they used to"""
+        self.assertEqual(
+            multi_val_dict('A=C:\\dir;B={x;C'),
+            {'A': 'C:\\dir', 'B': '{x', 'C': ''}
+        )
+        self.assertEqual(multi_val_dict('A=b=c', escape=None), {'A': 'b=c'})
+
+    def test_legacy_incompatible(self):
+        """Older values with balanced braces or escapes read differently"""
+        self.assertEqual(multi_val_dict('j={z}'), {'j': {'z': ''}})
+        self.assertEqual(multi_val_dict('j=a\\;b'), {'j': 'a;b'})
+        # earlier versions read these as plain strings, as when escaping
+        # is turned off in the format
+        self.assertEqual(multi_val_dict('j={z}', escape=''), {'j': '{z}'})
+        self.assertEqual(
+            multi_val_dict('j=a\\;b', escape=''), {'j': 'a\\', 'b': ''}
+        )
+
+    def test_records(self):
+        """Nested multi-values read back in records and lazy records"""
+        d = {'__type': 'RECORD', 'ALFA': self.d, 'BRAVO': 'excel'}
+        tempdir = TemporaryDirectory()
+        fpath = path.join(tempdir.name, 'test.mwlr')
+        for fmt in (Format(), Format({'vsep': '~', 'sfsep': ','})):
+            with self.subTest(format=fmt):
+                b = imwlrdb(d, uid='m1', out_format=fmt)
+                f = BytesIO(b)
+                ref = dict(d, UID='m1')
+                self.assertEqual(list(mwlr_iter(f, in_format=fmt)), [ref,])
+                with open(fpath, mode='wb') as f: f.write(b)
+                with MWLRReader(fpath, in_format=fmt) as r:
+                    lazy = r.lazy('m1')
+                    self.assertEqual(lazy['ALFA'], self.d)
+                    del lazy
+        tempdir.cleanup()
+
+class parallelParseTests(TempFileTestCase):
+
+    def write_recs(self, recs):
+        with open(self.fpath, mode='wb') as f:
+            with MWLRWriter(f) as w:
+                for x in recs: w.write(x)
+        return self.read()
+
+    def test_chunk_ranges(self):
+        """Chunks begin at top-level records only"""
+        sub = {'__type': 'SUB_RECORD', 'BRAVO': 'excel' * 10}
+        recs = [
+            {'__type': 'RECORD', 'ALFA': str(i), 'a%d' % i: sub}
+            for i in range(10)
+        ]
+        b = self.write_recs(recs)
+        ranges = list(chunk_ranges(b, chunk_bytes=1))
+        self.assertEqual(
+            [b[start:end] for start, end in ranges],
+            [imwlrdb(x) for x in recs]
+        )
+        self.assertEqual(list(chunk_ranges(b, chunk_bytes=len(b))), [
+            (0, len(b))
+        ])
+
+    def test_chunk_ranges_header(self):
+        recs = [
+            {'__header': 'From A%d' % i, '__footer': '-----', 'ALFA': str(i)}
+            for i in range(4)
+        ]
+        b = self.write_recs(recs)
+        ranges = list(
+            chunk_ranges(b, header='From ', footer='-----', chunk_bytes=1)
+        )
+        self.assertEqual(
+            [b[start:end] for start, end in ranges],
+            [imwlrdb(x) for x in recs]
+        )
+        # flags of compiled patterns are kept
+        header = re.compile(b'from ', re.IGNORECASE)
+        self.assertEqual(ranges, list(
+            chunk_ranges(b, header=header, footer='-----', chunk_bytes=1)
+        ))
+
+    def test_same_as_mwlr_iter(self):
+        recs = [
+            {
+                '__type': 'RECORD',
+                'ALFA': str(i) * 50,
+                'a%d' % i: {'__type': 'SUB_RECORD', 'BRAVO': 'excel'},
+            }
+            for i in range(40)
+        ]
+        b = self.write_recs(recs)
+        for depth in (1, 2):
+            ref = list(mwlr_iter(BytesIO(b), depth=depth))
+            for ordered in (True, False):
+                out = list(mwlr_parallel_iter(
+                    self.fpath, depth=depth, jobs=2, ordered=ordered,
+                    chunk_bytes=500
+                ))
+                if not ordered:
+                    key = lambda x: x.get('UID', x.get('ALFA'))
+                    out.sort(key=key)
+                    ref.sort(key=key)
+                self.assertEqual(out, ref)
+
+class columnTests(TestCase):
+
+    recs = (
+        {'__type': 'RECORD', 'ALFA': '1.5', 'BRAVO': {'lang': 'en'}},
+        {
+            '__type': 'RECORD',
+            'CHARLIE': 'caf\u00e9',
+            'a0': {'__type': 'SUB_RECORD', 'ALFA': '9'},
+        },
+        {'__type': 'RECORD', 'ALFA': '-2', 'CHARLIE': ''},
+    )
+
+    def table(self):
+        f = BytesIO()
+        with MWLRWriter(f) as w:
+            for x in self.recs: w.write(x)
+        f.seek(0)
+        return mwlr_columns(f)
+
+    def test_columns(self):
+        """Missing fields are absent from rows; sub-records are left out"""
+        t = self.table()
+        self.assertEqual(len(t), 3)
+        self.assertEqual(
+            set(t.columns), {'__type', 'ALFA', 'BRAVO', 'CHARLIE'}
+        )
+        self.assertEqual(list(t['ALFA']), ['1.5', None, '-2'])
+        self.assertEqual(list(t['BRAVO']), ['lang=en', None, None])
+        self.assertEqual(list(t['CHARLIE']), [None, 'caf\u00e9', ''])
+        self.assertEqual(
+            t.row(1), {'__type': 'RECORD', 'CHARLIE': 'caf\u00e9'}
+        )
+        self.assertEqual(bytes(t['CHARLIE'].data), b'caf\xc3\xa9')
+        self.assertEqual(list(t['CHARLIE'].offsets), [0, 0, 5, 5])
+        self.assertEqual(bytes(t['CHARLIE'].present), b'\x06')
+
+    def test_in_format(self):
+        """Multi-value fields are serialised as in the source file"""
+        fmt = Format({'vsep': '~', 'sfsep': ','})
+        f = BytesIO(imwlrdb(
+            {'__type': 'RECORD', 'BRAVO': {'lang': 'en', 'pref': '1'}},
+            out_format=fmt
+        ))
+        t = mwlr_columns(f, in_format=fmt)
+        self.assertEqual(list(t['BRAVO']), ['lang~en,pref~1'])
+
+    def test_numbers(self):
+        x = self.table()['ALFA'].numbers()
+        self.assertEqual((x[0], x[2]), (1.5, -2.0))
+        self.assertTrue(isnan(x[1]))
+
+    @skipIf(find_spec('numpy') is None, 'NumPy is not installed')
+    def test_numpy(self):
+        data, offsets, present = self.table()['ALFA'].numpy()
+        self.assertEqual(bytes(data), b'1.5-2')
+        self.assertEqual(list(offsets), [0, 3, 3, 5])
+        self.assertEqual(list(present), [True, False, True])
+
+class lazyRecordTests(TestCase):
+
+    d = {
+        '__type': 'RECORD',
+        'ALFA': 'line one\nline two ' + 'long ' * 30,
+        'BRAVO': {'lang': 'en', 'pref': '1'},
+        'a1': {
+            '__type': 'SUB_RECORD',
+            'CHARLIE': '-1',
+            'b1': {'__type': 'SUB_SUB_RECORD', 'DELTA': 'more'},
+        },
+        'ECHO': 'excel',
+        '': 'Freeform\r\nbody',
+    }
+
+    def test_same_as_mwlr_iter(self):
+        b = imwlrdb(self.d, uid='a0')
+        ref = next(mwlr_iter(BytesIO(b)))
+        r = LazyRecord(b)
+        self.assertEqual(r.to_dict(), ref)
+        self.assertEqual(r, ref)
+        self.assertEqual(list(r), list(ref))
+        self.assertEqual(r['ALFA'], ref['ALFA'])
+        self.assertEqual(r['BRAVO'], {'lang': 'en', 'pref': '1'})
+        self.assertEqual(r['a1']['b1']['DELTA'], 'more')
+        self.assertEqual((r.type, r.uid), ('RECORD', 'a0'))
+        with self.assertRaises(KeyError):
+            r['FOXTROT']
+
+    def test_sub_record_no_uid(self):
+        """Sub-records without a UID have the same key every time"""
+        b = imwlrdb({
+            '__type': 'RECORD',
+            'ALFA': '0',
+            'a1': {'__type': 'SUB_RECORD', 'CHARLIE': '-1'},
+        }).replace(b'UID:a1\r\n', b'')
+        r = LazyRecord(b)
+        self.assertEqual(list(r), list(r))
+        d = dict(r)
+        self.assertEqual(d, dict(r.items()))
+        key = list(r)[-1]
+        self.assertEqual(d[key], {'__type': 'SUB_RECORD', 'CHARLIE': '-1'})
+        self.assertEqual(r.to_dict()[key], d[key])
+
+    def test_header(self):
+        d = {
+            '__header': 'From A',
+            '__footer': '-----',
+            'ALFA': '0',
+            '': 'Body',
+        }
+        b = imwlrdb(d)
+        ref = next(mwlr_iter(BytesIO(b), header='From ', footer='-----'))
+        self.assertEqual(LazyRecord(b, footer='-----'), ref)
+        self.assertIsNone(LazyRecord(b).type)
+
+    def test_reader(self):
+        """Readers may be closed while their lazy records remain"""
+        tempdir = TemporaryDirectory()
+        fpath = path.join(tempdir.name, 'test.mwlr')
+        with open(fpath, mode='wb') as f: f.write(imwlrdb(self.d, uid='a0'))
+        with MWLRReader(fpath) as r:
+            sub = r.lazy('a1')
+            ref = r.record('a1')
+        self.assertEqual(r.pending_maps, 1)
+        self.assertEqual(sub, ref)
+        del sub
+        self.assertEqual(r.pending_maps, 0)
+        tempdir.cleanup()
+
+class MWLRReaderTests(TempFileTestCase):
+
+    def test_empty(self):
+        self.write(b'')
+        with MWLRReader(self.fpath) as r:
+            self.assertEqual(len(r), 0)
+
+    def test_two_level(self):
+        sub = {
+            '__type': 'SUB_RECORD',
+            'CHARLIE': '-1',
+            'DELTA': 'more'
+        }
+        d = {
+            '__type': 'RECORD',
+            'ALFA': '0',
+            'deadbeefcafe0000f000': sub,
+            'BRAVO': 'excel',
+        }
+        self.write(imwlrdb(d))
+        ref_sub = imwlrdb(sub, uid='deadbeefcafe0000f000')
+        with MWLRReader(self.fpath) as r:
+            self.assertEqual(r.records[0][:2], (None, 'RECORD'))
+            self.assertEqual(
+                r.record_bytes('deadbeefcafe0000f000'), ref_sub
+            )
+            self.assertEqual(
+                r.record('deadbeefcafe0000f000'),
+                dict(sub, UID='deadbeefcafe0000f000')
+            )
+            self.assertEqual(
+                r.record('deadbeefcafe0000f000', only={'DELTA'}),
+                {
+                    '__type': 'SUB_RECORD',
+                    'DELTA': 'more',
+                    'UID': 'deadbeefcafe0000f000'
+                }
+            )
+
+    def test_unknown_uid(self):
+        self.write(imwlrdb({'__type': 'RECORD', 'ALFA': 0}, uid='a0'))
+        with MWLRReader(self.fpath) as r:
+            with self.assertRaises(KeyError):
+                r.record('b0')
+
+    def test_query(self):
+        long_note = 'Keep away from the kitchen ' * 5
+        d = {
+            '__type': 'RECORD',
+            'a0': {'__type': 'ITEM', 'NOTE': long_note, 'N': '3'},
+            'a1': {'__type': 'ITEM', 'NOTE': 'kitchen', 'N': '7'},
+            'a2': {'__type': 'ITEM', 'NOTE': 'garden', 'N': '5'},
+            'a3': {'__type': 'ITEM', 'NOTE': {'lang': 'en'}},
+        }
+        self.write(imwlrdb(d))
+        uids = lambda it: [x['UID'] for x in it]
+        with MWLRReader(self.fpath) as r:
+            self.assertEqual(
+                uids(r.query([('NOTE', 'contains', 'the kitchen Keep')])),
+                ['a0']
+            )
+            self.assertEqual(
+                uids(r.query([('NOTE', '==', 'kitchen')])), ['a1']
+            )
+            self.assertEqual(
+                uids(r.query([('NOTE', 'startswith', long_note[:70])])),
+                ['a0']
+            )
+            self.assertEqual(
+                uids(r.query([('N', '>', '3'), ('N', '<=', '7')])),
+                ['a1', 'a2']
+            )
+            self.assertEqual(
+                uids(r.query([('NOTE', lambda v, x: v == x, {'lang': 'en'})])),
+                ['a3']
+            )
+            self.assertEqual(
+                list(r.query([('N', '==', '5')], only={'N'})),
+                [{'__type': 'ITEM', 'N': '5', 'UID': 'a2'}]
+            )
+            self.assertEqual(
+                list(r.query([('N', '==', '7')], offsets=True)),
+                [r.records[r.uids['a1']]]
+            )
+
+    def test_query_reserved(self):
+        """Types, UIDs, headers and footers are found by their values"""
+        d = {
+            '__type': 'RECORD',
+            'a0': {'__type': 'ITEM', 'N': '3'},
+            'a1': {'__type': 'ITEMS', 'N': '7'},
+        }
+        mail = {'__header': 'From alfa', '__footer': '-----', 'N': '5'}
+        self.write(b'\r\n'.join((imwlrdb(d, uid='r0'), imwlrdb(mail))))
+        uids = lambda it: [x.get('UID', x.get('N')) for x in it]
+        with MWLRReader(self.fpath, header='From ', footer='-----') as r:
+            self.assertEqual(
+                uids(r.query([('__type', '==', 'ITEM'), ('N', '>', '0')])),
+                ['a0']
+            )
+            self.assertEqual(
+                uids(r.query([('__type', 'startswith', 'ITEM')])),
+                ['a0', 'a1']
+            )
+            self.assertEqual(
+                uids(r.query([('__type', 'contains', 'CORD')])), ['r0']
+            )
+            self.assertEqual(uids(r.query([('UID', '==', 'r0')])), ['r0'])
+            self.assertEqual(
+                uids(r.query([('__header', '==', 'From alfa')])), ['5']
+            )
+            self.assertEqual(
+                uids(r.query([('__footer', '==', '-----')])), ['5']
+            )
+
+    def test_query_unknown_op(self):
+        self.write(imwlrdb({'__type': 'RECORD', 'ALFA': '0'}, uid='a0'))
+        with MWLRReader(self.fpath) as r:
+            with self.assertRaises(ValueError):
+                list(r.query([('ALFA', '~', '0')]))
+
+class MWLRIndexTests(TempFileTestCase):
+
+    d = {
+        '__type': 'RECORD',
+        'ALFA': 0,
+        'deadbeefcafe0000f000': {
+            '__type': 'SUB_RECORD',
+            'CHARLIE': -1,
+        },
+        'cafebabe': {
+            '__type': 'SUB_RECORD',
+            'CHARLIE': -2,
+        },
+    }
+
+    def setUp(self):
+        super().setUp()
+        self.index = MWLRIndex(('CHARLIE',))
+        self.write(imwlrdb(self.d, index=self.index))
+
+    def test_index_writer_eq_reader(self):
+        """Writer and reader must index records identically"""
+        with MWLRReader(self.fpath, fields=('CHARLIE',)) as r:
+            self.assertEqual(self.index.records, r.records)
+            self.assertEqual(self.index.values, r.index.values)
+
+    def test_sidecar(self):
+        self.index.save(index_path(self.fpath), self.fpath)
+        x = MWLRIndex.load(index_path(self.fpath), self.fpath)
+        self.assertEqual(x.records, self.index.records)
+        self.assertEqual(x.find('CHARLIE', '-2'), [2,])
+        with MWLRReader(self.fpath, fields=('CHARLIE',), sidecar=True) as r:
+            recs = r.find('CHARLIE', '-1')
+            self.assertEqual(recs[0]['UID'], 'deadbeefcafe0000f000')
+
+    def test_sidecar_stale(self):
+        self.index.save(index_path(self.fpath), self.fpath)
+        with open(self.fpath, mode='ab') as f: f.write(EOL)
+        self.assertIsNone(MWLRIndex.load(index_path(self.fpath), self.fpath))
+
+    def test_sidecar_other_fields(self):
+        self.index.save(index_path(self.fpath), self.fpath)
+        x = MWLRIndex.load(index_path(self.fpath), self.fpath, ('DELTA',))
+        self.assertIsNone(x)
+
+    def test_splice(self):
+        """Spliced indexes are the same as ones built from scratch"""
+        def build(recs, vals):
+            x = MWLRIndex(('CHARLIE',))
+            for rec, v in zip(recs, vals): x.add(*rec, values=v)
+            return x
+
+        recs = [(f'r{i}', 'RECORD', i, i) for i in range(6)]
+        vals = [{'CHARLIE': str(i % 2)} for i in range(6)]
+        new = [('n0', 'RECORD', 0, 0), ('n1', 'RECORD', 0, 0)]
+        new_vals = [{'CHARLIE': '1'}, {'CHARLIE': '2'}]
+        for i, j in ((1, 2), (1, 4), (2, 2), (5, 6)):
+            with self.subTest(i=i, j=j):
+                x = build(recs, vals)
+                x.splice(i, j, new, new_vals)
+                ref = build(
+                    recs[:i] + new + recs[j:], vals[:i] + new_vals + vals[j:]
+                )
+                self.assertEqual(x.records, ref.records)
+                self.assertEqual(x.uids, ref.uids)
+                self.assertEqual(x.values, ref.values)
+
+class formatTests(TestCase):
+
+    fmt = {
+        'eol': '\n',
+        'fsep': ':\x20',
+        'sol': '\t',
+        'width_bytes': 16,
+    }
+    d = {
+        '__type': 'RECORD',
+        'ALFA': 'abcdefgh12345678ABCDEFGH',
+        'deadbeefcafe0000f000': {
+            '__type': 'SUB_RECORD',
+            'CHARLIE': -1,
+        }
+    }
+
+    def test_format_eq_dict(self):
+        """Format objects must work like the dicts they come from"""
+        ref = imwlrdb(self.d, out_format=self.fmt)
+        self.assertEqual(imwlrdb(self.d, out_format=Format(self.fmt)), ref)
+
+    def test_format_encoding(self):
+        """The encoding of a Format takes precedence"""
+        fmt = Format(self.fmt, encoding='utf-16-le')
+        ref = imwlrdb(self.d, encoding='utf-16-le', out_format=self.fmt)
+        self.assertEqual(imwlrdb(self.d, out_format=fmt), ref)
+
+    def test_format_reader(self):
+        d = {'ALFA': 'abcdefgh12345678ABCDEFGH', 'BRAVO': 'excel'}
+        fmt = Format(self.fmt)
+        f = BytesIO(imwlrdb(d, out_format=fmt))
+        self.assertEqual(list(mwlr_iter(f, in_format=fmt)), [d,])
+
+    def test_format_template(self):
+        """Templates leave out reserved names, and are shared"""
+        fmt = Format(self.fmt)
+        keys = ('__type', 'ALFA', 'uid', '', 0, 'deadbeefcafe0000f000')
+        t = fmt.template(keys)
+        self.assertEqual(t, (
+            ('ALFA', b'ALFA: ', b'ALFA;'),
+            ('deadbeefcafe0000f000', b'deadbeefcafe0000f000: ',
+                b'deadbeefcafe0000f000;'),
+        ))
+        self.assertIs(fmt.template(list(keys)), t)
+        ref = imwlrdb(self.d, out_format=self.fmt)
+        self.assertEqual(imwlrdb(self.d, out_format=fmt), ref)
+
+    def test_format_template_records(self):
+        """Sub-record UIDs are not part of templates, which are bounded"""
+        fmt = Format(self.fmt)
+        for i in range(10):
+            d = {'__type': 'RECORD', 'ALFA': '0', None: 'x'}
+            d.update(
+                (f'{i}-{j}', {'__type': 'SUB_RECORD', 'CHARLIE': j})
+                for j in range(100)
+            )
+            ref = imwlrdb(d, out_format=self.fmt)
+            self.assertEqual(imwlrdb(d, out_format=fmt), ref)
+        self.assertEqual(len(fmt.templates), 2)
+        self.assertEqual(
+            fmt.template(d)[:2],
+            (('ALFA', b'ALFA: ', b'ALFA;'), (None, 3, None))
+        )
+        for i in range(100): fmt.template([f'{i}-{j}' for j in range(1000)])
+        self.assertLessEqual(fmt.template_keys, TEMPLATES_MAX_KEYS)
+
+class MWLRWriterTests(TestCase):
+
+    recs = (
+        {'__type': 'RECORD', 'ALFA': 0, 'BRAVO': 'excel'},
+        {},
+        {
+            '__type': 'RECORD',
+            'CHARLIE': 'more' * 40,
+            'deadbeefcafe0000f000': {'__type': 'SUB_RECORD', 'DELTA': -1},
+        },
+    )
+
+    def test_empty(self):
+        f = BytesIO()
+        with MWLRWriter(f) as w: w.write({})
+        self.assertEqual(f.getvalue(), b'')
+
+    def test_one_record_eq_imwlrdb(self):
+        f = BytesIO()
+        with MWLRWriter(f) as w: w.write(self.recs[0], uid='a0')
+        self.assertEqual(f.getvalue(), imwlrdb(self.recs[0], uid='a0'))
+
+    def test_records(self):
+        """Records are separated by EOL; small buffers are flushed early"""
+        f = BytesIO()
+        w = MWLRWriter(f, buffer_bytes=16)
+        for x in self.recs: w.write(x)
+        self.assertTrue(f.getvalue())
+        w.close()
+        ref = EOL.join(imwlrdb(x) for x in self.recs if x)
+        self.assertEqual(f.getvalue(), ref)
+
+    def test_index(self):
+        f = BytesIO()
+        index = MWLRIndex()
+        with MWLRWriter(f, index=index) as w:
+            for x in self.recs: w.write(x)
+        b = f.getvalue()
+        uid = 'deadbeefcafe0000f000'
+        ref = imwlrdb(self.recs[2][uid], uid=uid)
+        _, _, start, end = index.records[index.uids[uid]]
+        self.assertEqual(b[start:end], ref)
+
+    def test_write_all_parallel(self):
+        """Output and index must be the same as from the sequential path"""
+        recs = [dict(self.recs[i % 3], ECHO=i) for i in range(40)]
+        f_ref = BytesIO()
+        index_ref = MWLRIndex(('ECHO',))
+        with MWLRWriter(f_ref, index=index_ref) as w:
+            for x in recs: w.write(x)
+        f = BytesIO()
+        index = MWLRIndex(('ECHO',))
+        with MWLRWriter(f, index=index) as w:
+            w.write_all(iter(recs), jobs=2, chunk_size=3)
+        self.assertEqual(f.getvalue(), f_ref.getvalue())
+        self.assertEqual(index.records, index_ref.records)
+        self.assertEqual(index.values, index_ref.values)
+
+class appendTests(TempFileTestCase):
+
+    recs = MWLRWriterTests.recs
+    cal = {
+        '__type': 'CALENDAR',
+        'ALFA': 0,
+        'deadbeefcafe0000f000': {'__type': 'EVENT', 'CHARLIE': -1},
+    }
+    event = {'__type': 'EVENT', 'CHARLIE': -2}
+
+    def test_append_eq_writer(self):
+        """Appended records and index are the same as if written at once"""
+        f_ref = BytesIO()
+        index_ref = MWLRIndex()
+        with MWLRWriter(f_ref, index=index_ref) as w:
+            for x in self.recs: w.write(x)
+        index = MWLRIndex()
+        self.write(imwlrdb(self.recs[0], index=index))
+        with open(self.fpath, mode='r+b') as f:
+            with MWLRWriter.append(f, index=index) as w:
+                for x in self.recs[1:]: w.write(x)
+        self.assertEqual(self.read(), f_ref.getvalue())
+        self.assertEqual(index.records, index_ref.records)
+
+    def test_append_empty(self):
+        self.write(b'')
+        append_records(self.fpath, self.recs[:1])
+        self.assertEqual(self.read(), imwlrdb(self.recs[0]))
+
+    def test_append_trailing_eol(self):
+        self.write(imwlrdb(self.recs[0]) + EOL)
+        append_records(self.fpath, self.recs[:1])
+        self.assertEqual(self.read(), EOL.join((imwlrdb(self.recs[0]),) * 2))
+
+    def test_append_outer(self):
+        """Records are added before the END line of the outer record"""
+        self.write(imwlrdb(self.cal) + EOL)
+        with MWLRReader(self.fpath) as r:
+            r.index.save(index_path(self.fpath), self.fpath)
+        append_records(
+            self.fpath, {'cafebabe': self.event}, outer='CALENDAR'
+        )
+        ref = dict(self.cal, cafebabe=self.event)
+        self.assertEqual(self.read(), imwlrdb(ref) + EOL)
+        index = MWLRIndex.load(index_path(self.fpath), self.fpath)
+        with MWLRReader(self.fpath) as r:
+            self.assertEqual(index.records, r.records)
+
+    def test_append_outer_wrong_type(self):
+        self.write(imwlrdb(self.cal))
+        with self.assertRaises(ValueError):
+            append_records(self.fpath, [self.event], outer='EVENT')
+        self.assertEqual(self.read(), imwlrdb(self.cal))
+
+class storeTests(TempFileTestCase):
+
+    cal = {
+        '__type': 'CALENDAR',
+        'ALFA': 0,
+        'deadbeefcafe0000f000': {
+            '__type': 'EVENT', 'CHARLIE': -1, 'DELTA': 'more' * 20
+        },
+        'deadbeefcafe0000f001': {'__type': 'EVENT', 'CHARLIE': -2},
+    }
+    uid = 'deadbeefcafe0000f000'
+
+    def test_dead_record(self):
+        for n in range(200):
+            b = dead_record(n)
+            if b is not None: self.assertEqual(len(b), n)
+        self.assertEqual(list(mwlr_iter(BytesIO(dead_record(160)))), [])
+
+    def test_update_in_place(self):
+        self.write(imwlrdb(self.cal))
+        size = len(self.read())
+        event = {'__type': 'EVENT', 'CHARLIE': 0}
+        with MWLRStore(self.fpath, compact_ratio=None) as st:
+            st.update(self.uid, event)
+            self.assertEqual(len(st.dead), 1)
+            self.assertEqual(st.record(self.uid)['CHARLIE'], '0')
+        self.assertEqual(len(self.read()), size)
+        rec = next(mwlr_iter(BytesIO(self.read())))
+        self.assertEqual(rec[self.uid], {'__type': 'EVENT', 'CHARLIE': '0'})
+        self.assertEqual(len(rec), 4)
+
+    def test_update_append_delete_compact(self):
+        self.write(imwlrdb(self.cal))
+        event = dict(self.cal[self.uid], DELTA='more' * 40)
+        with MWLRStore(self.fpath, compact_ratio=None) as st:
+            st.update(self.uid, event)
+            st.delete('deadbeefcafe0000f001')
+            self.assertEqual(len(st.dead), 2)
+            st.compact()
+            self.assertEqual(st.dead_bytes, 0)
+        ref = {'__type': 'CALENDAR', 'ALFA': 0, self.uid: event}
+        self.assertEqual(self.read(), imwlrdb(ref))
+
+    def test_patched_index(self):
+        """Tables patched after changes are the same as from a scan"""
+        cal = dict(self.cal)
+        cal['deadbeefcafe0000f002'] = {
+            '__type': 'EVENT',
+            'a0': {'__type': 'ALARM', 'ECHO': 'x' * 100},
+        }
+        self.write(EOL.join((imwlrdb({'__type': 'ITEM'}, 'i0'), imwlrdb(cal))))
+        changes = (
+            ('deadbeefcafe0000f002', {'__type': 'EVENT', 'CHARLIE': 0}),
+            (self.uid, dict(self.cal[self.uid], DELTA='more' * 40)),
+            ('deadbeefcafe0000f001', None),
+            (self.uid, {'__type': 'EVENT', 'b0': {'__type': 'ALARM'}}),
+            ('b0', None),
+        )
+        with MWLRStore(self.fpath, compact_ratio=None) as st:
+            for uid, d in changes:
+                if d is None: st.delete(uid)
+                else: st.update(uid, d)
+                with MWLRReader(self.fpath) as ref:
+                    self.assertEqual(st.records, ref.records)
+                    self.assertEqual(st.uids, ref.uids)
+                    self.assertEqual(st.dead, ref.dead)
+                self.assertEqual(st.dead_bytes, st._dead_size(ref.dead))
+
+    def test_update_not_last(self):
+        """Records that cannot be appended to their parent are compacted"""
+        cal_2 = dict(self.cal)
+        del cal_2[self.uid]
+        self.write(EOL.join((imwlrdb(self.cal), imwlrdb(cal_2))))
+        event = dict(self.cal[self.uid], DELTA='more' * 40)
+        with MWLRStore(self.fpath) as st: st.update(self.uid, event)
+        ref = dict(self.cal)
+        ref[self.uid] = event
+        self.assertEqual(self.read(), EOL.join((imwlrdb(ref), imwlrdb(cal_2))))
+
+    def test_compact_ratio(self):
+        self.write(imwlrdb(self.cal))
+        with MWLRStore(self.fpath, compact_ratio=0.0) as st:
+            st.delete(self.uid)
+            self.assertEqual(st.dead, [])
+        ref = dict(self.cal)
+        del ref[self.uid]
+        self.assertEqual(self.read(), imwlrdb(ref))
+
+class blockTests(TempFileTestCase):
+
+    recs = {
+        'a%d' % i: {
+            '__type': 'RECORD',
+            'ALFA': str(i) * 40,
+            'b%d' % i: {'__type': 'SUB_RECORD', 'BRAVO': 'excel' * 20},
+        }
+        for i in range(20)
+    }
+
+    fname = 'test.mwlrz'
+
+    def setUp(self):
+        super().setUp()
+        f = BytesIO()
+        with MWLRWriter(f) as w:
+            for uid, d in self.recs.items(): w.write(d, uid)
+        self.ref = f.getvalue()
+
+    def write_blocks(self, **kwargs):
+        index = MWLRIndex()
+        with open(self.fpath, mode='wb') as f:
+            with MWLRBlockWriter(f, index=index, **kwargs) as w:
+                for uid, d in self.recs.items(): w.write(d, uid)
+        return index
+
+    def test_same_as_writer(self):
+        """Uncompressed blocks are the same as MWLRWriter output"""
+        codecs = ('zlib', 'lzma') if lzma is not None else ('zlib',)
+        for codec in codecs:
+            self.write_blocks(codec=codec, block_bytes=1000)
+            with MWLRBlockReader(self.fpath) as r:
+                self.assertGreater(len(r.blocks), 1)
+                self.assertEqual(r.read(), self.ref)
+                self.assertEqual(r.read(900, 2100), self.ref[900:2100])
+                self.assertEqual(
+                    list(r), list(mwlr_iter(BytesIO(self.ref)))
+                )
+
+    def test_record(self):
+        index = self.write_blocks(block_bytes=1000)
+        with MWLRBlockReader(self.fpath) as r:
+            self.assertEqual(r.blocks[0][0], 'a0')
+            uid = r.blocks[1][0]
+            self.assertEqual(r.record(uid), dict(self.recs[uid], UID=uid))
+            with self.assertRaises(KeyError):
+                r.record('b3')
+        index.save(index_path(self.fpath), self.fpath)
+        with MWLRBlockReader(self.fpath, sidecar=True) as r:
+            self.assertEqual(
+                r.record('b3', only={'BRAVO'}),
+                dict(self.recs['a3']['b3'], UID='b3')
+            )
+
+    def test_parallel(self):
+        """Blocks start with the same UIDs when written by workers"""
+        self.write_blocks(block_bytes=1000)
+        with MWLRBlockReader(self.fpath) as r: ref = r.blocks
+        recs = [dict(d, UID=uid) for uid, d in self.recs.items()]
+        with open(self.fpath, mode='wb') as f:
+            with MWLRBlockWriter(f, block_bytes=1000) as w:
+                w.write_all(recs, jobs=2, chunk_size=1, uid_key='UID')
+        with MWLRBlockReader(self.fpath) as r:
+            self.assertEqual(r.blocks, ref)
+            uid = r.blocks[1][0]
+            self.assertEqual(r.record(uid), dict(self.recs[uid], UID=uid))
+
+    def test_header(self):
+        """Records with custom headers and footers are read back"""
+        for footer in ('-----', '\r\n'):
+            mails = [
+                {
+                    '__header': f'From alfa {i}',
+                    '__footer': footer,
+                    'N': str(i),
+                    '': f'\r\nHello {i}',
+                }
+                for i in range(40)
+            ]
+            with open(self.fpath, mode='wb') as f:
+                with MWLRBlockWriter(f, block_bytes=200) as w:
+                    for d in mails: w.write(d)
+            with self.subTest(footer=footer), MWLRBlockReader(
+                self.fpath, header='From ', footer=footer
+            ) as r:
+                self.assertGreater(len(r.blocks), 1)
+                self.assertEqual(list(r), mails)
+
+    def test_empty(self):
+        with open(self.fpath, mode='wb') as f:
+            with MWLRBlockWriter(f) as w: w.write({})
+        with MWLRBlockReader(self.fpath) as r:
+            self.assertEqual(r.read(), b'')
+
+    def test_not_container(self):
+        with open(self.fpath, mode='wb') as f: f.write(self.ref)
+        with self.assertRaises(ValueError):
+            MWLRBlockReader(self.fpath)
+
+class cacheTests(TestCase):
+
+    def record(self):
+        return {
+            '__type': 'RECORD',
+            'ALFA': 'excel' * 30,
+            'a0': {
+                '__type': 'SUB_RECORD',
+                'BRAVO': '0',
+                'b0': {'__type': 'SUB_SUB_RECORD', 'CHARLIE': 'more'},
+            },
+            'a1': {'__type': 'SUB_RECORD', 'BRAVO': '1'},
+        }
+
+    def export(self, d, cache, offset=0):
+        index = MWLRIndex(('BRAVO',))
+        b = imwlrdb(d, 'r0', index=index, offset=offset, cache=cache)
+        return b, index.records, index.record_values
+
+    def test_same_output(self):
+        """Output and index are the same with records from the cache"""
+        d = self.record()
+        ref = self.export(d, None, 8)
+        cache = SerialiseCache()
+        self.assertEqual(self.export(d, cache), self.export(d, None))
+        self.assertEqual(len(cache), 3)
+        self.assertEqual(self.export(d, cache, 8), ref)
+        self.assertEqual(cache.hits, 2)
+
+    def test_changed(self):
+        """Changed sub-records are serialised again"""
+        d = self.record()
+        cache = SerialiseCache()
+        self.export(d, cache)
+        d['a0']['b0']['CHARLIE'] = 'less'
+        self.assertEqual(self.export(d, cache), self.export(d, None))
+        self.assertEqual(cache.hits, 1) # only a1
+
+    def test_eviction(self):
+        d = self.record()
+        n = len(imwlrdb(d['a1'], 'a1')) + len(EOL)
+        cache = SerialiseCache(max_bytes=n)
+        self.export(d, cache)
+        self.assertEqual(len(cache), 1)
+        self.assertEqual(cache.size, n)
+
+    def test_stats(self):
+        """The cache is not used when counting records"""
+        d = self.record()
+        cache = SerialiseCache()
+        imwlrdb(d, cache=cache, stats=SerialiseStats())
+        self.assertEqual(len(cache), 0)
+
+class deltaTests(TestCase):
+
+    def tree(self):
+        return {
+            '__type': 'CALENDAR',
+            'ALFA': '0',
+            'e0': {
+                '__type': 'EVENT',
+                'BRAVO': 'excel',
+                'a0': {'__type': 'ALARM', 'CHARLIE': '-1'},
+            },
+            'e1': {'__type': 'EVENT', 'BRAVO': 'more'},
+            'e2': {
+                '__type': 'EVENT',
+                'a2': {'__type': 'ALARM', 'CHARLIE': '-2'},
+            },
+        }
+
+    def test_unchanged(self):
+        old = record_hashes(self.tree(), 'c0')
+        self.assertEqual(
+            record_diff(old, record_hashes(self.tree(), 'c0')),
+            ([], [], [])
+        )
+        self.assertEqual(imwlrdb_delta(old, self.tree(), 'c0'), b'')
+
+    def test_duplicate_uid(self):
+        """UIDs repeated under different parents cannot be told apart"""
+        new = self.tree()
+        new['e1']['a0'] = {'__type': 'ALARM', 'CHARLIE': '-1'}
+        with self.assertRaises(ValueError):
+            record_hashes(new, 'c0')
+        old = record_hashes(self.tree(), 'c0')
+        with self.assertRaises(ValueError):
+            imwlrdb_delta(old, new, 'c0')
+
+    def test_diff(self):
+        """Records added or removed with their parents are left out"""
+        old = record_hashes(self.tree(), 'c0')
+        new = self.tree()
+        new['e1']['BRAVO'] = 'less'
+        new['e1']['a0'] = new['e0'].pop('a0') # moved
+        del new['e2']
+        new['e3'] = {
+            '__type': 'EVENT',
+            'a3': {'__type': 'ALARM', 'CHARLIE': '-3'},
+        }
+        self.assertEqual(
+            record_diff(old, record_hashes(new, 'c0')),
+            (['e3'], ['e1', 'a0'], ['e2'])
+        )
+
+    def test_delta(self):
+        old = record_hashes(self.tree(), 'c0')
+        new = self.tree()
+        new['ALFA'] = '1'
+        new['e1']['BRAVO'] = 'less'
+        del new['e0']
+        new['e3'] = {
+            '__type': 'EVENT',
+            'a3': {'__type': 'ALARM', 'CHARLIE': '-3'},
+        }
+        recs = list(mwlr_iter(
+            BytesIO(imwlrdb_delta(old, new, 'c0')), depth=1
+        ))
+        self.assertEqual(recs, [
+            {'__type': 'CALENDAR', 'ALFA': '1', 'UID': 'c0'},
+            {
+                '__type': 'EVENT',
+                '__parent': 'c0',
+                'BRAVO': 'less',
+                'UID': 'e1'
+            },
+            {
+                '__type': 'EVENT',
+                '__parent': 'c0',
+                'a3': {'__type': 'ALARM', 'CHARLIE': '-3'},
+                'UID': 'e3'
+            },
+            {'__type': '__removed', 'UID': 'e0'},
+        ])
+
+    def test_reserved(self):
+        """Reserved names are only written in their own roles"""
+        d = {
+            '__type': 'EVENT',
+            '__pad': 'x',
+            '__removed': 'x',
+            'ALFA': '0',
+            '__parent': 'c0',
+            'a0': {'__type': 'ALARM', '__parent': 'e0'},
+        }
+        self.assertEqual(imwlrdb(d, 'e0'), EOL.join((
+            b'BEGIN:EVENT', b'UID:e0', b'__parent:c0', b'ALFA:0',
+            b'BEGIN:ALARM', b'UID:a0', b'END:ALARM', b'END:EVENT'
+        )))
+        with self.assertRaises(ValueError):
+            imwlrdb({'__type': '__dead'})
+
+    def test_removed_read(self):
+        """Removed records are read the same by all readers"""
+        new = self.tree()
+        del new['e1']
+        b = imwlrdb_delta(record_hashes(self.tree(), 'c0'), new, 'c0')
+        ref = list(mwlr_iter(BytesIO(b), depth=1))
+        self.assertEqual(ref, [{'__type': '__removed', 'UID': 'e1'}])
+        with TemporaryDirectory() as d:
+            fpath = path.join(d, 'test.mwlr')
+            with open(fpath, mode='wb') as f: f.write(b)
+            with MWLRReader(fpath) as r:
+                self.assertEqual(r.records, [('e1', '__removed', 0, len(b))])
+                self.assertEqual(r.record('e1'), ref[0])
+
+class asyncTests(TestCase):
+
+    class Sink:
+        """Stand-in for asyncio.StreamWriter"""
+        def __init__(self):
+            self.out = BytesIO()
+            self.drains = 0
+
+        def write(self, b):
+            self.out.write(b)
+
+        def writelines(self, x):
+            self.out.writelines(x)
+
+        async def drain(self):
+            self.drains += 1
+
+    d = {
+        '__type': 'RECORD',
+        'ALFA': 0,
+        'deadbeefcafe0000f000': {'__type': 'SUB_RECORD', 'CHARLIE': -1},
+        'deadbeefcafe0000f001': {'__type': 'SUB_RECORD', 'CHARLIE': -2},
+    }
+
+    def test_aiter_eq_imwlrdb(self):
+        async def f():
+            return b''.join([x async for x in imlwldb_aiter(self.d)])
+
+        self.assertEqual(run(f())[:-len(EOL)], imwlrdb(self.d))
+
+    def test_writer(self):
+        sink = self.Sink()
+
+        async def f():
+            async def recs():
+                for x in (self.d, {}, self.d): yield x
+
+            async with AsyncMWLRWriter(sink, buffer_bytes=32) as w:
+                await w.write_all(recs())
+
+        run(f())
+        ref = EOL.join((imwlrdb(self.d),) * 2)
+        self.assertEqual(sink.out.getvalue(), ref)
+        self.assertGreater(sink.drains, 1)
+
+    def test_append(self):
+        with self.assertRaises(ValueError):
+            AsyncMWLRWriter.append(BytesIO(imwlrdb(self.d)), outer='RECORD')
+
+    def test_sync_with(self):
+        """Writers cannot be used with a plain 'with' statement"""
+        with self.assertRaises(TypeError):
+            with AsyncMWLRWriter(self.Sink()): pass
+
+class statsTests(TestCase):
+
+    d = {
+        '__type': 'RECORD',
+        'ALFA': 0,
+        'BRAVO': 'x' * 100,
+        'deadbeefcafe0000f000': {'__type': 'SUB_RECORD', 'CHARLIE': -1},
+    }
+
+    def test_counts(self):
+        stats = SerialiseStats()
+        b = imwlrdb(self.d, stats=stats)
+        rec = stats.types['RECORD']
+        sub = stats.types['SUB_RECORD']
+        self.assertEqual(
+            [rec[k] for k in ('records', 'fields', 'lines', 'wraps')],
+            [1, 2, 5, 1]
+        )
+        self.assertEqual(
+            [sub[k] for k in ('records', 'fields', 'lines', 'wraps')],
+            [1, 1, 4, 0]
+        )
+        self.assertEqual(stats.total()['bytes'], len(b) + len(EOL))
+        self.assertEqual(b, imwlrdb(self.d))
+
+    def test_callback(self):
+        log = []
+        stats = SerialiseStats(callback=lambda *x: log.append(x))
+        f = BytesIO()
+        with MWLRWriter(f, stats=stats) as w:
+            w.write_all([self.d] * 4, jobs=2, chunk_size=1)
+        self.assertEqual([x[0] for x in log], ['SUB_RECORD', 'RECORD'] * 4)
+        self.assertEqual(stats.types['RECORD']['records'], 4)
+
+class mainTests(TempFileTestCase):
+
+    recs = [
+        {
+            '__type': 'RECORD',
+            'UID': f'r{i}',
+            'ALFA': 'x' * 100,
+            'BRAVO': 'excel\nmore excel',
+            'CHARLIE': {'DELTA': 'a;b', 'ECHO': {'FOXTROT': str(i)}},
+            'deadbeefcafe0000f000': {'__type': 'SUB_RECORD', 'GOLF': '-1'},
+        }
+        for i in range(8)
+    ]
+
+    def setUp(self):
+        super().setUp()
+        with open(self.path('in.jsonl'), mode='w') as f:
+            for d in self.recs: f.write(f'{dumps(d)}\n\n')
+
+    def test_round_trip(self):
+        """Records must come back the same, with or without workers"""
+        for jobs in ('1', '2'):
+            with self.subTest(jobs=jobs):
+                main([
+                    'mwlr', self.path('in.jsonl'), '-o', self.path('a.mwlr'),
+                    '--jobs', jobs
+                ])
+                f = BytesIO()
+                with MWLRWriter(f) as w:
+                    for d in self.recs: w.write(d, d['UID'])
+                self.assertEqual(self.read('a.mwlr'), f.getvalue())
+                main([
+                    'jsonl', self.path('a.mwlr'), '-o', self.path('b.jsonl'),
+                    '--jobs', jobs
+                ])
+                lines = self.read('b.jsonl', 'r').splitlines()
+                self.assertEqual([loads(x) for x in lines], self.recs)
+
+    def test_format(self):
+        main([
+            'mwlr', self.path('in.jsonl'), '-o', self.path('a.mwlr'),
+            '--eol', '\\n', '--sol', '\\t', '--width-bytes', '40',
+        ])
+        b = self.read('a.mwlr')
+        self.assertNotIn(b'\r\n', b)
+        self.assertIn(b'\n\t', b)
+        fmt = {'eol': '\n', 'sol': '\t', 'width_bytes': 40}
+        self.assertEqual(
+            list(mwlr_iter(BytesIO(b), in_format=fmt))[0]['ALFA'], 'x' * 100
+        )
+
+    def test_error(self):
+        with open(self.path('bad.jsonl'), mode='w') as f: f.write('[1]\n')
+        with self.assertRaises(SystemExit) as cm:
+            main(['mwlr', self.path('bad.jsonl'), '-o', self.path('a.mwlr')])
+        self.assertEqual(cm.exception.code, 1)
+
+    def test_std_streams(self):
+        """Standard streams are read and written as UTF-8, like files"""
+        d = {'__type': 'RECORD', 'ALFA': 'caf\xe9'}
+        b_json = bytes(f'{dumps(d, ensure_ascii=False)}\n', encoding='utf8')
+        b_mwlr = imwlrdb(d)
+        std = (sys.stdin, sys.stdout)
+        try:
+            for to, b_in, b_out in (
+                ('mwlr', b_json, b_mwlr), ('jsonl', b_mwlr, b_json)
+            ):
+                with self.subTest(to=to):
+                    f = BytesIO()
+                    sys.stdin = TextIOWrapper(BytesIO(b_in), encoding='ascii')
+                    sys.stdout = TextIOWrapper(f, encoding='ascii')
+                    self.assertEqual(main([to]), 0)
+                    self.assertEqual(f.getvalue(), b_out)
+        finally:
+            sys.stdin, sys.stdout = std